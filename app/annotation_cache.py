@@ -0,0 +1,177 @@
+"""函数注释结果的持久化缓存
+以规范化函数代码、模型、温度、提示词模板和 token 预算的哈希为键，存储在本地 SQLite 文件中，
+支持按条目数和存活时间淘汰，并记录命中/未命中计数
+"""
+import ast
+import atexit
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import textwrap
+import threading
+import time
+from token_budget import get_max_output_tokens, get_prompt_token_budget
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), '.annotation_cache.sqlite3')
+DEFAULT_MAX_ENTRIES = 100000
+DEFAULT_MAX_AGE_DAYS = 30
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def normalize_function_code(function_code):
+    """规范化函数代码：可解析时使用 AST 反解析结果（忽略注释和格式），否则压缩空白"""
+    try:
+        return ast.unparse(ast.parse(textwrap.dedent(function_code)))
+    except SyntaxError:
+        return re.sub(r'\s+', ' ', function_code).strip()
+
+
+def build_cache_key(function_code, environment, prompt_template):
+    """根据规范化代码、模型、温度、提示词模板及 token 预算生成缓存键
+
+    输入预算决定函数代码是否被压缩、输出上限决定 max_tokens，两者变化都可能改变注释内容。
+    """
+    payload = json.dumps([
+        normalize_function_code(function_code),
+        environment["model_name"],
+        str(environment["model_temperature"]),
+        prompt_template,
+        get_prompt_token_budget(environment),
+        get_max_output_tokens()
+    ], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class AnnotationCache:
+    """基于 SQLite 的注释缓存，可在多线程间共享"""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_age_days=DEFAULT_MAX_AGE_DAYS):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_days * 86400
+        self.hits = 0
+        self.misses = 0
+        # 读取路径不写库：命中/未命中计数和访问时间先记在内存中，写入、淘汰、统计或关闭时一并落盘
+        self._unflushed = {"hits": 0, "misses": 0}
+        self._accessed = {}  # 键 -> 最近访问时间
+        self._closed = False
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS annotations ("
+                "key TEXT PRIMARY KEY, content TEXT NOT NULL, metrics TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+        self.evict()
+        atexit.register(self.close)
+
+    def get(self, key):
+        """读取缓存，命中时返回 {"content", "metrics"}，否则返回 None（只读查询，不开启写事务）"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content, metrics FROM annotations WHERE key = ? AND created_at >= ?",
+                (key, now - self.max_age_seconds)
+            ).fetchone()
+            if not row:
+                self.misses += 1
+                self._unflushed["misses"] += 1
+                return None
+            self.hits += 1
+            self._unflushed["hits"] += 1
+            self._accessed[key] = now
+        return {"content": row[0], "metrics": json.loads(row[1])}
+
+    def _flush_locked(self):
+        """把内存中的计数和访问时间写入数据库（调用方已持有锁并处于事务中）"""
+        self._conn.executemany(
+            "INSERT INTO counters (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?",
+            [(name, count, count) for name, count in self._unflushed.items() if count]
+        )
+        self._conn.executemany("UPDATE annotations SET accessed_at = ? WHERE key = ?",
+                               [(accessed_at, key) for key, accessed_at in self._accessed.items()])
+        self._unflushed = {"hits": 0, "misses": 0}
+        self._accessed = {}
+
+    def flush(self):
+        """将内存中的命中/未命中计数和访问时间写入数据库"""
+        with self._lock, self._conn:
+            self._flush_locked()
+
+    def put(self, key, content, metrics):
+        """写入缓存，超过条目上限时淘汰最久未访问的记录"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO annotations (key, content, metrics, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, content, json.dumps(metrics), now, now)
+            )
+            self._flush_locked()
+        if self.max_entries and self._count() > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        """按存活时间和条目数上限淘汰缓存"""
+        with self._lock, self._conn:
+            self._flush_locked()  # 先写入访问时间，按最近访问淘汰
+            self._conn.execute(
+                "DELETE FROM annotations WHERE created_at < ?", (time.time() - self.max_age_seconds,)
+            )
+            if self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM annotations WHERE key NOT IN ("
+                    "SELECT key FROM annotations ORDER BY accessed_at DESC LIMIT ?)",
+                    (self.max_entries,)
+                )
+
+    def _count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM annotations").fetchone()[0]
+
+    def stats(self):
+        """返回本次进程的命中/未命中计数、累计计数和当前条目数"""
+        self.flush()
+        with self._lock:
+            totals = dict(self._conn.execute("SELECT name, value FROM counters").fetchall())
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "total_hits": totals.get("hits", 0),
+            "total_misses": totals.get("misses", 0),
+            "entries": self._count()
+        }
+
+    def close(self):
+        """写入内存中的计数和访问时间并关闭数据库连接（可重复调用）"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            with self._conn:
+                self._flush_locked()
+            self._conn.close()
+
+
+def get_annotation_cache(environment):
+    """按环境配置获取共享的缓存实例，未配置 cache_path 时返回 None"""
+    path = environment.get("cache_path") if environment else None
+    if not path:
+        return None
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = AnnotationCache(
+                path,
+                max_entries=int(os.getenv("CACHE_MAX_ENTRIES", str(DEFAULT_MAX_ENTRIES))),
+                max_age_days=float(os.getenv("CACHE_MAX_AGE_DAYS", str(DEFAULT_MAX_AGE_DAYS)))
+            )
+        return _caches[path]
@@ -0,0 +1,248 @@
+"""常驻注释服务
+在一个常驻进程中提供 HTTP 接口：环境配置只初始化一次，请求在 asyncio 事件循环中异步处理，
+模型调用交给有界线程池执行；规范化代码、模型和提示词模板都相同的在途请求合并为一次上游调用
+
+接口：
+    POST /annotate   请求体 {"code": "<函数代码>"}，返回 {"comment", "metrics", "coalesced"}
+    GET  /stats      请求数、排队深度、合并次数、延迟分位数、分阶段耗时等统计
+    GET  /health     健康检查
+
+用法：
+    python app/annotation_service.py [--host 127.0.0.1] [--port 8000] [--workers N] [--max-queue N]
+"""
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from annotation_cache import build_cache_key
+from func_annotator import generate_function_comment, init_environment, load_prompt_template
+from instrumentation import get_instrumentation, percentiles
+
+DEFAULT_MAX_BODY = 1024 * 1024
+LATENCY_WINDOW = 2048  # 延迟分位数基于最近的请求计算
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large",
+                502: "Bad Gateway", 503: "Service Unavailable"}
+
+
+class AnnotationService:
+    """注释服务：合并相同的在途请求，用有界线程池调用模型，并统计排队深度和延迟"""
+
+    def __init__(self, environment, *, workers=None, max_queue=None):
+        self.environment = environment
+        self.workers = workers or int(os.getenv("SERVICE_WORKERS", "8"))
+        self.max_queue = max_queue or int(os.getenv("SERVICE_MAX_QUEUE", "1000"))
+        self.started_at = time.time()
+        self.counters = {"requests": 0, "coalesced": 0, "upstream_calls": 0, "errors": 0, "rejected": 0}
+        self.queue_depth = 0  # 已提交、等待空闲工作线程的上游调用数
+        self.max_queue_depth = 0
+        self.running = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="annotate")
+        self._in_flight = {}  # 合并键 -> asyncio.Future
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._upstream_latencies = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+        self._loop = None
+        self._server = None
+        self._thread = None
+
+    def _call_upstream(self, function_code):
+        """工作线程中执行：调用模型生成注释"""
+        with self._lock:
+            self.queue_depth -= 1
+            self.running += 1
+        start = time.perf_counter()
+        try:
+            return generate_function_comment(function_code, self.environment)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self._upstream_latencies.append(time.perf_counter() - start)
+
+    async def annotate(self, function_code):
+        """生成注释，返回 (结果, 是否与在途请求合并)；结果为 dict 或错误信息字符串，队列已满时返回 None"""
+        start = time.perf_counter()
+        self.counters["requests"] += 1
+        key = build_cache_key(function_code, self.environment, load_prompt_template())
+        future = self._in_flight.get(key)
+        coalesced = future is not None
+        if coalesced:
+            self.counters["coalesced"] += 1
+        else:
+            if self.queue_depth >= self.max_queue:
+                self.counters["rejected"] += 1
+                return None, False
+            with self._lock:
+                self.queue_depth += 1
+                self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            self.counters["upstream_calls"] += 1
+            future = asyncio.get_running_loop().run_in_executor(self._executor, self._call_upstream, function_code)
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # shield：某个客户端断开时不取消其他请求共享的上游调用
+        result = await asyncio.shield(future)
+        if not isinstance(result, dict):
+            self.counters["errors"] += 1
+        self._latencies.append(time.perf_counter() - start)
+        return result, coalesced
+
+    def stats(self):
+        """返回服务统计"""
+        with self._lock:
+            queue_depth, running = self.queue_depth, self.running
+            upstream = list(self._upstream_latencies)
+        return {
+            **self.counters,
+            "in_flight": len(self._in_flight),
+            "queue_depth": queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "running": running,
+            "workers": self.workers,
+            "latency": percentiles(self._latencies, 4),
+            "upstream_latency": percentiles(upstream, 4),
+            "uptime": round(time.time() - self.started_at, 1),
+            "phases": get_instrumentation().summary(),
+            **({"routing": self.environment["router"].stats()} if self.environment.get("router") else {})
+        }
+
+    async def handle_request(self, method, path, body):
+        """处理一个 HTTP 请求，返回 (状态码, 响应对象)"""
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok", "model": self.environment["model_name"]}
+        if method == "GET" and path == "/stats":
+            return 200, self.stats()
+        if method != "POST" or path != "/annotate":
+            return 404, {"error": "Not found"}
+        try:
+            function_code = json.loads(body or b"{}")["code"]
+        except (ValueError, KeyError, TypeError):
+            return 400, {"error": "Request body must be JSON with a 'code' field"}
+        if not isinstance(function_code, str):
+            return 400, {"error": "'code' must be a string"}
+        result, coalesced = await self.annotate(function_code)
+        if result is None:
+            return 503, {"error": "Service queue is full, retry later"}
+        if not isinstance(result, dict):
+            status = 400 if result.startswith("Input must be") else 502
+            return status, {"error": result}
+        return 200, {**result, "coalesced": coalesced}
+
+    async def _handle_connection(self, reader, writer):
+        """处理一个连接上的 HTTP/1.1 请求（支持 keep-alive）"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                parts = request_line.decode('latin-1').split()
+                if len(parts) < 2:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode('latin-1').partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get("content-length", "0") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    status, payload = 400, {"error": "Invalid Content-Length"}
+                elif length > DEFAULT_MAX_BODY:
+                    status, payload = 413, {"error": "Request body too large"}
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    status, payload = await self.handle_request(parts[0].upper(), parts[1].split("?")[0], body)
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                keep_alive = headers.get("connection", "").lower() != "close" and length >= 0 and status != 413
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                    f"Content-Type: application/json; charset=utf-8\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host="127.0.0.1", port=8000):
+        """在当前事件循环中开始监听，返回 (host, port)"""
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self, host="127.0.0.1", port=8000):
+        """监听并持续处理请求"""
+        address = await self.start(host, port)
+        print(f"[SERVICE] 注释服务已启动：http://{address[0]}:{address[1]}（工作线程 {self.workers}）")
+        async with self._server:
+            await self._server.serve_forever()
+
+    def start_background(self, host="127.0.0.1", port=0):
+        """在后台线程的事件循环中运行服务（便于嵌入和测试），返回服务地址"""
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        address = []
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            address.extend(self._loop.run_until_complete(self.start(host, port)))
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="annotation-service", daemon=True)
+        self._thread.start()
+        ready.wait()
+        return f"http://{address[0]}:{address[1]}"
+
+    def stop(self):
+        """停止后台服务并关闭线程池"""
+        if self._loop is not None:
+            async def shutdown():
+                self._server.close()
+                await self._server.wait_closed()
+                # 关闭仍处于 keep-alive 的连接
+                handlers = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+                for task in handlers:
+                    task.cancel()
+                await asyncio.gather(*handlers, return_exceptions=True)
+            asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+        self._executor.shutdown(wait=True)
+
+
+def main():
+    """命令行入口：启动常驻注释服务"""
+    parser = argparse.ArgumentParser(description="常驻函数注释服务")
+    parser.add_argument("--host", default=os.getenv("SERVICE_HOST", "127.0.0.1"), help="监听地址")
+    parser.add_argument("--port", type=int, default=int(os.getenv("SERVICE_PORT", "8000")), help="监听端口")
+    parser.add_argument("--workers", type=int, default=None, help="上游调用的工作线程数（默认读取 SERVICE_WORKERS）")
+    parser.add_argument("--max-queue", type=int, default=None, help="排队上限，超过时返回 503（默认读取 SERVICE_MAX_QUEUE）")
+    args = parser.parse_args()
+    env = init_environment()
+    if not env:
+        print("[ERROR] 环境配置错误，请检查环境变量")
+        return
+    service = AnnotationService(env, workers=args.workers, max_queue=args.max_queue)
+    try:
+        asyncio.run(service.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        print(f"[SERVICE] 统计：{json.dumps(service.stats(), ensure_ascii=False)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,58 @@
 """
 批量函数注释生成工具
-从 feedings/ 目录读取函数样本，批量生成注释（不保存文件）
+从 feedings/ 目录读取函数样本，批量生成注释（默认不修改源码，--write-back 时作为文档字符串写回）
 对每个函数进行评分和记录
 """
-import ast
+import argparse
+import os
 import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import count, islice
 from pathlib import Path
 from datetime import datetime
-import mlflow
 from tqdm import tqdm
+from dedup import FunctionDeduplicator
+from annotation_cache import DEFAULT_CACHE_PATH, build_cache_key, get_annotation_cache
+from prompt_packing import generate_packed_comments, pack_functions
+from provider_batch import (
+    DEFAULT_BATCH_PATH,
+    BatchRequestWriter,
+    default_task_index_path,
+    iter_batch_results,
+    load_task_index,
+    parse_batch_result
+)
+from instrumentation import Instrumentation, format_summary, get_instrumentation, reset_instrumentation
+from token_budget import plan_function_prompt
+from tracking import (
+    BackgroundTracker,
+    init_tracking,
+    log_metrics,
+    log_params,
+    mlflow,
+    replay_fallback,
+    start_run,
+    tracking_enabled
+)
+from repo_scanner import scan_file, scan_repository
+from incremental import DEFAULT_MANIFEST_PATH, AnnotationManifest, compute_run_signature
+from work_queue import DEFAULT_LEASE_SECONDS, DEFAULT_QUEUE_PATH, WorkQueue, default_worker_id
 from func_annotator import (
     init_environment,
-    generate_function_comment
+    build_comment_result,
+    generate_function_comment,
+    load_prompt_template
 )
 
 
+# 与 results_store.DEFAULT_RESULTS_DIR 相同；在此单独定义，避免启动时为命令行默认值加载 pyarrow
+DEFAULT_RESULTS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'outputs', 'annotations')
+
+
 def extract_functions_from_file(file_path):
-    """从 Python 文件中提取所有函数定义"""
-    functions = []
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        # 解析 Python AST
-        tree = ast.parse(content)
-        for node in ast.walk(tree):
-            if isinstance(node, ast.FunctionDef):
-                # 获取函数的起始和结束行号
-                func_lines = content.split('\n')[node.lineno - 1:node.end_lineno]
-                func_code = '\n'.join(func_lines)
-                functions.append({
-                    'name': node.name,
-                    'code': func_code,
-                    'line': node.lineno
-                })
-    except Exception as e:
-        print(f"[ERROR] 读取文件 {file_path} 时出错: {e}")
-    return functions
+    """从 Python 文件中提取所有函数定义（含异步函数和类方法）"""
+    return scan_file(file_path)
 
 
 def extract_annotation_content(annotation):
@@ -46,118 +63,377 @@ def extract_annotation_content(annotation):
     return annotation
 
 
-def process_sample_file(sample_file, env):
-    """处理单个样本文件，生成注释但不保存输出文件"""
-    # 提取文件名
-    function_name = Path(sample_file).name
-    functions = extract_functions_from_file(sample_file)
-    # 记录每个函数的结果
-    function_records = []
-    success_count = 0
-    error_count = 0
-    # 创建函数处理进度条（显示 当前/总数，时间格式改为运行耗时）
-    func_progress = tqdm(
-        functions,
-        desc=f"处理 {function_name}",
-        leave=True,  # 处理完文件后保留进度条
+def build_function_record(file_name, func_info, result):
+    """根据注释结果构建单个函数的记录"""
+    record = {
+        'file': file_name,
+        'function_name': func_info.get('qualname', func_info['name']),
+        'line': func_info.get('line'),
+        'comment': None,
+        'latency': 0.0,
+        'success': False,
+        'input_length': len(func_info['code'].strip()),
+        'output_length': 0,
+        'completeness': 0.0,
+        'comment_density': 0.0,
+        'cache_hit': False,
+        'error_message': None
+    }
+    # 1. 成功场景：result为字典（包含注释和指标）
+    if isinstance(result, dict):
+        metrics = result["metrics"]
+        record['success'] = True
+        record['comment'] = result["comment"]
+        record['latency'] = metrics["latency"]
+        record['output_length'] = metrics["output_length"]
+        record['completeness'] = metrics["completeness"]
+        record['comment_density'] = metrics["comment_density"]
+        record['cache_hit'] = metrics.get("cache_hit", False)
+    # 2. 错误场景：result为字符串（错误信息）
+    else:
+        record['error_message'] = result
+        record['latency'] = (datetime.now() - datetime.now()).total_seconds()  # 错误场景耗时为0
+    return record
+
+
+def log_function_record(record, func_info, result, env, tracker=None):
+    """将单个函数的结果记录到MLflow
+
+    传入 tracker 时交由后台记录器按批写入父运行，否则在跟踪开启时于当前线程同步写入嵌套运行。
+    """
+    if tracker is None and not tracking_enabled(env):
+        return
+    file_name = record['file']
+    func_name = record['function_name']
+    params = {
+        "file": file_name,
+        "function_name": func_name,
+        "model": env["model_name"]
+    }
+    if isinstance(result, dict):
+        metrics = result["metrics"]
+        run_name = f"{env['model_name']}_{file_name}_{func_name}"
+        params["temperature"] = env["model_temperature"]
+        if metrics.get("endpoint"):
+            params["endpoint"] = metrics["endpoint"]
+        run_metrics = {
+            "input_length": record['input_length'],
+            "output_length": metrics["output_length"],
+            "耗时": metrics["latency"],
+            "completeness": metrics["completeness"],
+            "comment_density": metrics["comment_density"],
+            "success": 1,
+            # 估算与实际 token 数（缓存命中或服务端未返回用量时缺省）
+            **{key: metrics[key] for key in ("input_tokens_est", "input_tokens", "output_tokens", "max_tokens")
+               if metrics.get(key) is not None}
+        }
+        if metrics.get("compaction"):
+            params["compaction"] = metrics["compaction"]
+        texts = {
+            f"{func_name}_annotation.txt": extract_annotation_content(result["comment"]),
+            f"{func_name}_input.txt": func_info['code']
+        }
+    else:
+        run_name = f"{env['model_name']}_{file_name}_{func_name}_error"
+        params["error_message"] = result
+        run_metrics = {"input_length": record['input_length'], "耗时": 0.0, "success": 0}
+        texts = {}
+    if tracker is not None:
+        tracker.log_run(run_name, params, run_metrics, texts)
+        return
+    with mlflow.start_run(run_name=run_name, nested=True):
+        mlflow.log_params(params)
+        mlflow.log_metrics(run_metrics)
+        for artifact_file, text in texts.items():
+            mlflow.log_text(text, artifact_file)
+
+
+def summarize_file_records(file_name, function_records):
+    """计算文件级统计（平均耗时计算方式：总和/数量）"""
+    stats = FileStats()
+    for record in function_records:
+        stats.add(record)
+    return stats.summary(file_name)
+
+
+class FileStats:
+    """按文件累计函数记录的计数和指标之和，只保留计数器、不保留记录本身，结果与逐条汇总一致"""
+
+    def __init__(self):
+        self.files = {}  # 文件名 -> 累计值，按首次出现的任务序号排序输出
+
+    def add(self, record, index=0):
+        """计入一条函数记录（index 为任务序号，用于按扫描顺序输出文件）"""
+        totals = self.files.setdefault(record['file'], {
+            'first_index': index, 'success_count': 0, 'error_count': 0,
+            'completeness': 0, 'density': 0, 'latency': 0
+        })
+        totals['first_index'] = min(totals['first_index'], index)
+        if not record['success']:
+            totals['error_count'] += 1
+            return
+        totals['success_count'] += 1
+        totals['completeness'] += record['completeness']
+        totals['density'] += record['comment_density']
+        totals['latency'] += record['latency']
+
+    def summary(self, file_name):
+        """单个文件的统计（无记录时各项为 0）"""
+        totals = self.files.get(file_name) or {'success_count': 0, 'error_count': 0, 'completeness': 0,
+                                               'density': 0, 'latency': 0}
+        success_count = totals['success_count']
+        return {
+            'file': file_name,
+            'success_count': success_count,
+            'error_count': totals['error_count'],
+            'avg_completeness': totals['completeness'] / success_count if success_count else 0,
+            'avg_density': totals['density'] / success_count if success_count else 0,
+            'avg_duration': totals['latency'] / success_count if success_count else 0,
+            'total_success_latency': totals['latency']  # 新增总耗时字段用于全局计算
+        }
+
+    def summaries(self):
+        """所有文件的统计，按文件首次出现的任务序号排序"""
+        return [self.summary(file_name)
+                for file_name in sorted(self.files, key=lambda name: self.files[name]['first_index'])]
+
+
+def annotate_unit(unit, env):
+    """执行一个工作单元：单个函数直接请求，多个函数打包为一次请求"""
+    if len(unit) == 1:
+        return [generate_function_comment(unit[0][1]['code'], env)]
+    return generate_packed_comments([task['code'] for _, task in unit], env)
+
+
+def run_annotation_tasks(tasks, env, workers=1, progress=None):
+    """执行注释任务，按完成顺序逐个产出 (任务序号, 任务, 结果)
+
+    workers > 1 时使用线程池并发请求，在途请求数不超过 workers；
+    env["pack_size"] > 1 时每个请求最多打包 pack_size 个函数（且估算token数不超过 env["pack_tokens"]）。
+    MLflow 记录等有状态操作由调用方在主线程中完成。
+    """
+    pack_size = env.get("pack_size") or 1
+    units = pack_functions(tasks, pack_size, env.get("pack_tokens")) if pack_size > 1 \
+        else ([(index, task)] for index, task in enumerate(tasks))
+    if workers <= 1:
+        for unit in units:
+            results = annotate_unit(unit, env)
+            if progress is not None:
+                progress.update(len(unit))
+            for (index, task), result in zip(unit, results):
+                yield index, task, result
+        return
+    unit_iter = iter(units)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = {}
+        # 先填满并发窗口，之后每完成一个再补充一个
+        for unit in islice(unit_iter, workers):
+            in_flight[executor.submit(annotate_unit, unit, env)] = unit
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                unit = in_flight.pop(future)
+                next_unit = next(unit_iter, None)
+                if next_unit is not None:
+                    in_flight[executor.submit(annotate_unit, next_unit, env)] = next_unit
+                if progress is not None:
+                    progress.update(len(unit))
+                for (index, task), result in zip(unit, future.result()):
+                    yield index, task, result
+
+
+def create_progress_bar(total, desc):
+    """创建进度条（显示 当前/总数，时间格式为运行耗时）"""
+    return tqdm(
+        total=total,
+        desc=desc,
+        leave=True,  # 处理完成后保留进度条
         unit="函数",
         bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [运行耗时：{elapsed_s:.1f}秒]"
     )
-    # 处理每个函数
-    for func_info in func_progress:
-        func_name = func_info['name']
-        func_code = func_info['code']
-        input_length = len(func_code.strip())
-        # 生成注释（接收字典格式结果或错误信息）
-        result = generate_function_comment(func_code, env)
-        # 创建函数记录
-        record = {
-            'file': function_name,
-            'function_name': func_name,
-            'latency': 0.0,
-            'success': False,
-            'input_length': input_length,
-            'output_length': 0,
-            'completeness': 0.0,
-            'comment_density': 0.0,
-            'error_message': None
-        }
-        # 1. 成功场景：result为字典（包含注释和指标）
-        if isinstance(result, dict):
-            comment = result["comment"]
-            metrics = result["metrics"]
-            annotation_content = extract_annotation_content(comment)
-            # 更新记录
-            record['success'] = True
-            record['latency'] = metrics["latency"]
-            record['output_length'] = metrics["output_length"]
-            record['completeness'] = metrics["completeness"]
-            record['comment_density'] = metrics["comment_density"]
-            success_count += 1
-            # 统一记录MLflow日志（外层唯一日志）
-            with mlflow.start_run(
-                run_name=f"{env['model_name']}_{function_name}_{func_name}",
-                nested=True
-            ):
-                mlflow.log_param("file", function_name)
-                mlflow.log_param("function_name", func_name)
-                mlflow.log_param("model", env["model_name"])
-                mlflow.log_param("temperature", env["model_temperature"])
-                mlflow.log_metric("input_length", input_length)
-                mlflow.log_metric("output_length", metrics["output_length"])
-                mlflow.log_metric("耗时", metrics["latency"])
-                mlflow.log_metric("completeness", metrics["completeness"])
-                mlflow.log_metric("comment_density", metrics["comment_density"])
-                mlflow.log_metric("success", 1)
-                mlflow.log_text(annotation_content, f"{func_name}_annotation.txt")
-                mlflow.log_text(func_code, f"{func_name}_input.txt")
-        # 2. 错误场景：result为字符串（错误信息）
+
+
+def open_results_sink(results_dir, run_id, model_name):
+    """打开列式结果数据集的写入器，未指定目录时返回 None；pyarrow 只在写入结果时加载"""
+    if not results_dir:
+        return None
+    from results_store import ResultsWriter  # pylint: disable=import-outside-toplevel
+    return ResultsWriter(results_dir, run_id or uuid.uuid4().hex, model_name)
+
+
+def close_tracker(tracker):
+    """等待后台记录器写完，有记录转存到本地回退文件时提示重放方式"""
+    if tracker is None:
+        return
+    tracker.close()
+    if tracker.fallback_count:
+        print(f"\n[TRACKING] {tracker.fallback_count} 条记录未能写入 MLflow，已保存到 {tracker.fallback_path}；"
+              f"可用 --replay-tracking 重新写入")
+
+
+def replay_tracking(fallback_path=None):
+    """将本地回退文件中的函数记录重新写入 MLflow"""
+    init_tracking()
+    replayed, remaining = replay_fallback(fallback_path)
+    print(f"[TRACKING] 已重新写入 {replayed} 条记录，仍失败 {remaining} 条")
+    return replayed, remaining
+
+
+def record_result(task, result, env, *, tracker=None, manifest=None, sink=None):
+    """将一个函数的注释结果转换为函数记录，并写入日志、结果数据集和增量清单"""
+    record = build_function_record(task['file'], task, result)
+    with get_instrumentation().span("tracking"):
+        log_function_record(record, task, result, env, tracker)
+    if sink is not None:
+        sink.write(record, task['code'])
+    if manifest and isinstance(result, dict):
+        manifest.update(task, record)
+    return record
+
+
+def annotate_tasks(tasks, env, workers=1, *, tracker=None, progress=None, manifest=None, sink=None, dedup=None,
+                   on_record=None):
+    """为任务列表生成注释并记录日志，返回与任务顺序一致的函数记录
+
+    传入 on_record 时每条记录完成后立即交给 on_record(任务序号, 记录)，不在内存中保留记录，返回 None，
+    此时内存占用不随任务总数增长（用于扫描整个仓库）；
+    传入 manifest 时，指纹未变化的函数直接沿用清单中的记录，不调用模型也不重复记录日志；
+    传入 sink（ResultsWriter）时，所有函数记录（包括沿用的记录）都会写入列式结果数据集；
+    传入 dedup（FunctionDeduplicator）时，结构等价的函数只为代表函数调用模型，其余函数复用其注释，
+    代表函数失败时这些函数最后单独调用模型。
+    """
+    records = {}
+    pending = {}  # 调用模型的任务：提交顺序 -> 在原任务列表中的序号（完成后移除）
+    submitted = count()
+    orphans = []  # 代表函数失败、需要单独调用模型的 (序号, 任务)
+
+    def emit(index, record):
+        if on_record is None:
+            records[index] = record
         else:
-            record['error_message'] = result
-            record['latency'] = (datetime.now() - datetime.now()).total_seconds()  # 错误场景耗时为0
-            error_count += 1
-            # 统一记录MLflow错误日志
-            with mlflow.start_run(
-                run_name=f"{env['model_name']}_{function_name}_{func_name}_error",
-                nested=True
-            ):
-                mlflow.log_param("file", function_name)
-                mlflow.log_param("function_name", func_name)
-                mlflow.log_param("model", env["model_name"])
-                mlflow.log_param("error_message", result)
-                mlflow.log_metric("input_length", input_length)
-                mlflow.log_metric("耗时", 0.0)
-                mlflow.log_metric("success", 0)
-
-        function_records.append(record)
-        # 更新进度条时计算已用秒数（保留1位小数）
-        func_progress.set_postfix(elapsed_s=func_progress.format_dict['elapsed'])
+            on_record(index, record)
+
+    def record_followers(followers):
+        """为复用代表注释的函数生成记录"""
+        for index, task, names, group in followers:
+            result = dedup.derive(group, task, names)
+            if result is None:
+                orphans.append((index, task))
+                continue
+            emit(index, record_result(task, result, env, tracker=tracker, manifest=manifest, sink=sink))
+            if progress is not None:
+                progress.update(1)
+
+    def pending_tasks():
+        """逐个产出需要注释的任务，未变化的函数直接沿用清单记录，结构等价的函数等待代表函数的结果"""
+        for index, task in enumerate(tasks):
+            carried = manifest.lookup(task) if manifest else None
+            if carried is None:
+                followers = dedup.assign(index, task) if dedup else None
+                if followers is None:
+                    pending[next(submitted)] = index
+                    yield task
+                else:
+                    record_followers(followers)
+                continue
+            emit(index, carried)
+            if sink is not None:
+                sink.write(carried, task['code'])
+            if progress is not None:
+                progress.update(1)
+
+    for position, task, result in run_annotation_tasks(pending_tasks(), env, workers, progress):
+        index = pending.pop(position)
+        emit(index, record_result(task, result, env, tracker=tracker, manifest=manifest, sink=sink))
+        if dedup:
+            record_followers(dedup.complete(index, result))
+        if progress is not None:
+            # 更新进度条时计算已用秒数（保留1位小数）
+            progress.set_postfix(elapsed_s=progress.format_dict['elapsed'])
+    if orphans:
+        for position, task, result in run_annotation_tasks([t for _, t in orphans], env, workers, progress):
+            emit(orphans[position][0], record_result(task, result, env, tracker=tracker, manifest=manifest,
+                                                     sink=sink))
+    if on_record is not None:
+        return None
+    return [records[index] for index in sorted(records)]
+
+
+def summarize_records_by_file(records):
+    """按文件分组计算统计信息，文件顺序与记录中首次出现的顺序一致（records 可为迭代器，逐条累计）"""
+    stats = FileStats()
+    for index, record in enumerate(records):
+        stats.add(record, index)
+    return stats.summaries()
+
+
+def process_sample_file(sample_file, env, workers=1, *, tracker=None, manifest=None, sink=None, dedup=None):
+    """处理单个样本文件，生成注释但不保存输出文件"""
+    # 提取文件名
+    function_name = Path(sample_file).name
+    functions = [{**func_info, 'file': function_name} for func_info in extract_functions_from_file(sample_file)]
+    func_progress = create_progress_bar(len(functions), f"处理 {function_name}")
+    # 记录每个函数的结果（按函数在文件中的顺序保存）
+    function_records = annotate_tasks(
+        functions, env, workers, tracker=tracker, progress=func_progress, manifest=manifest, sink=sink, dedup=dedup
+    )
     # 关闭当前文件的进度条
     func_progress.close()
-    # 计算文件级统计（修改平均耗时计算方式：总和/数量）
-    success_records = [r for r in function_records if r['success']]
-    total_success_latency = sum(r['latency'] for r in success_records)
-    avg_completeness = sum(r['completeness'] for r in success_records) / len(success_records) if success_records else 0
-    avg_density = sum(r['comment_density'] for r in success_records) / len(success_records) if success_records else 0
-    avg_duration = total_success_latency / len(success_records) if success_records else 0
-    return {
-        'file': function_name,
-        'success_count': success_count,
-        'error_count': error_count,
-        'avg_completeness': avg_completeness,
-        'avg_density': avg_density,
-        'avg_duration': avg_duration,
-        'total_success_latency': total_success_latency  # 新增总耗时字段用于全局计算
-    }
+    return summarize_file_records(function_name, function_records)
 
 
-def batch_annotate():
-    """批量处理所有样本文件（不保存输出文件，仅输出统计）"""
-    # 初始化环境
-    env = init_environment()
-    if not env:
-        print("\n[ERROR] 环境配置错误，请检查环境变量")
-        return
+def process_sample_files(sample_files, env, workers=1, *, tracker=None, manifest=None, sink=None, dedup=None):
+    """处理多个样本文件，返回每个文件的统计信息
+
+    workers <= 1 时逐个文件顺序处理；否则所有文件的函数共享同一个线程池，
+    文件级统计仍按文件分组计算，与顺序运行结果一致。
+    """
+    if workers <= 1:
+        return [
+            process_sample_file(sample_file, env, tracker=tracker, manifest=manifest, sink=sink, dedup=dedup)
+            for sample_file in sample_files
+        ]
+    tasks = []
+    spans = []  # 每个文件的 (文件名, 起始序号, 结束序号)：按任务序号分组，不同目录下的同名文件互不混淆
+    for sample_file in sample_files:
+        file_name = Path(sample_file).name
+        start = len(tasks)
+        for func_info in extract_functions_from_file(sample_file):
+            tasks.append({**func_info, 'file': file_name})
+        spans.append((file_name, start, len(tasks)))
+    progress = create_progress_bar(len(tasks), f"处理 {len(sample_files)} 个文件（并发 {workers}）")
+    records = annotate_tasks(
+        tasks, env, workers, tracker=tracker, progress=progress, manifest=manifest, sink=sink, dedup=dedup
+    )
+    progress.close()
+    return [summarize_file_records(file_name, records[start:end]) for file_name, start, end in spans]
+
+
+def process_source_tree(source_root, env, workers=1, *, include=None, exclude=None, default_excludes=True,
+                        tracker=None, manifest=None, sink=None, dedup=None):
+    """扫描任意目录树并为其中的函数生成注释，返回每个文件的统计信息
+
+    文件在进程池中并行解析，函数记录按需流入注释流程，不会预先加载整棵树；
+    每条记录完成后即写入各个 sink 并计入按文件累计的统计，不保留记录列表。
+    """
+    progress = create_progress_bar(None, f"处理 {source_root}")
+    tasks = scan_repository(source_root, include, exclude, default_excludes=default_excludes)
+    stats = FileStats()
+    annotate_tasks(
+        tasks, env, workers, tracker=tracker, progress=progress, manifest=manifest, sink=sink, dedup=dedup,
+        on_record=lambda index, record: stats.add(record, index)
+    )
+    progress.close()
+    return stats.summaries()
+
+
+def find_sample_files(source_root=None):
+    """未指定源码目录时返回 feedings/ 下的样本文件列表，指定时返回空列表；目录或样本不存在时返回 None"""
+    if source_root:
+        if not os.path.isdir(source_root):
+            print(f"\n[ERROR] 源码目录不存在: {source_root}")
+            return None
+        return []
     # 获取项目根目录
     project_root = Path(__file__).parent.parent
     feedings_dir = project_root / 'feedings'
@@ -165,59 +441,511 @@ def batch_annotate():
     sample_files = list(feedings_dir.glob('function_sample*.py'))
     if not sample_files:
         print(f"\n[ERROR] 未找到样本文件在 {feedings_dir}")
+        return None
+    return sample_files
+
+
+def iter_source_tasks(sample_files, source_root=None, include=None, exclude=None, default_excludes=True):
+    """逐个产出待注释的函数：指定源码目录时扫描目录树，否则读取样本文件"""
+    if source_root:
+        yield from scan_repository(source_root, include, exclude, default_excludes=default_excludes)
         return
-    # 启动MLflow主运行
-    with mlflow.start_run(run_name=f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}"):
-        mlflow.log_param("batch_start_time", datetime.now().isoformat())
-        mlflow.log_param("total_files", len(sample_files))
-        mlflow.log_param("model", env["model_name"])
-        mlflow.log_param("temperature", env["model_temperature"])
-        # 记录所有文件的统计信息
-        all_stats = []
-        # 处理每个文件
-        start_time = time.time()
-        for sample_file in sample_files:
-            stats = process_sample_file(sample_file, env)
-            all_stats.append(stats)
-        total_time = time.time() - start_time
-        # 计算总体统计
-        total_functions = sum(s['success_count'] + s['error_count'] for s in all_stats)
-        total_success = sum(s['success_count'] for s in all_stats)
-        total_errors = sum(s['error_count'] for s in all_stats)
-        total_latency = sum(s['total_success_latency'] for s in all_stats)
-        overall_success_rate = total_success / total_functions if total_functions > 0 else 0
-        overall_avg_completeness = (
+    for sample_file in sample_files:
+        file_name = Path(sample_file).name
+        for func_info in extract_functions_from_file(sample_file):
+            yield {**func_info, 'file': file_name}
+
+
+def compute_overall_stats(all_stats, total_time):
+    """根据各文件统计计算总体统计"""
+    total_functions = sum(s['success_count'] + s['error_count'] for s in all_stats)
+    total_success = sum(s['success_count'] for s in all_stats)
+    total_latency = sum(s['total_success_latency'] for s in all_stats)
+    return {
+        'total_files': len(all_stats),
+        'total_functions': total_functions,
+        'total_success': total_success,
+        'total_errors': sum(s['error_count'] for s in all_stats),
+        'success_rate': total_success / total_functions if total_functions > 0 else 0,
+        'avg_completeness': (
             sum(s['avg_completeness'] * s['success_count'] for s in all_stats)
             / total_success if total_success > 0 else 0
-        )
-        overall_avg_density = (
+        ),
+        'avg_density': (
             sum(s['avg_density'] * s['success_count'] for s in all_stats)
             / total_success if total_success > 0 else 0
-        )
-        overall_avg_duration = total_time / total_success if total_success > 0 else 0  # 总耗时/总成功数
-        overall_avg_latency = (
-            total_latency/ total_success if total_success > 0 else 0
-        )
-        # 记录总体指标到MLflow
-        mlflow.log_metric("total_functions", total_functions)
-        mlflow.log_metric("total_success", total_success)
-        mlflow.log_metric("total_errors", total_errors)
-        mlflow.log_metric("success_rate", overall_success_rate)
-        mlflow.log_metric("avg_completeness", overall_avg_completeness)
-        mlflow.log_metric("avg_density", overall_avg_density)
-        mlflow.log_metric("avg_duration", overall_avg_duration)
-        mlflow.log_metric("total_time", total_time)
-    # 输出最终统计结果
+        ),
+        'avg_duration': total_time / total_success if total_success > 0 else 0,  # 总耗时/总成功数
+        'avg_latency': total_latency / total_success if total_success > 0 else 0,
+        'total_time': total_time
+    }
+
+
+def log_overall_stats(env, overall, extra_metrics=None):
+    """记录总体指标到MLflow（跟踪关闭时跳过）"""
+    log_metrics(env, {
+        "total_functions": overall['total_functions'],
+        "total_files": overall['total_files'],
+        "total_success": overall['total_success'],
+        "total_errors": overall['total_errors'],
+        "success_rate": overall['success_rate'],
+        "avg_completeness": overall['avg_completeness'],
+        "avg_density": overall['avg_density'],
+        "avg_duration": overall['avg_duration'],
+        "total_time": overall['total_time'],
+        **(extra_metrics or {})
+    })
+
+
+def print_overall_stats(overall):
+    """输出总体统计（不含结尾分隔线，调用方可追加其他统计行）"""
     print("\n" + "=" * 60)
     print("[STATS] 统计：")
-    print(f"   [SUCCESS] 成功：{total_success}")
-    print(f"   [FAILED] 失败：{total_errors}")
-    print(f"   [AVG_LATENCY] 平均延迟：{overall_avg_latency:.2f}s")
-    print(f"   [AVG_COMPLETENESS] 平均完整性：{overall_avg_completeness:.2%}")
-    print(f"   [AVG_DENSITY] 平均注释密度：{overall_avg_density:.4f}")
-    print(f"   [AVG_DURATION] 平均耗时：{overall_avg_duration:.2f}s")
+    print(f"   [SUCCESS] 成功：{overall['total_success']}")
+    print(f"   [FAILED] 失败：{overall['total_errors']}")
+    print(f"   [AVG_LATENCY] 平均延迟：{overall['avg_latency']:.2f}s")
+    print(f"   [AVG_COMPLETENESS] 平均完整性：{overall['avg_completeness']:.2%}")
+    print(f"   [AVG_DENSITY] 平均注释密度：{overall['avg_density']:.4f}")
+    print(f"   [AVG_DURATION] 平均耗时：{overall['avg_duration']:.2f}s")
+
+
+def batch_annotate(workers=None, *, cache_path=None, pack_size=None, pack_tokens=None, manifest_path=None,
+                   source_root=None, include=None, exclude=None, default_excludes=True, results_dir=None,
+                   trace_path=None, dedup=None, write_back=None):
+    """批量处理所有样本文件（默认不修改源码，仅输出统计），返回总体统计（环境或输入错误时返回 None）
+
+    workers: 并发请求数，未指定时读取环境变量 BATCH_WORKERS（默认 1，即顺序执行）
+    cache_path: 注释缓存文件路径，未指定时使用环境变量 ANNOTATION_CACHE_PATH（未设置则不缓存）
+    pack_size/pack_tokens: 每个请求打包的函数数量上限及估算token上限，未指定时读取 PACK_SIZE/PACK_TOKENS
+    manifest_path: 增量模式的函数指纹清单路径，指定时只为新增或变化的函数生成注释
+    source_root/include/exclude: 指定时扫描该目录树（按包含/排除 glob 过滤）代替 feedings/ 样本文件
+    default_excludes: 是否在 exclude 之外同时排除 .git、venv 等默认目录（默认 True）
+    results_dir: 列式结果数据集目录，未指定时读取 RESULTS_DIR（未设置则不写入）
+    trace_path: 分阶段耗时的追踪事件文件（Chrome Trace 格式），未指定时读取 TRACE_PATH（未设置则不导出）
+    dedup: 是否对结构等价（仅标识符不同）的函数只调用一次模型，未指定时读取 DEDUP_FUNCTIONS
+    write_back: 运行结束后将注释作为文档字符串写回源码："apply" 修改文件，"diff" 只输出统一 diff
+    """
+    if workers is None:
+        workers = int(os.getenv("BATCH_WORKERS", "1"))
+    results_dir = results_dir or os.getenv("RESULTS_DIR")
+    # 初始化环境
+    env = init_environment()
+    if not env:
+        print("\n[ERROR] 环境配置错误，请检查环境变量")
+        return None
+    if cache_path:
+        env["cache_path"] = cache_path
+    if pack_size:
+        env["pack_size"] = pack_size
+    if pack_tokens:
+        env["pack_tokens"] = pack_tokens
+    if dedup is not None:
+        env["dedup"] = dedup
+    cache = get_annotation_cache(env)
+    deduplicator = FunctionDeduplicator() if env["dedup"] else None
+    manifest = AnnotationManifest(
+        manifest_path, compute_run_signature(env, load_prompt_template())
+    ) if manifest_path else None
+    sample_files = find_sample_files(source_root)
+    if sample_files is None:
+        return None
+    # 每次运行重新统计各阶段耗时
+    instrumentation = reset_instrumentation(trace_path)
+    # 启动MLflow主运行（跟踪关闭时不加载mlflow）
+    with start_run(env, f"batch_{datetime.now().strftime('%Y%m%d_%H%M%S')}") as run_id:
+        batch_params = {
+            "batch_start_time": datetime.now().isoformat(),
+            "model": env["model_name"],
+            "temperature": env["model_temperature"],
+            "workers": workers,
+            "pack_size": env["pack_size"],
+            "dedup": env["dedup"]
+        }
+        if source_root:
+            batch_params["source_root"] = os.path.abspath(source_root)
+        else:
+            batch_params["total_files"] = len(sample_files)
+        log_params(env, batch_params)
+        # 处理所有文件并记录统计信息
+        start_time = time.time()
+        # 函数级记录交给后台记录器，跟踪I/O不占用批处理的关键路径
+        tracker = BackgroundTracker.for_active_run() if run_id else None
+        # 函数记录同时写入列式结果数据集（按行组批量写入）
+        results_sink = open_results_sink(results_dir, run_id, env["model_name"])
+        sink = results_sink
+        if write_back:
+            # 写回模式收集成功的函数记录（含代码），运行结束后按文件一次写回；仅此时加载写回模块
+            from docstring_writer import DocstringCollector  # pylint: disable=import-outside-toplevel
+            sink = DocstringCollector(results_sink)
+        try:
+            if source_root:
+                all_stats = process_source_tree(
+                    source_root, env, workers, include=include, exclude=exclude, default_excludes=default_excludes,
+                    tracker=tracker, manifest=manifest, sink=sink, dedup=deduplicator
+                )
+            else:
+                all_stats = process_sample_files(
+                    sample_files, env, workers, tracker=tracker, manifest=manifest, sink=sink, dedup=deduplicator
+                )
+            total_time = time.time() - start_time
+        finally:
+            close_tracker(tracker)
+            if sink is not None:
+                sink.close()
+        if results_sink is not None:
+            log_params(env, {"results_path": results_sink.path})
+        overall = compute_overall_stats(all_stats, total_time)
+        extra_metrics = {}
+        write_back_stats = None
+        if write_back:
+            from docstring_writer import write_back_docstrings  # pylint: disable=import-outside-toplevel
+            write_back_stats = write_back_docstrings(
+                source_root or Path(__file__).parent.parent / 'feedings', sink.records, workers=workers,
+                dry_run=write_back == "diff"
+            )
+            extra_metrics["docstrings_written"] = write_back_stats["written"]
+        if tracker is not None:
+            extra_metrics["tracking_fallback_records"] = tracker.fallback_count
+        if manifest:
+            manifest.save()
+            extra_metrics["carried_forward"] = manifest.carried_count
+        if deduplicator:
+            extra_metrics["dedup_reused"] = deduplicator.reused
+        if cache:
+            cache_stats = cache.stats()
+            extra_metrics["cache_hits"] = cache_stats["hits"]
+            extra_metrics["cache_misses"] = cache_stats["misses"]
+        router_stats = env["router"].stats() if env.get("router") else None
+        if router_stats:
+            extra_metrics["hedged_calls"] = router_stats["hedged_calls"]
+            for endpoint in router_stats["endpoints"]:
+                for key in ("calls", "failures", "p50", "p95", "hedges_won"):
+                    extra_metrics[f"endpoint_{endpoint['name']}_{key}"] = endpoint[key]
+        phase_stats = instrumentation.summary()
+        extra_metrics.update(instrumentation.metrics())
+        log_overall_stats(env, overall, extra_metrics)
+    instrumentation.close()
+    # 输出最终统计结果
+    print_overall_stats(overall)
+    if router_stats:
+        for endpoint in router_stats["endpoints"]:
+            print(f"   [ENDPOINT] {endpoint['name']}（{endpoint['model']}）：调用 {endpoint['calls']}，"
+                  f"失败 {endpoint['failures']}，p50 {endpoint['p50']:.2f}s，p95 {endpoint['p95']:.2f}s")
+        print(f"   [HEDGE] 对冲请求：{router_stats['hedged_calls']}")
+    if manifest:
+        print(f"   [INCREMENTAL] 沿用未变化函数：{manifest.carried_count}")
+    if deduplicator:
+        print(f"   [DEDUP] 复用结构等价函数的注释：{deduplicator.reused}")
+    if cache:
+        print(f"   [CACHE] 缓存命中：{cache_stats['hits']}，未命中：{cache_stats['misses']}")
+    if write_back_stats:
+        from docstring_writer import print_write_back_summary  # pylint: disable=import-outside-toplevel
+        print_write_back_summary(write_back_stats, write_back == "diff")
+    if phase_stats:
+        print("   [PHASES] 分阶段耗时：")
+        for line in format_summary(phase_stats):
+            print(line)
+    if instrumentation.tracer is not None:
+        print(f"   [TRACE] 追踪文件：{instrumentation.tracer.path}")
     print("=" * 60)
+    return overall
+
+
+def export_batch_requests(batch_path=None, *, source_root=None, include=None, exclude=None, default_excludes=True,
+                          max_requests=None):
+    """将每个函数导出为一行服务商批处理请求（JSONL），同时导出任务索引，返回请求文件路径列表"""
+    env = init_environment()
+    if not env:
+        print("\n[ERROR] 环境配置错误，请检查环境变量")
+        return None
+    sample_files = find_sample_files(source_root)
+    if sample_files is None:
+        return None
+    prompt_template = load_prompt_template()
+    writer = BatchRequestWriter(batch_path or DEFAULT_BATCH_PATH, max_requests)
+    try:
+        for task in iter_source_tasks(sample_files, source_root, include, exclude, default_excludes):
+            prompt, tokens = plan_function_prompt(task['code'], prompt_template, env)
+            writer.write(task, env, prompt, max_tokens=tokens["max_tokens"])
+    finally:
+        writer.close()
+    print(f"\n[EXPORT] 已导出 {writer.count} 个请求：{', '.join(writer.paths) or '-'}")
+    print(f"   [TASKS] 任务索引：{writer.index_path}")
+    return writer.paths
+
+
+def ingest_batch_results(result_paths, *, task_index_path=None, cache_path=None, manifest_path=None,
+                         results_dir=None):
+    """读取服务商批处理结果，按 custom_id 还原为函数记录并记录日志和统计，返回总体统计
+
+    批处理结果没有单次请求耗时，函数记录的 latency 记为 0；索引中没有对应结果的函数记为失败。
+    """
+    results_dir = results_dir or os.getenv("RESULTS_DIR")
+    env = init_environment()
+    if not env:
+        print("\n[ERROR] 环境配置错误，请检查环境变量")
+        return None
+    if cache_path:
+        env["cache_path"] = cache_path
+    tasks = load_task_index(task_index_path or default_task_index_path(DEFAULT_BATCH_PATH))
+    prompt_template = load_prompt_template()
+    cache = get_annotation_cache(env)
+    manifest = AnnotationManifest(manifest_path, compute_run_signature(env, prompt_template)) \
+        if manifest_path else None
+    records, unknown = {}, 0
+    with start_run(env, f"batch_ingest_{datetime.now().strftime('%Y%m%d_%H%M%S')}") as run_id:
+        log_params(env, {
+            "batch_start_time": datetime.now().isoformat(),
+            "model": env["model_name"],
+            "temperature": env["model_temperature"],
+            "mode": "provider_batch",
+            "batch_requests": len(tasks)
+        })
+        start_time = time.time()
+        tracker = BackgroundTracker.for_active_run() if run_id else None
+        sink = open_results_sink(results_dir, run_id, env["model_name"])
+        try:
+            for result_line in iter_batch_results(result_paths):
+                custom_id, content, error = parse_batch_result(result_line, env)
+                task = tasks.get(custom_id)
+                if task is None or custom_id in records:
+                    unknown += 1
+                    continue
+                result = build_comment_result(content, task['code'], 0.0) if error is None else error
+                records[custom_id] = record_result(task, result, env, tracker=tracker, manifest=manifest, sink=sink)
+                if cache and error is None:
+                    cache.put(build_cache_key(task['code'], env, prompt_template), content, result["metrics"])
+            missing = [custom_id for custom_id in tasks if custom_id not in records]
+            for custom_id in missing:
+                records[custom_id] = record_result(
+                    tasks[custom_id], "Missing from batch results", env, tracker=tracker, sink=sink
+                )
+            total_time = time.time() - start_time
+        finally:
+            close_tracker(tracker)
+            if sink is not None:
+                sink.close()
+        overall = compute_overall_stats(
+            summarize_records_by_file(records[custom_id] for custom_id in tasks), total_time
+        )
+        if manifest:
+            manifest.save()
+        log_overall_stats(env, overall, {"batch_missing": len(missing), "batch_unknown": unknown})
+    print_overall_stats(overall)
+    print(f"   [BATCH] 缺失结果：{len(missing)}，无法匹配的结果：{unknown}")
+    print("=" * 60)
+    return overall
+
+
+def enqueue_work(queue_path=None, *, source_root=None, include=None, exclude=None, default_excludes=True):
+    """将待注释的函数加入分片工作队列（已在队列中的函数跳过），返回新加入的数量"""
+    sample_files = find_sample_files(source_root)
+    if sample_files is None:
+        return None
+    queue = WorkQueue(queue_path or DEFAULT_QUEUE_PATH)
+    try:
+        added = queue.enqueue(iter_source_tasks(sample_files, source_root, include, exclude, default_excludes))
+        counts = queue.counts()
+    finally:
+        queue.close()
+    print(f"\n[QUEUE] 新加入 {added} 个函数，队列共 {counts['total']} 个（待处理 {counts['pending']}，"
+          f"已完成 {counts['done']}）：{queue.path}")
+    return added
+
+
+def run_queue_worker(queue_path=None, workers=None, *, worker_id=None, lease_size=None,
+                     lease_seconds=DEFAULT_LEASE_SECONDS, cache_path=None, dedup=None):
+    """分片工作进程：反复从队列租用一批函数、生成注释并写回函数记录，队列中没有可租用的任务时退出
+
+    可同时运行任意数量的工作进程（或共享卷的容器）。每批完成后立即写回，进程被杀时最多丢失在途的一批，
+    其租约过期后由其他工作进程重新处理。返回本进程完成的函数数量（环境错误时返回 None）。
+    """
+    if workers is None:
+        workers = int(os.getenv("BATCH_WORKERS", "1"))
+    env = init_environment()
+    if not env:
+        print("\n[ERROR] 环境配置错误，请检查环境变量")
+        return None
+    if cache_path:
+        env["cache_path"] = cache_path
+    if dedup is not None:
+        env["dedup"] = dedup
+    worker_id = worker_id or default_worker_id()
+    lease_size = lease_size or max(workers, env["pack_size"]) * 4
+    queue = WorkQueue(queue_path or DEFAULT_QUEUE_PATH, lease_seconds)
+    queue.register_worker(worker_id)
+    # 工作进程的分阶段耗时写回队列，由合并步骤汇总
+    instrumentation = reset_instrumentation()
+    deduplicator = FunctionDeduplicator() if env["dedup"] else None
+    completed = 0
+    with start_run(env, f"batch_worker_{worker_id}") as run_id:
+        log_params(env, {
+            "batch_start_time": datetime.now().isoformat(),
+            "model": env["model_name"],
+            "temperature": env["model_temperature"],
+            "workers": workers,
+            "worker_id": worker_id,
+            "queue_path": os.path.abspath(queue.path)
+        })
+        tracker = BackgroundTracker.for_active_run() if run_id else None
+        progress = create_progress_bar(None, f"工作进程 {worker_id}")
+        try:
+            while leased := queue.lease(worker_id, lease_size):
+                try:
+                    records = annotate_tasks([task for _, task in leased], env, workers, tracker=tracker,
+                                             progress=progress, dedup=deduplicator)
+                except BaseException:
+                    # 被中断或出错时立即归还整批任务，无需等待租约过期
+                    queue.release(worker_id, [task_id for task_id, _ in leased])
+                    raise
+                completed += queue.complete(worker_id, zip((task_id for task_id, _ in leased), records))
+        finally:
+            progress.close()
+            close_tracker(tracker)
+            queue.finish_worker(worker_id, completed, instrumentation.to_dict())
+            queue.close()
+            instrumentation.close()
+        log_metrics(env, {"worker_completed": completed})
+    print(f"\n[WORKER] {worker_id} 完成 {completed} 个函数")
+    return completed
+
+
+def merge_queue_results(queue_path=None, *, results_dir=None):
+    """合并分片工作队列中的函数记录，输出并记录与 batch_annotate 相同的总体统计，返回总体统计
+
+    租约多次过期而放弃的函数记为失败；尚未完成的函数不计入统计，并在输出中列出数量。
+    """
+    results_dir = results_dir or os.getenv("RESULTS_DIR")
+    env = init_environment()
+    if not env:
+        print("\n[ERROR] 环境配置错误，请检查环境变量")
+        return None
+    queue = WorkQueue(queue_path or DEFAULT_QUEUE_PATH)
+    try:
+        counts = queue.counts()
+        worker_phases = queue.worker_phases()
+        instrumentation = Instrumentation()
+        for phases in worker_phases:
+            instrumentation.merge(phases)
+        with start_run(env, f"batch_merge_{datetime.now().strftime('%Y%m%d_%H%M%S')}") as run_id:
+            log_params(env, {
+                "batch_start_time": datetime.now().isoformat(),
+                "model": env["model_name"],
+                "temperature": env["model_temperature"],
+                "mode": "sharded",
+                "queue_path": os.path.abspath(queue.path)
+            })
+            sink = open_results_sink(results_dir, run_id, env["model_name"])
+            records = []
+            try:
+                for task, record in queue.iter_done():
+                    if record is None:
+                        record = build_function_record(task['file'], task, "Worker lease expired repeatedly")
+                    records.append(record)
+                    if sink is not None:
+                        sink.write(record, task['code'])
+            finally:
+                if sink is not None:
+                    sink.close()
+            overall = compute_overall_stats(summarize_records_by_file(records), queue.time_span())
+            phase_stats = instrumentation.summary()
+            log_overall_stats(env, overall, {
+                "queue_pending": counts["pending"],
+                "queue_leased": counts["leased"],
+                "queue_workers": len(worker_phases),
+                **instrumentation.metrics()
+            })
+    finally:
+        queue.close()
+    print_overall_stats(overall)
+    print(f"   [QUEUE] 已完成：{counts['done']}，待处理：{counts['pending']}，处理中：{counts['leased']}")
+    if phase_stats:
+        print("   [PHASES] 分阶段耗时：")
+        for line in format_summary(phase_stats):
+            print(line)
+    print("=" * 60)
+    return overall
+
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="批量函数注释生成工具")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="并发请求数（默认读取 BATCH_WORKERS，未设置时为 1）")
+    parser.add_argument("--source", default=None,
+                        help="要注释的源码目录（默认处理 feedings/function_sample*.py）")
+    parser.add_argument("--include", action="append", default=None,
+                        help="扫描源码目录时包含的文件 glob，可多次指定（默认 *.py）")
+    parser.add_argument("--exclude", action="append", default=None,
+                        help="扫描源码目录时额外排除的文件或目录 glob，可多次指定（在默认排除的 .git、venv 等之外）")
+    parser.add_argument("--no-default-excludes", action="store_false", dest="default_excludes",
+                        help="不使用默认排除列表，只按 --exclude 排除")
+    parser.add_argument("--cache", nargs="?", const=DEFAULT_CACHE_PATH, default=None,
+                        help="启用注释缓存，可指定缓存文件路径（默认读取 ANNOTATION_CACHE_PATH）")
+    parser.add_argument("--results", nargs="?", const=DEFAULT_RESULTS_DIR, default=None,
+                        help="将函数记录写入 Parquet 结果数据集，可指定目录（默认读取 RESULTS_DIR）")
+    parser.add_argument("--incremental", nargs="?", const=DEFAULT_MANIFEST_PATH, default=None,
+                        help="增量模式：只注释新增或变化的函数，可指定指纹清单路径")
+    parser.add_argument("--pack-size", type=int, default=None,
+                        help="每个请求打包的函数数量上限（默认读取 PACK_SIZE，未设置时为 1 即不打包）")
+    parser.add_argument("--pack-tokens", type=int, default=None,
+                        help="每个打包请求中函数代码的估算token上限（默认读取 PACK_TOKENS）")
+    parser.add_argument("--dedup", action="store_true", default=None,
+                        help="结构等价（仅标识符不同）的函数只调用一次模型，复用并改写注释（默认读取 DEDUP_FUNCTIONS）")
+    parser.add_argument("--export-batch", nargs="?", const=DEFAULT_BATCH_PATH, default=None,
+                        help="不调用API，将每个函数导出为服务商批处理请求 JSONL（默认 outputs/batch_requests.jsonl）")
+    parser.add_argument("--batch-max-requests", type=int, default=None,
+                        help="每个批处理请求文件的请求数上限，超过时分片（默认 50000）")
+    parser.add_argument("--ingest-batch", nargs="+", default=None, metavar="RESULTS_JSONL",
+                        help="读取服务商批处理结果 JSONL，生成函数记录和统计")
+    parser.add_argument("--trace", default=None, metavar="TRACE_JSON",
+                        help="导出分阶段耗时的追踪事件文件（Chrome Trace 格式，默认读取 TRACE_PATH）")
+    parser.add_argument("--batch-tasks", default=None,
+                        help="导出时生成的任务索引路径（默认 outputs/batch_requests.tasks.jsonl）")
+    parser.add_argument("--write-back", action="store_const", const="apply", default=None,
+                        help="运行结束后将注释作为文档字符串写回源码（插入或替换，原子写入）")
+    parser.add_argument("--write-back-diff", action="store_const", const="diff", dest="write_back",
+                        help="同 --write-back，但只输出统一 diff，不修改文件")
+    parser.add_argument("--enqueue", nargs="?", const=DEFAULT_QUEUE_PATH, default=None, metavar="QUEUE",
+                        help="分片模式：将函数加入 SQLite 工作队列（默认 outputs/work_queue.sqlite3）")
+    parser.add_argument("--work", nargs="?", const=DEFAULT_QUEUE_PATH, default=None, metavar="QUEUE",
+                        help="分片模式：作为工作进程处理队列中的函数，可同时运行多个")
+    parser.add_argument("--merge", nargs="?", const=DEFAULT_QUEUE_PATH, default=None, metavar="QUEUE",
+                        help="分片模式：合并队列中的函数记录并输出总体统计")
+    parser.add_argument("--worker-id", default=None,
+                        help="工作进程标识（默认 主机名-进程号-随机后缀）")
+    parser.add_argument("--lease-size", type=int, default=None,
+                        help="工作进程每次租用的函数数量（默认并发数的 4 倍）")
+    parser.add_argument("--lease-seconds", type=float, default=DEFAULT_LEASE_SECONDS,
+                        help="租约时长（秒），超时未完成的函数由其他工作进程重新处理（默认 600）")
+    parser.add_argument("--replay-tracking", nargs="?", const="", default=None, metavar="FALLBACK_JSONL",
+                        help="将跟踪回退文件中的记录重新写入 MLflow（默认读取 TRACKING_FALLBACK_PATH）")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    batch_annotate()
+    args = parse_args()
+    if args.replay_tracking is not None:
+        replay_tracking(args.replay_tracking or None)
+    elif args.export_batch:
+        export_batch_requests(args.export_batch, source_root=args.source, include=args.include,
+                              exclude=args.exclude, default_excludes=args.default_excludes,
+                              max_requests=args.batch_max_requests)
+    elif args.enqueue:
+        enqueue_work(args.enqueue, source_root=args.source, include=args.include, exclude=args.exclude,
+                     default_excludes=args.default_excludes)
+    elif args.work:
+        run_queue_worker(args.work, args.workers, worker_id=args.worker_id, lease_size=args.lease_size,
+                         lease_seconds=args.lease_seconds, cache_path=args.cache, dedup=args.dedup)
+    elif args.merge:
+        merge_queue_results(args.merge, results_dir=args.results)
+    elif args.ingest_batch:
+        ingest_batch_results(args.ingest_batch, task_index_path=args.batch_tasks, cache_path=args.cache,
+                             manifest_path=args.incremental, results_dir=args.results)
+    else:
+        batch_annotate(workers=args.workers, cache_path=args.cache,
+                       pack_size=args.pack_size, pack_tokens=args.pack_tokens, manifest_path=args.incremental,
+                       source_root=args.source, include=args.include, exclude=args.exclude,
+                       default_excludes=args.default_excludes,
+                       results_dir=args.results, trace_path=args.trace, dedup=args.dedup,
+                       write_back=args.write_back)
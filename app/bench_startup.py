@@ -0,0 +1,69 @@
+"""冷启动耗时基准
+在独立子进程中多次测量解释器空载、交互式 main()、batch_annotate（空源码目录）和测试收集的启动耗时，
+输出最小值与中位数；默认以跟踪关闭（CI=1）的方式运行，与 Docker/CI 环境一致
+
+用法：
+    python app/bench_startup.py [--runs N] [--tracking]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def build_scenarios(empty_dir):
+    """返回 [(名称, 命令, 标准输入)]"""
+    return [
+        ("interpreter", [sys.executable, "-c", "pass"], None),
+        ("import func_annotator", [sys.executable, "-c", "import func_annotator"], None),
+        ("func_annotator main()", [sys.executable, os.path.join(APP_DIR, "func_annotator.py")], "END\n"),
+        ("batch_annotate (empty source)",
+         [sys.executable, os.path.join(APP_DIR, "batch_annotator.py"), "--source", empty_dir], None),
+        ("pytest --collect-only",
+         [sys.executable, "-m", "pytest", "--collect-only", "-q", os.path.join(APP_DIR, "test.py")], None),
+    ]
+
+
+def measure(command, stdin_text, env, runs):
+    """运行命令 runs 次，返回每次的墙钟耗时（秒）"""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, input=stdin_text, env=env, cwd=APP_DIR, text=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    """命令行入口：输出各场景的启动耗时"""
+    parser = argparse.ArgumentParser(description="冷启动耗时基准")
+    parser.add_argument("--runs", type=int, default=5, help="每个场景的运行次数")
+    parser.add_argument("--tracking", action="store_true", help="开启跟踪（不设置 CI），测量导入 mlflow/dagshub 的开销")
+    args = parser.parse_args()
+    env = {
+        **os.environ,
+        # 占位配置：只测量启动路径，空输入和空目录不会发出API请求
+        "API_KEY": os.getenv("API_KEY", "bench"),
+        "API_URL": os.getenv("API_URL", "http://127.0.0.1:9/v1/chat/completions"),
+        "MODEL_NAME": os.getenv("MODEL_NAME", "bench-model"),
+        "MODEL_TEMPERATURE": os.getenv("MODEL_TEMPERATURE", "0.3"),
+    }
+    if args.tracking:
+        env.pop("CI", None)
+    else:
+        env["CI"] = "1"
+    with tempfile.TemporaryDirectory() as empty_dir:
+        print(f"{'scenario':<32}{'min':>10}{'median':>10}")
+        for name, command, stdin_text in build_scenarios(empty_dir):
+            timings = measure(command, stdin_text, env, args.runs)
+            print(f"{name:<32}{min(timings):>9.3f}s{statistics.median(timings):>9.3f}s")
+
+
+if __name__ == "__main__":
+    main()
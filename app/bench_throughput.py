@@ -0,0 +1,193 @@
+"""吞吐量基准
+生成指定规模的合成函数语料，启动本地模拟模型服务，分别测量 generate_function_comment（单函数调用，
+非流式/流式）和 batch_annotate（整棵源码树，可打包）的吞吐量、p50/p95/p99 延迟和峰值内存；
+每个场景在独立子进程中运行，峰值内存互不影响。结果可保存为 JSON 并与上一次运行对比
+
+用法：
+    python app/bench_throughput.py [--functions 10000] [--calls 2000] [--workers 16] [--pack-size 8]
+                                   [--latency fixed:0.005] [--error-rate 0] [--rate-limit 0]
+                                   [--model glm-4-flash] [--output bench.json] [--baseline bench.json]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import percentiles
+from mock_llm_server import MockLLMServer
+
+SCENARIOS = ("generate_function_comment", "generate_function_comment_stream", "batch_annotate",
+             "batch_annotate_packed")
+FUNCTIONS_PER_FILE = 200
+
+
+def build_synthetic_function(index, rng):
+    """生成一个语法正确、内容各异的函数"""
+    params = [f"arg{j}" for j in range(rng.randint(0, 4))]
+    lines = [f"def synthetic_{index}({', '.join(params)}):"]
+    operands = params or ["1"]
+    for k in range(rng.randint(1, 8)):
+        expression = f" {rng.choice(['+', '-', '*'])} ".join(rng.choice(operands) for _ in range(2))
+        lines.append(f"    value_{k} = {expression} + {rng.randint(0, 99)}")
+    lines.append(f"    return value_{k}")
+    return "\n".join(lines) + "\n"
+
+
+def write_corpus(corpus_dir, count, seed=0):
+    """写入 count 个合成函数（每个文件 FUNCTIONS_PER_FILE 个）"""
+    rng = random.Random(seed)
+    for start in range(0, count, FUNCTIONS_PER_FILE):
+        functions = [build_synthetic_function(i, rng) for i in range(start, min(count, start + FUNCTIONS_PER_FILE))]
+        with open(os.path.join(corpus_dir, f"module_{start // FUNCTIONS_PER_FILE:05d}.py"), 'w',
+                  encoding='utf-8') as f:
+            f.write("\n\n".join(functions))
+
+
+def peak_rss_mb():
+    """当前进程的峰值常驻内存（MB）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_generate_scenario(corpus_dir, calls, workers, stream):
+    """并发调用 generate_function_comment，返回 (函数数, 成功数, 每次调用的墙钟延迟)"""
+    # pylint: disable=import-outside-toplevel
+    from func_annotator import generate_function_comment, init_environment
+    from repo_scanner import scan_repository
+    env = init_environment()
+    env["stream"] = stream
+    codes = [info['code'] for _, info in zip(range(calls), scan_repository(corpus_dir, workers=1))]
+
+    def timed_call(code):
+        start = time.perf_counter()
+        result = generate_function_comment(code, env)
+        return isinstance(result, dict), time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        outcomes = list(executor.map(timed_call, codes))
+    return len(codes), sum(ok for ok, _ in outcomes), [latency for _, latency in outcomes]
+
+
+def run_batch_scenario(corpus_dir, workers, pack_size):
+    """对整个语料运行 batch_annotate，延迟取结果数据集中记录的每个函数的请求耗时"""
+    # pylint: disable=import-outside-toplevel
+    from batch_annotator import batch_annotate
+    from results_store import load_results
+    with tempfile.TemporaryDirectory() as results_dir:
+        overall = batch_annotate(workers, pack_size=pack_size, source_root=corpus_dir, results_dir=results_dir)
+        latencies = load_results(results_dir, columns=["latency"], errors_only=False)["latency"].to_pylist()
+    return overall['total_functions'], overall['total_success'], latencies
+
+
+def run_scenario(name, args):
+    """在当前（子）进程中运行一个场景并返回结果字典"""
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if name.startswith("generate_function_comment"):
+            functions, successes, latencies = run_generate_scenario(
+                args.corpus, args.calls, args.workers, stream=name.endswith("_stream")
+            )
+        else:
+            functions, successes, latencies = run_batch_scenario(
+                args.corpus, args.workers, args.pack_size if name.endswith("_packed") else 1
+            )
+    seconds = time.perf_counter() - start
+    return {
+        "scenario": name,
+        "functions": functions,
+        "successes": successes,
+        "seconds": round(seconds, 3),
+        "throughput": round(functions / seconds, 2) if seconds > 0 else 0.0,
+        **percentiles(latencies, 4),
+        "peak_rss_mb": round(peak_rss_mb(), 1)
+    }
+
+
+def print_results(results, baseline=None):
+    """输出结果表；提供基准结果时附加吞吐量和 p95 的变化"""
+    baseline = {row["scenario"]: row for row in baseline or []}
+    header = f"{'scenario':<34}{'functions':>10}{'seconds':>10}{'fn/s':>10}{'p50':>9}{'p95':>9}{'p99':>9}{'rss MB':>9}"
+    print(header + ("   vs baseline" if baseline else ""))
+    for row in results:
+        line = (f"{row['scenario']:<34}{row['functions']:>10}{row['seconds']:>10.2f}{row['throughput']:>10.1f}"
+                f"{row['p50']:>9.4f}{row['p95']:>9.4f}{row['p99']:>9.4f}{row['peak_rss_mb']:>9.1f}")
+        previous = baseline.get(row["scenario"])
+        if previous and previous["throughput"] and previous["p95"]:
+            line += (f"   fn/s {row['throughput'] / previous['throughput'] - 1:+.1%}"
+                     f", p95 {row['p95'] / previous['p95'] - 1:+.1%}")
+        print(line)
+
+
+def parse_args():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="注释流程吞吐量基准（使用本地模拟模型服务）")
+    parser.add_argument("--functions", type=int, default=10000, help="合成语料的函数数量")
+    parser.add_argument("--calls", type=int, default=2000, help="generate_function_comment 场景的调用次数")
+    parser.add_argument("--workers", type=int, default=16, help="并发请求数")
+    parser.add_argument("--pack-size", type=int, default=8, help="打包场景每个请求的函数数量")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=SCENARIOS, help="要运行的场景")
+    parser.add_argument("--model", default="glm-4-flash", help="模型名（以 qwen 开头时使用 Qwen 响应格式）")
+    parser.add_argument("--latency", default="fixed:0.005", help="模拟服务的延迟分布，例如 lognormal:-4,0.5")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟服务返回 500 的比例")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="模拟服务返回 429 的比例")
+    parser.add_argument("--seed", type=int, default=0, help="语料和模拟服务的随机种子")
+    parser.add_argument("--output", default=None, help="将结果保存为 JSON 文件")
+    parser.add_argument("--baseline", default=None, help="与之前保存的 JSON 结果对比")
+    parser.add_argument("--scenario", default=None, help=argparse.SUPPRESS)  # 子进程内部使用
+    parser.add_argument("--corpus", default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    """命令行入口：生成语料、启动模拟服务并逐个场景运行"""
+    args = parse_args()
+    if args.scenario:
+        print(json.dumps(run_scenario(args.scenario, args)))
+        return
+    results = []
+    with tempfile.TemporaryDirectory() as corpus_dir, \
+            MockLLMServer(latency=args.latency, error_rate=args.error_rate, rate_limit_rate=args.rate_limit,
+                          seed=args.seed) as server:
+        write_corpus(corpus_dir, args.functions, args.seed)
+        child_env = {
+            **os.environ,
+            "API_URL": server.url,
+            "API_KEY": "mock",
+            "MODEL_NAME": args.model,
+            "MODEL_TEMPERATURE": "0.3",
+            "CI": "1",  # 关闭实验跟踪
+            "API_POOL_SIZE": str(args.workers),
+            "API_BACKOFF_BASE": os.getenv("API_BACKOFF_BASE", "0.05")
+        }
+        for name in ("ANNOTATION_CACHE_PATH", "RESULTS_DIR", "PACK_SIZE", "PACK_TOKENS", "API_STREAM"):
+            child_env.pop(name, None)
+        for name in args.scenarios:
+            command = [sys.executable, os.path.abspath(__file__), "--scenario", name, "--corpus", corpus_dir,
+                       "--calls", str(args.calls), "--workers", str(args.workers), "--pack-size", str(args.pack_size)]
+            completed = subprocess.run(command, env=child_env, capture_output=True, text=True, check=False)
+            if completed.returncode != 0:
+                print(f"[ERROR] 场景 {name} 运行失败：\n{completed.stderr[-2000:]}")
+                continue
+            results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+        print(f"[MOCK] 模拟服务统计：{server.stats}")
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"args": {k: v for k, v in vars(args).items() if k not in ("scenario", "corpus")},
+                       "results": results}, f, ensure_ascii=False, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""结构去重
+函数在重命名局部标识符（函数名、参数、局部变量）并去掉文档字符串后 AST 相同，即视为结构等价（alpha 等价）。
+批处理中每组等价函数只调用一次模型，代表函数的注释按名称对应关系替换后复用给组内其他函数，并按各自的代码重新计算指标
+"""
+import ast
+import hashlib
+import re
+import textwrap
+from func_annotator import build_comment_result
+
+# 注释正文中也常作为普通单词出现的名称：代表函数的这些名称与成员不同时无法安全替换，成员单独调用模型
+AMBIGUOUS_NAMES = frozenset({
+    "a", "an", "and", "as", "at", "be", "by", "count", "data", "do", "for", "if", "in", "index", "input", "is",
+    "it", "item", "items", "key", "list", "name", "no", "number", "numbers", "of", "on", "or", "output", "result",
+    "return", "string", "sum", "text", "the", "to", "total", "value", "values"
+})
+_PENDING = object()
+
+
+def _strip_docstring(node):
+    body = node.body
+    if body and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant) \
+            and isinstance(body[0].value.value, str):
+        node.body = body[1:] or [ast.Pass()]
+
+
+def _collect_local_names(function_node):
+    """函数内绑定的名称（函数名、参数、赋值目标、嵌套定义、异常变量），不含 global/nonlocal 声明的名称"""
+    names = {function_node.name}
+    declared_outer = set()
+    for node in ast.walk(function_node):
+        if isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            declared_outer.update(node.names)
+    return names - declared_outer
+
+
+class _Canonicalizer(ast.NodeTransformer):
+    """按首次出现的顺序把局部名称替换为 _v0、_v1……，并去掉所有文档字符串"""
+
+    def __init__(self, local_names):
+        self.local_names = local_names
+        self.mapping = {}  # 原名称 -> 规范名称（保持首次出现顺序）
+
+    def _rename(self, name):
+        if name not in self.mapping:
+            self.mapping[name] = f"_v{len(self.mapping)}"
+        return self.mapping[name]
+
+    def visit_FunctionDef(self, node):  # pylint: disable=invalid-name
+        node.name = self._rename(node.name)
+        _strip_docstring(node)
+        self.generic_visit(node)
+        return node
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_ClassDef(self, node):  # pylint: disable=invalid-name
+        node.name = self._rename(node.name)
+        _strip_docstring(node)
+        self.generic_visit(node)
+        return node
+
+    def visit_arg(self, node):
+        node.arg = self._rename(node.arg)
+        self.generic_visit(node)
+        return node
+
+    def visit_Name(self, node):  # pylint: disable=invalid-name
+        if node.id in self.local_names:
+            node.id = self._rename(node.id)
+        return node
+
+    def visit_ExceptHandler(self, node):  # pylint: disable=invalid-name
+        if node.name:
+            node.name = self._rename(node.name)
+        self.generic_visit(node)
+        return node
+
+
+def canonicalize_function(function_code):
+    """返回 (结构键, 按规范顺序排列的原名称)；无法解析为单个函数定义时返回 (None, None)
+
+    结构键相同的两个函数互为 alpha 等价，名称列表按位置一一对应。全局名称、属性名和常量保持不变。
+    """
+    try:
+        module = ast.parse(textwrap.dedent(function_code))
+    except SyntaxError:
+        return None, None
+    if len(module.body) != 1 or not isinstance(module.body[0], (ast.FunctionDef, ast.AsyncFunctionDef)):
+        return None, None
+    function_node = module.body[0]
+    canonicalizer = _Canonicalizer(_collect_local_names(function_node))
+    canonical = canonicalizer.visit(function_node)
+    key = hashlib.sha256(ast.dump(canonical, include_attributes=False).encode('utf-8')).hexdigest()
+    return key, tuple(canonicalizer.mapping)
+
+
+def can_rename(source_names, target_names):
+    """代表函数中与成员不同的名称都不是常见单词时，才能在注释正文中安全替换"""
+    return all(s == t or (len(s) > 1 and s.lower() not in AMBIGUOUS_NAMES) for s, t in zip(source_names, target_names))
+
+
+def rename_in_text(text, source_names, target_names):
+    """将注释正文中的代表函数名称整词替换为成员函数的对应名称（一次替换完成，名称互换也正确）"""
+    mapping = {s: t for s, t in zip(source_names, target_names) if s != t}
+    if not mapping:
+        return text
+    alternatives = "|".join(re.escape(name) for name in sorted(mapping, key=len, reverse=True))
+    return re.sub(rf'(?<!\w)({alternatives})(?!\w)', lambda match: mapping[match.group(1)], text)
+
+
+class _Group:
+    """一组结构等价的函数：代表函数的名称、结果及等待结果的成员"""
+
+    def __init__(self, names):
+        self.names = names
+        self.result = _PENDING
+        self.followers = []  # (任务序号, 任务, 名称)
+
+
+class FunctionDeduplicator:
+    """在批处理中按结构等价分组：每组第一个函数作为代表调用模型，其余成员复用代表的注释
+
+    同一个对象可跨多个文件使用；assign/complete 只在批处理主线程中调用，
+    代表函数以其在本次 annotate_tasks 任务列表中的序号登记，并在同一次调用内完成。
+    """
+
+    def __init__(self):
+        self._groups = {}
+        self._representatives = {}  # 代表任务在本次 annotate_tasks 任务列表中的序号 -> 组
+        self.reused = 0
+
+    def assign(self, index, task):
+        """登记一个任务：需要调用模型时返回 None；作为成员时返回可立即复用结果的成员列表
+
+        代表函数尚未完成时成员进入等待，返回空列表，代表完成后由 complete 返回。
+        """
+        key, names = canonicalize_function(task['code'])
+        if key is None:
+            return None
+        group = self._groups.get(key)
+        if group is not None and not can_rename(group.names, names):
+            # 名称无法安全替换时，只与名称完全相同的函数合并
+            key = (key, names)
+            group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = _Group(names)
+            self._representatives[index] = group
+            return None
+        if group.result is _PENDING:
+            group.followers.append((index, task, names))
+            return []
+        return [(index, task, names, group)]
+
+    def complete(self, index, result):
+        """序号为 index 的代表函数完成，返回等待其结果的成员列表 [(任务序号, 任务, 名称, 组)]"""
+        group = self._representatives.pop(index, None)
+        if group is None:
+            return []
+        group.result = result
+        followers, group.followers = group.followers, []
+        return [(*follower, group) for follower in followers]
+
+    def derive(self, group, task, names):
+        """由代表的结果生成成员的结果：代表失败时返回 None（成员需单独调用模型）
+
+        成员沿用代表的延迟和首字耗时，使延迟统计反映生成这条注释的实际耗时，而不是被计为 0 拉低平均值。
+        """
+        if not isinstance(group.result, dict):
+            return None
+        comment = group.result["comment"]
+        content = comment[len('"""\n'):-len('\n"""')] if comment.startswith('"""\n') else comment
+        metrics = group.result["metrics"]
+        result = build_comment_result(rename_in_text(content, group.names, names), task['code'], metrics["latency"],
+                                      ttft=metrics.get("ttft"))
+        result["metrics"]["dedup"] = True
+        self.reused += 1
+        return result
@@ -0,0 +1,316 @@
+"""文档字符串回写
+将注释结果写回源码：按 extract_functions_from_file 的行范围定位函数，插入或替换其文档字符串
+（按函数体的缩进重排注释正文，已有的文档字符串整体替换），每个文件只读写一次。
+注释与函数按限定名和结构（忽略文档字符串和位置）匹配，源码在注释后被修改的函数不会写入；
+文件在进程池中并行处理，先写临时文件再原子替换；dry-run 时只输出统一 diff，不修改文件
+
+用法：
+    python app/docstring_writer.py SOURCE_DIR [--path DIR] [--run-id ID] [--file GLOB] [--workers N] [--dry-run]
+"""
+import argparse
+import ast
+import difflib
+import os
+import shutil
+import sys
+import tempfile
+import textwrap
+from concurrent.futures import ProcessPoolExecutor
+from repo_scanner import extract_functions_from_source
+
+FUNCTION_NODES = (ast.FunctionDef, ast.AsyncFunctionDef)
+DEFINITION_NODES = (*FUNCTION_NODES, ast.ClassDef)
+SUMMARY_KEYS = ("files", "changed_files", "written", "unchanged", "unmatched", "skipped", "errors")
+
+
+def _is_docstring(statement):
+    return isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Constant) \
+        and isinstance(statement.value.value, str)
+
+
+def format_docstring(comment, indent, newline="\n"):
+    """将注释（可带首尾三引号行）格式化为按 indent 缩进的文档字符串行（含换行符）"""
+    text = comment.strip()
+    if text.startswith('"""') and text.endswith('"""') and len(text) >= 6:
+        text = text[3:-3]
+    text = textwrap.dedent(text.strip("\n")).strip()
+    text = text.replace("\\", "\\\\").replace('"""', '\\"\\"\\"')
+    lines = ['"""'] + text.splitlines() + ['"""']
+    return [(indent + line if line.strip() else "") + newline for line in lines]
+
+
+def _dump_without_docstrings(node):
+    """AST 的嵌套元组表示（不含位置信息），跳过函数和类的文档字符串；不复制 AST"""
+    if isinstance(node, list):
+        return tuple(_dump_without_docstrings(item) for item in node)
+    if not isinstance(node, ast.AST):
+        return node
+    fields = []
+    for name, value in ast.iter_fields(node):
+        if name == "body" and isinstance(node, DEFINITION_NODES) and value and _is_docstring(value[0]):
+            value = value[1:]
+        fields.append(_dump_without_docstrings(value))
+    return (type(node).__name__, *fields)
+
+
+def structure_key(node):
+    """函数结构的比较键：忽略位置信息、函数自身的装饰器（提取的函数代码不含装饰器）以及所有文档字符串，
+    写回后仍能与原注释匹配
+    """
+    key = _dump_without_docstrings(node)
+    position = 1 + node._fields.index("decorator_list")
+    return key[:position] + ((),) + key[position + 1:]
+
+
+def code_structure_key(function_code):
+    """注释时的函数代码的结构键；无法解析为单个函数定义时返回 None"""
+    try:
+        module = ast.parse(function_code)
+    except SyntaxError:
+        return None
+    if len(module.body) != 1 or not isinstance(module.body[0], FUNCTION_NODES):
+        return None
+    return structure_key(module.body[0])
+
+
+def _leading_text(line, col_offset):
+    """行内 col_offset（UTF-8 字节偏移）之前的文本"""
+    return line.encode('utf-8')[:col_offset].decode('utf-8', errors='replace')
+
+
+def _trailing_text(line, col_offset):
+    """行内 col_offset（UTF-8 字节偏移）之后的文本"""
+    return line.encode('utf-8')[col_offset:].decode('utf-8', errors='replace')
+
+
+def _is_blank_or_comment(line):
+    stripped = line.strip()
+    return not stripped or stripped.startswith('#')
+
+
+def docstring_edit(node, lines, comment, newline="\n"):
+    """计算为函数写入文档字符串的编辑 (起始行下标, 结束行下标, 新行列表)
+
+    已有文档字符串时替换其所在的行；没有时插入在函数头（含多行签名及其后的注释行）之后。
+    函数体与 def 写在同一行、或文档字符串与其他语句共用一行时无法安全改写，返回 None。
+    """
+    first = node.body[0]
+    decorators = getattr(first, "decorator_list", [])
+    first_line = min([first.lineno] + [decorator.lineno for decorator in decorators])
+    if not decorators and _leading_text(lines[first.lineno - 1], first.col_offset).strip():
+        return None
+    line = lines[first_line - 1]
+    new_lines = format_docstring(comment, line[:len(line) - len(line.lstrip())], newline)
+    if _is_docstring(first):
+        if _trailing_text(lines[first.end_lineno - 1], first.end_col_offset).strip():
+            return None
+        return first.lineno - 1, first.end_lineno, new_lines
+    insert_at = first_line - 1
+    while insert_at - 1 >= node.lineno and _is_blank_or_comment(lines[insert_at - 1]):
+        insert_at -= 1
+    return insert_at, insert_at, new_lines
+
+
+def match_annotations(functions, nodes, annotations):
+    """按限定名和函数代码为文件中的函数匹配注释，返回 ([(函数节点, 注释)], 未匹配的函数数)
+
+    annotations 为 [(限定名, 行号, 函数代码, 注释)]，同一函数有多条注释时优先取行号相同的，否则取最后一条。
+    代码文本相同时直接匹配，不同时（例如已写回过文档字符串）再比较结构键。
+    """
+    by_name = {}
+    for annotation in annotations:
+        by_name.setdefault(annotation[0], []).append(annotation)
+    keys = {}  # 注释 id -> 注释时代码的结构键
+    matched, used = [], set()
+    for func_info in functions:
+        candidates = by_name.get(func_info['qualname'])
+        if not candidates:
+            continue
+        node = nodes[func_info['line']]
+        same = [a for a in candidates if a[2] == func_info['code']]
+        if not same:
+            key = structure_key(node)
+            same = [a for a in candidates if keys.setdefault(id(a), code_structure_key(a[2])) == key]
+        if not same:
+            continue
+        chosen = next((a for a in reversed(same) if a[1] == func_info['line']), same[-1])
+        used.update(id(a) for a in same)
+        matched.append((node, chosen[3]))
+    unmatched = sum(1 for items in by_name.values() if not any(id(a) in used for a in items))
+    return matched, unmatched
+
+
+def _atomic_write(file_path, content):
+    """先写入同目录的临时文件，再原子替换原文件（保留文件权限）"""
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".docstrings-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            f.write(content)
+        shutil.copymode(file_path, tmp_path)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_back_file(file_path, annotations, dry_run=False, label=None):
+    """为单个文件写回文档字符串（读写各一次），返回该文件的统计，dry_run 时附带统一 diff 而不修改文件"""
+    label = label or os.path.basename(file_path)
+    result = {"file": label, "written": 0, "unchanged": 0, "unmatched": 0, "skipped": 0, "error": None, "diff": None}
+    try:
+        with open(file_path, 'r', encoding='utf-8', newline='') as f:
+            content = f.read()
+        tree = ast.parse(content)
+        functions = extract_functions_from_source(content, tree, fingerprints=False)
+    except (OSError, SyntaxError, UnicodeDecodeError, ValueError) as e:
+        result["error"] = str(e)
+        result["unmatched"] = len({annotation[0] for annotation in annotations})
+        return result
+    nodes = {node.lineno: node for node in ast.walk(tree) if isinstance(node, FUNCTION_NODES)}
+    lines = content.splitlines(keepends=True)
+    newline = "\r\n" if lines and lines[0].endswith("\r\n") else "\n"
+    matched, result["unmatched"] = match_annotations(functions, nodes, annotations)
+    edits = []
+    for node, comment in matched:
+        edit = docstring_edit(node, lines, comment, newline)
+        if edit is None:
+            result["skipped"] += 1
+        elif lines[edit[0]:edit[1]] == edit[2]:
+            result["unchanged"] += 1
+        else:
+            edits.append(edit)
+    # 从文件末尾向前应用，前面函数的行号不受影响（嵌套函数的编辑位置互不重叠）
+    new_lines = list(lines)
+    for start, end, replacement in sorted(edits, key=lambda edit: edit[0], reverse=True):
+        new_lines[start:end] = replacement
+    result["written"] = len(edits)
+    if not edits:
+        return result
+    if dry_run:
+        result["diff"] = "".join(difflib.unified_diff(lines, new_lines, f"a/{label}", f"b/{label}"))
+    else:
+        _atomic_write(file_path, "".join(new_lines))
+    return result
+
+
+def _write_back_job(job):
+    return write_back_file(*job)
+
+
+def group_annotations(records):
+    """将成功的函数记录（含 code）按文件分组为 {文件: [(限定名, 行号, 函数代码, 注释)]}"""
+    grouped = {}
+    for record in records:
+        if record.get('success') and record.get('comment') and record.get('code'):
+            grouped.setdefault(record['file'], []).append(
+                (record['function_name'], record.get('line'), record['code'], record['comment'])
+            )
+    return grouped
+
+
+def iter_write_back(source_root, records, *, workers=None, dry_run=False):
+    """按文件写回文档字符串，逐个产出各文件的统计
+
+    records 中的 file 为相对 source_root 的路径；workers > 1 时在进程池中并行处理文件，
+    workers 默认取 CPU 核数。指向 source_root 之外的记录不处理。
+    """
+    root = os.path.abspath(source_root)
+    jobs = []
+    for label, annotations in group_annotations(records).items():
+        file_path = os.path.abspath(os.path.join(root, label))
+        if os.path.commonpath([root, file_path]) != root:
+            yield {"file": label, "written": 0, "unchanged": 0, "unmatched": len({a[0] for a in annotations}),
+                   "skipped": 0, "error": "outside source root", "diff": None}
+            continue
+        jobs.append((file_path, annotations, dry_run, label))
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        yield from map(_write_back_job, jobs)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(_write_back_job, jobs, chunksize=max(1, len(jobs) // (workers * 8)))
+
+
+def write_back_docstrings(source_root, records, *, workers=None, dry_run=False, diff_output=None):
+    """写回所有文件的文档字符串，dry_run 时把 diff 写入 diff_output（默认标准输出），返回汇总统计"""
+    summary = dict.fromkeys(SUMMARY_KEYS, 0)
+    diff_output = diff_output or sys.stdout
+    for result in iter_write_back(source_root, records, workers=workers, dry_run=dry_run):
+        summary["files"] += 1
+        summary["changed_files"] += bool(result["written"])
+        summary["errors"] += bool(result["error"])
+        for key in ("written", "unchanged", "unmatched", "skipped"):
+            summary[key] += result[key]
+        if result["error"]:
+            print(f"[ERROR] 写回 {result['file']} 时出错: {result['error']}")
+        if result["diff"]:
+            diff_output.write(result["diff"])
+    return summary
+
+
+def print_write_back_summary(summary, dry_run=False):
+    """输出写回统计行"""
+    action = "将写入" if dry_run else "已写入"
+    print(f"   [WRITE_BACK] {action} {summary['written']} 个函数的文档字符串（{summary['changed_files']} 个文件），"
+          f"无变化 {summary['unchanged']}，未匹配 {summary['unmatched']}，无法改写 {summary['skipped']}，"
+          f"出错文件 {summary['errors']}")
+
+
+class DocstringCollector:
+    """批处理结果输出的包装：收集成功的函数记录（含代码）用于写回，并转发给内部输出（如 ResultsWriter）"""
+
+    def __init__(self, inner=None):
+        self.inner = inner
+        self.records = []
+
+    def write(self, record, code=None):
+        """收集一条函数记录并转发"""
+        if record.get('success'):
+            self.records.append({**record, 'code': code})
+        if self.inner is not None:
+            self.inner.write(record, code)
+
+    def close(self):
+        """关闭内部输出"""
+        if self.inner is not None:
+            self.inner.close()
+
+
+def load_annotation_records(dataset_dir=None, run_id=None, file_pattern=None):
+    """从结果数据集读取成功的函数记录（按时间排序，同一函数以较新的注释为准），dataset_dir 默认为结果数据集目录"""
+    # pyarrow 导入开销大，仅从结果数据集写回时加载（批处理写回直接使用内存中的记录）
+    import pyarrow.compute as pc  # pylint: disable=import-outside-toplevel
+    from results_store import DEFAULT_RESULTS_DIR, load_results  # pylint: disable=import-outside-toplevel
+    table = load_results(dataset_dir or DEFAULT_RESULTS_DIR, columns=["run_id", "timestamp", "file", "function_name",
+                                                                      "line", "code", "comment", "success"],
+                         file_pattern=file_pattern)
+    table = table.filter(table["success"])
+    if run_id:
+        table = table.filter(pc.equal(table["run_id"], run_id))
+    return table.sort_by("timestamp").to_pylist()
+
+
+def main():
+    """命令行入口：将结果数据集中的注释写回源码目录"""
+    parser = argparse.ArgumentParser(description="将注释结果作为文档字符串写回源码")
+    parser.add_argument("source", help="源码目录（结果中的文件路径相对于该目录）")
+    parser.add_argument("--path", default=None, help="结果数据集目录（默认 outputs/annotations）")
+    parser.add_argument("--run-id", default=None, help="只使用指定运行的结果（默认所有运行，较新的优先）")
+    parser.add_argument("--file", default=None, help="文件 glob 过滤，例如 'pkg/*'")
+    parser.add_argument("--workers", type=int, default=None, help="并行处理文件的进程数（默认 CPU 核数）")
+    parser.add_argument("--dry-run", action="store_true", help="只输出统一 diff，不修改文件")
+    args = parser.parse_args()
+    if args.path and not os.path.isdir(args.path):
+        print(f"[ERROR] 结果数据集不存在: {args.path}")
+        return
+    if not os.path.isdir(args.source):
+        print(f"[ERROR] 源码目录不存在: {args.source}")
+        return
+    records = load_annotation_records(args.path, args.run_id, args.file)
+    summary = write_back_docstrings(args.source, records, workers=args.workers, dry_run=args.dry_run)
+    print_write_back_summary(summary, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
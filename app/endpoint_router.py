@@ -0,0 +1,215 @@
+"""多端点路由
+维护一组模型端点（API_URL/API_KEY/MODEL_NAME 各不相同，可混用 qwen、glm 和 OpenAI 兼容格式），
+记录每个端点的延迟（EWMA 和最近窗口）与错误情况，每次调用发往当前最快的健康端点；
+连续失败的端点暂时摘除，冷却后再尝试。可选对冲：主请求超过该端点的延迟分位数仍未返回时，
+向次优端点发送一份相同请求，先成功返回的结果生效
+
+端点配置（API_ENDPOINTS，JSON 列表或 JSON 文件路径）：
+    [{"name": "glm", "api_url": "...", "api_key_env": "GLM_API_KEY", "model_name": "glm-4-flash"},
+     {"name": "qwen", "api_url": "...", "api_key": "...", "model_name": "qwen-plus", "model_temperature": "0.3"}]
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from instrumentation import percentile
+
+ENDPOINT_FIELDS = ("api_url", "api_key", "model_name", "model_temperature")
+LATENCY_WINDOW = 200
+FAILURE_LATENCY_FACTOR = 2.0  # 失败按当前延迟的倍数计入 EWMA，使失败的端点排名后移
+FAILURE_LATENCY_FLOOR = 1.0  # 失败计入的最小延迟（秒），快速失败的端点不会因此显得更快
+
+
+def load_endpoints(defaults):
+    """读取 API_ENDPOINTS 配置，缺省字段取 defaults（主端点配置）；未配置时返回空列表"""
+    raw = os.getenv("API_ENDPOINTS", "").strip()
+    if not raw:
+        return []
+    if not raw.startswith("["):
+        with open(raw, 'r', encoding='utf-8') as f:
+            raw = f.read()
+    endpoints = []
+    for number, entry in enumerate(json.loads(raw), start=1):
+        endpoint = {field: entry.get(field) or defaults.get(field) for field in ENDPOINT_FIELDS}
+        if entry.get("api_key_env"):
+            endpoint["api_key"] = os.getenv(entry["api_key_env"])
+        endpoint["name"] = entry.get("name") or f"{endpoint['model_name']}#{number}"
+        endpoints.append(endpoint)
+    return endpoints
+
+
+class EndpointState:
+    """单个端点的配置及健康统计"""
+
+    def __init__(self, config, alpha=0.2):
+        self.name = config["name"]
+        self.config = {field: config[field] for field in ENDPOINT_FIELDS}
+        self.alpha = alpha
+        self.ewma_latency = None
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+        self.hedges_won = 0
+
+    def healthy(self, now):
+        """未处于冷却期即为健康"""
+        return now >= self.cooldown_until
+
+    def _update_ewma(self, latency):
+        self.ewma_latency = latency if self.ewma_latency is None \
+            else self.alpha * latency + (1 - self.alpha) * self.ewma_latency
+
+    def record(self, latency, success, *, failure_threshold, cooldown):
+        """记录一次调用结果；失败按惩罚延迟计入 EWMA（不计入延迟窗口），连续失败达到阈值时进入冷却期"""
+        self.calls += 1
+        if success:
+            self.consecutive_failures = 0
+            self.latencies.append(latency)
+            self._update_ewma(latency)
+            return
+        self._update_ewma(max(latency, self.ewma_latency or 0.0, FAILURE_LATENCY_FLOOR) * FAILURE_LATENCY_FACTOR)
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= failure_threshold:
+            self.cooldown_until = time.time() + cooldown
+
+    def stats(self):
+        """端点统计"""
+        return {
+            "name": self.name,
+            "model": self.config["model_name"],
+            "calls": self.calls,
+            "failures": self.failures,
+            "ewma_latency": round(self.ewma_latency or 0.0, 4),
+            "p50": round(percentile(self.latencies, 50), 4),
+            "p95": round(percentile(self.latencies, 95), 4),
+            "hedges_won": self.hedges_won,
+            "healthy": self.healthy(time.time())
+        }
+
+
+class EndpointRouter:
+    """按健康状况和延迟选择端点，支持失败转移和对冲请求"""
+
+    def __init__(self, endpoints, *, hedge=False, hedge_percentile=95, hedge_min_samples=20,
+                 failure_threshold=3, cooldown=30.0, max_threads=32):
+        self.states = [EndpointState(endpoint) for endpoint in endpoints]
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.hedged_calls = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix="hedge") if hedge else None
+
+    @classmethod
+    def from_environment(cls, environment):
+        """根据 API_ENDPOINTS 及对冲相关环境变量创建路由器；端点少于 2 个时返回 None"""
+        endpoints = load_endpoints(environment)
+        primary = {field: environment.get(field) for field in ENDPOINT_FIELDS}
+        if all(primary[field] for field in ("api_url", "api_key", "model_name")) and not any(
+                (e["api_url"], e["model_name"]) == (primary["api_url"], primary["model_name"]) for e in endpoints):
+            endpoints.insert(0, {**primary, "name": "primary"})
+        if len(endpoints) < 2:
+            return None
+        return cls(
+            endpoints,
+            hedge=os.getenv("API_HEDGE", "").lower() in ("1", "true"),
+            hedge_percentile=float(os.getenv("API_HEDGE_PERCENTILE", "95")),
+            failure_threshold=int(os.getenv("API_FAILURE_THRESHOLD", "3")),
+            cooldown=float(os.getenv("API_COOLDOWN", "30"))
+        )
+
+    def select(self, exclude=()):
+        """选择当前 EWMA 延迟最低的健康端点（从未调用过的端点优先探测一次）；全部不健康时选冷却最早结束的端点"""
+        now = time.time()
+        with self._lock:
+            candidates = [s for s in self.states if s not in exclude]
+            if not candidates:
+                return None
+            healthy = [s for s in candidates if s.healthy(now)]
+            if not healthy:
+                return min(candidates, key=lambda s: s.cooldown_until)
+            return min(healthy, key=lambda s: (s.ewma_latency is not None, s.ewma_latency or 0.0, s.in_flight))
+
+    def _attempt(self, state, call, is_success, environment):
+        """在指定端点上执行一次调用，返回 (结果, 是否成功)"""
+        with self._lock:
+            state.in_flight += 1
+        start = time.perf_counter()
+        try:
+            result = call({**environment, **state.config, "router": None, "endpoint": state.name})
+        finally:
+            latency = time.perf_counter() - start
+            with self._lock:
+                state.in_flight -= 1
+        success = is_success(result)
+        with self._lock:
+            state.record(latency, success, failure_threshold=self.failure_threshold, cooldown=self.cooldown)
+        return result, success
+
+    def _hedge_deadline(self, state):
+        """端点延迟的对冲阈值（样本不足时不对冲）"""
+        with self._lock:
+            if len(state.latencies) < self.hedge_min_samples:
+                return None
+            return percentile(state.latencies, self.hedge_percentile)
+
+    def _attempt_hedged(self, state, call, is_success, environment, tried):
+        """发出主请求，超过阈值仍未返回时向次优端点发出对冲请求，返回先成功的结果"""
+        deadline = self._hedge_deadline(state)
+        if deadline is None:
+            return self._attempt(state, call, is_success, environment)
+        primary = self._executor.submit(self._attempt, state, call, is_success, environment)
+        done, _ = wait([primary], timeout=deadline)
+        backup_state = None if done else self.select(exclude=tried)
+        if backup_state is None:
+            return primary.result()
+        tried.append(backup_state)
+        with self._lock:
+            self.hedged_calls += 1
+        pending = {primary: state, self._executor.submit(self._attempt, backup_state, call, is_success, environment):
+                   backup_state}
+        outcome = None
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                winner = pending.pop(future)
+                outcome = future.result()
+                if outcome[1]:
+                    if winner is backup_state:
+                        with self._lock:
+                            backup_state.hedges_won += 1
+                    return outcome  # 另一个请求在后台完成，只更新端点统计
+        return outcome
+
+    def call(self, call, is_success, environment, hedge=True, can_fail_over=None):
+        """路由一次调用：call(端点环境) -> 结果，is_success(结果) 判断成功与否
+
+        失败时依次转移到其他端点（每个端点最多尝试一次），全部失败时返回最后一次的结果。
+        传入 can_fail_over 时每次失败后先调用它，返回 False 则不再转移，直接返回本次结果。
+        """
+        tried = []
+        result = None
+        while True:
+            state = self.select(exclude=tried)
+            if state is None:
+                return result
+            tried.append(state)
+            if self.hedge and hedge and len(self.states) > 1:
+                result, success = self._attempt_hedged(state, call, is_success, environment, tried)
+            else:
+                result, success = self._attempt(state, call, is_success, environment)
+            if success or (can_fail_over is not None and not can_fail_over()):
+                return result
+
+    def stats(self):
+        """所有端点的统计"""
+        with self._lock:
+            return {"hedged_calls": self.hedged_calls, "endpoints": [state.stats() for state in self.states]}
@@ -1,12 +1,28 @@
 """生成Python函数注释的工具，集成API调用及实验跟踪功能
 """
+import json
 import os
 import re
 import time
 import requests
-import mlflow
-import dagshub
 from dotenv import load_dotenv
+from annotation_cache import build_cache_key, get_annotation_cache
+from endpoint_router import ENDPOINT_FIELDS, EndpointRouter, load_endpoints
+from http_client import post_with_retry
+from instrumentation import get_instrumentation
+from token_budget import plan_function_prompt
+from tracking import init_tracking, mlflow, tracking_enabled
+
+FUNCTION_NAME_PATTERN = re.compile(r'(?:async\s+)?def\s+(\w+)')
+# 评分规则（预编译；离线评分引擎 metrics_engine.py 复用同一组规则）
+COMPLETENESS_PATTERNS = {
+    "input": re.compile(r'input|parameters|param', re.IGNORECASE),
+    "processing": re.compile(r'processing|steps|operation|do', re.IGNORECASE),
+    "output": re.compile(r'output|return|result', re.IGNORECASE)
+}
+WHITESPACE_PATTERN = re.compile(r'\s+')
+REPEATED_CHAR_PATTERN = re.compile(r'(.)\1+')
+_prompt_templates = {}  # 模板路径 -> (修改时间, 模板内容)
 
 env_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env')
 load_dotenv(dotenv_path=env_path)
@@ -24,32 +40,39 @@ def init_environment():
         "api_url": os.getenv("API_URL"),
         "model_name": os.getenv("MODEL_NAME"),
         "model_temperature": os.getenv("MODEL_TEMPERATURE"),
+        "cache_path": os.getenv("ANNOTATION_CACHE_PATH"),  # 设置后启用注释结果缓存
+        "stream": os.getenv("API_STREAM", "").lower() in ("1", "true"),  # 是否使用流式响应
+        "pack_size": int(os.getenv("PACK_SIZE", "1")),  # 批处理时每个请求打包的函数数量
+        "pack_tokens": int(os.getenv("PACK_TOKENS", "0")) or None,  # 打包请求的估算token上限
+        "dedup": os.getenv("DEDUP_FUNCTIONS", "").lower() in ("1", "true"),  # 批处理时结构等价函数只调用一次模型
         "is_docker": is_docker  # 增加Docker环境标识
     }
+    # 配置了多个端点（API_ENDPOINTS）时按延迟和健康状况路由，主端点未配置时取第一个端点
+    endpoints = load_endpoints(env)
+    if endpoints and not all(env[key] for key in ["api_key", "api_url", "model_name"]):
+        env.update({key: endpoints[0][key] for key in ENDPOINT_FIELDS})
     if not all(env[key] for key in ["api_key", "api_url", "model_name"]):
         return None
-    # 非CI且非Docker环境才初始化mlflow和dagshub
-    if not os.getenv("CI") and not is_docker:
-        mlflow_tracking_uri = os.getenv("MLFLOW_TRACKING_URI")
-        mlflow_experiment = os.getenv("MLFLOW_EXPERIMENT")
-        if mlflow_tracking_uri and mlflow_experiment:
-            mlflow.set_tracking_uri(mlflow_tracking_uri)
-            mlflow.set_experiment(mlflow_experiment)
-        dagshub.init(
-            repo_name=os.getenv("DAGSHUB_REPO"),
-            repo_owner=os.getenv("DAGSHUB_USER"),
-            mlflow=True,
-            host="https://dagshub.com"
-        )
+    env["router"] = EndpointRouter.from_environment(env)
+    # 非CI且非Docker环境才初始化mlflow和dagshub（延迟导入，跟踪关闭时不加载）
+    env["tracking"] = not os.getenv("CI") and not is_docker
+    if env["tracking"]:
+        init_tracking()
     return env
 
 
 def load_prompt_template():
-    """加载根目录的prompt_template.txt提示词模板"""
+    """加载根目录的prompt_template.txt提示词模板（按文件修改时间缓存，文件变化后自动重新读取）"""
     template_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'prompt_template.txt')
     try:
+        mtime = os.stat(template_path).st_mtime_ns
+        cached = _prompt_templates.get(template_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
         with open(template_path, 'r', encoding='utf-8') as f:
-            return f.read().strip()
+            template = f.read().strip()
+        _prompt_templates[template_path] = (mtime, template)
+        return template
     except FileNotFoundError:
         return (
             "Please generate annotation for the following Python function.\n"
@@ -66,24 +89,21 @@ def load_prompt_template():
 
 def calculate_completeness(annotation: str) -> float:
     """计算注释完整性（输入、处理、输出三部分的覆盖度）"""
-    has_input = bool(re.search(r'input|parameters|param', annotation, re.IGNORECASE))
-    has_processing = bool(re.search(r'processing|steps|operation|do', annotation, re.IGNORECASE))
-    has_output = bool(re.search(r'output|return|result', annotation, re.IGNORECASE))
-    return (has_input + has_processing + has_output) / 3
+    return sum(bool(pattern.search(annotation)) for pattern in COMPLETENESS_PATTERNS.values()) / 3
 
 
 def calculate_comment_density(annotation: str, function_code: str) -> float:
     """计算注释密度（注释字符数/函数代码字符数）"""
-    cleaned_annotation = re.sub(r'\s+', '', annotation)
-    cleaned_annotation = re.sub(r'(.)\1+', r'\1', cleaned_annotation)
-    function_valid_chars = re.sub(r'\s+', '', function_code)
+    cleaned_annotation = WHITESPACE_PATTERN.sub('', annotation)
+    cleaned_annotation = REPEATED_CHAR_PATTERN.sub(r'\1', cleaned_annotation)
+    function_valid_chars = WHITESPACE_PATTERN.sub('', function_code)
     if len(function_valid_chars) == 0:
         return 0.0
     return round(len(cleaned_annotation) / len(function_valid_chars), 4)
 
 
-def build_api_request(environment, prompt):
-    """构建API请求参数"""
+def build_api_request(environment, prompt, stream=False, max_tokens=1024):
+    """构建API请求参数（stream 为 True 时请求 SSE 流式响应）"""
     model_name = environment["model_name"].lower()
     base_params = {
         "url": environment["api_url"],
@@ -95,91 +115,228 @@ def build_api_request(environment, prompt):
     temperature = float(environment["model_temperature"])
 
     if model_name.startswith("qwen"):
-        return {
+        params = {
             **base_params,
             "json": {
                 "model": environment["model_name"],
                 "input": {"prompt": prompt},
                 "parameters": {
                     "temperature": temperature,
-                    "max_tokens": 1024
+                    "max_tokens": max_tokens
                 }
             }
         }
-    if model_name.startswith("glm"):
-        return {
-            **base_params,
-            "json": {
-                "model": environment["model_name"],
-                "messages": [{"role": "user", "content": prompt}],
-                "temperature": temperature,
-                "max_tokens": 1024
-            }
-        }
-    return {
+        if stream:
+            # DashScope 通过请求头开启SSE，增量输出使每个事件只包含新生成的文本
+            params["headers"]["X-DashScope-SSE"] = "enable"
+            params["json"]["parameters"]["incremental_output"] = True
+        return params
+    # GLM 及其他 OpenAI 兼容接口
+    params = {
         **base_params,
         "json": {
             "model": environment["model_name"],
             "messages": [{"role": "user", "content": prompt}],
-            "temperature": temperature
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        }
+    }
+    if stream:
+        params["json"]["stream"] = True
+    return params
+
+
+def build_comment_result(comment_content, function_code, latency, *, cache_hit=False, retries=0, ttft=None,
+                         tokens=None):
+    """生成标准注释格式并计算关键指标（tokens 为估算及实际 token 数等预算信息，合并进指标）"""
+    with get_instrumentation().span("metrics"):
+        result = {
+            "comment": f'"""\n{comment_content}\n"""',
+            "metrics": {
+                "latency": latency,
+                "ttft": latency if ttft is None else ttft,
+                "output_length": len(comment_content),
+                "completeness": calculate_completeness(comment_content),
+                "comment_density": calculate_comment_density(comment_content, function_code),
+                "cache_hit": cache_hit,
+                "retries": retries
+            }
         }
+    if tokens:
+        result["metrics"].update(tokens)
+    return result
+
+
+def tag_endpoint(result, environment):
+    """在成功结果的指标中记录实际使用的端点名称（多端点路由时）"""
+    if isinstance(result, dict) and environment.get("endpoint"):
+        result["metrics"]["endpoint"] = environment["endpoint"]
+    return result
+
+
+def parse_usage(response_data):
+    """读取响应中的实际 token 用量（OpenAI/GLM 的 prompt/completion_tokens 或 Qwen 的 input/output_tokens）"""
+    usage = response_data.get("usage") or {}
+    return {
+        "input_tokens": usage.get("prompt_tokens", usage.get("input_tokens")),
+        "output_tokens": usage.get("completion_tokens", usage.get("output_tokens"))
     }
 
 
-def generate_function_comment(function_code, environment):
-    """生成函数注释主逻辑"""
+def parse_api_response(response_data, environment):
+    """根据模型类型从完整响应中提取注释内容"""
+    if environment["model_name"].lower().startswith("qwen"):
+        return response_data["output"]["text"].strip()
+    return response_data["choices"][0]["message"]["content"].strip()
+
+
+def read_stream_response(response, environment, start_time, on_token=None, usage=None):
+    """逐块解析流式（SSE）响应，返回 (完整注释内容, 首个token耗时)
+
+    兼容 OpenAI/GLM 的 choices[0].delta.content 与 Qwen 增量输出的 output.text 两种格式，
+    每收到一段文本即回调 on_token；传入 usage 字典时写入事件中携带的实际 token 用量。
+    """
+    is_qwen = environment["model_name"].lower().startswith("qwen")
+    chunks = []
+    ttft = None
+    lines = response.iter_lines()
+    for raw_line in lines:
+        line = raw_line.decode('utf-8') if isinstance(raw_line, bytes) else raw_line
+        if not line.startswith("data:"):
+            continue
+        payload = line[len("data:"):].strip()
+        if payload == "[DONE]":
+            # 读完剩余响应体（含分块编码的结束块），连接才会归还连接池供后续请求复用
+            for _ in lines:
+                pass
+            break
+        event = json.loads(payload)
+        if usage is not None and event.get("usage"):
+            usage.update(parse_usage(event))
+        if is_qwen:
+            text = event["output"].get("text")
+        else:
+            choices = event["choices"]
+            text = choices[0].get("delta", {}).get("content") if choices else None
+        if not text:
+            continue
+        if ttft is None:
+            ttft = round(time.time() - start_time, 4)
+        chunks.append(text)
+        if on_token:
+            on_token(text)
+    if ttft is None:
+        raise ValueError("Empty stream response")
+    return "".join(chunks).strip(), ttft
+
+
+def generate_function_comment(function_code, environment, on_token=None, *, skip_cache_lookup=False):
+    """生成函数注释主逻辑
+
+    传入 on_token 或环境配置 stream 为 True 时使用流式响应，on_token 会随文本到达被逐段调用。
+    各阶段耗时计入分阶段统计（instrumentation.py）。
+    skip_cache_lookup 供已查过缓存的调用方（打包请求）使用：不再查找缓存，避免未命中被重复计数，结果仍写入缓存。
+    """
+    instrumentation = get_instrumentation()
+    call_start = time.perf_counter()
     error_occurred = False
     error_msg = ""
-    latency = 0.0  # 初始化耗时变量，用于错误场景返回
+    latency = ttft = 0.0  # 初始化耗时变量，用于错误场景返回
+    comment_content = ""
     # 环境或输入校验错误
     if not environment:
         error_msg = "Problems in API settings, please check."
         error_occurred = True
-    elif not function_code.strip().startswith("def "):
+    elif not function_code.strip().startswith(("def ", "async def ")):
         error_msg = "Input must be a Python function starting with 'def'"
         error_occurred = True
+    elif environment.get("router") is not None:
+        # 多端点：交给路由器选择端点（失败时转移，流式输出时不发对冲请求），请求只在各端点的调用中构建
+        # 流式输出已有文本送达 on_token 后不再转移，避免下一个端点重复输出
+        streamed = []
+
+        def relay(text):
+            streamed.append(text)
+            on_token(text)
+
+        return environment["router"].call(
+            lambda endpoint_env: tag_endpoint(
+                generate_function_comment(function_code, endpoint_env, on_token and relay,
+                                          skip_cache_lookup=skip_cache_lookup),
+                endpoint_env
+            ),
+            lambda result: isinstance(result, dict),
+            environment,
+            hedge=on_token is None,
+            can_fail_over=lambda: not streamed
+        )
     else:
-        prompt = load_prompt_template().replace("{function_code}", function_code)
-        request_params = build_api_request(environment, prompt)
+        with instrumentation.span("template_load"):
+            prompt_template = load_prompt_template()
+        with instrumentation.span("request_build"):
+            # 超出 token 预算的函数先压缩，max_tokens 随函数规模调整
+            prompt, tokens = plan_function_prompt(function_code, prompt_template, environment)
+            stream = on_token is not None or bool(environment.get("stream"))
+            request_params = build_api_request(environment, prompt, stream=stream, max_tokens=tokens["max_tokens"])
         if not request_params:
             error_msg = "Problems in API settings, please check."
             error_occurred = True
     # 错误场景：仅返回错误信息
     if error_occurred:
         return error_msg
+    # 命中缓存：直接返回缓存的注释（指标按当前代码重新计算），不调用API
+    cache = get_annotation_cache(environment)
+    cache_key = build_cache_key(function_code, environment, prompt_template) if cache else None
+    if cache and not skip_cache_lookup:
+        lookup_start = time.perf_counter()
+        cached = cache.get(cache_key)
+        if cached is not None:
+            # 延迟记为本次查找缓存的耗时，而不是生成该注释时的 API 延迟
+            return build_comment_result(
+                cached["content"], function_code, time.perf_counter() - lookup_start, cache_hit=True
+            )
     # 正常请求API
     try:
         start_time = time.time()
-        response = requests.post(** request_params, timeout=30)
-        response.raise_for_status()
+        request_start = time.perf_counter()
+        # 复用连接池会话，临时错误（429/5xx）自动退避重试
+        response, retries = post_with_retry(request_params, timeout=30, stream=stream)
+        if stream:
+            # 流式模式：边接收边解析，记录首个token耗时
+            # 读完后连接已归还连接池；解析出错提前退出时关闭连接，不留下读了一半的连接
+            with instrumentation.span("download", stream=True), response:
+                comment_content, ttft = read_stream_response(response, environment, start_time, on_token, tokens)
         latency = round(time.time() - start_time, 4)
+        instrumentation.record("request", time.perf_counter() - request_start, request_start)
     except requests.exceptions.RequestException:
         # API请求错误：返回错误信息
         return "Problems in API connection, please check."
-    # 解析API响应并生成注释
-    try:
-        response_data = response.json()
-        model_name = environment["model_name"].lower()
-        # 根据模型类型解析响应
-        if model_name.startswith("qwen"):
-            comment_content = response_data["output"]["text"].strip()
-        else:
-            comment_content = response_data["choices"][0]["message"]["content"].strip()
-        # 生成标准注释格式
-        comment = f'"""\n{comment_content}\n"""'
-        # 返回注释+关键指标
-        return {
-            "comment": comment,
-            "metrics": {
-                "latency": latency,
-                "output_length": len(comment_content),
-                "completeness": calculate_completeness(comment_content),
-                "comment_density": calculate_comment_density(comment_content, function_code)
-            }
-        }
-    except (KeyError, ValueError):
-        # 响应解析错误：返回错误信息
+    except (KeyError, IndexError, TypeError, ValueError):
+        # 流式响应解析错误：返回错误信息
         return "Problems in API response, please check."
+    # 解析API响应并生成注释
+    if not stream:
+        try:
+            with instrumentation.span("json_parse"):
+                response_data = response.json()
+                comment_content = parse_api_response(response_data, environment)
+                tokens.update(parse_usage(response_data))
+        except (KeyError, ValueError):
+            # 响应解析错误：返回错误信息
+            return "Problems in API response, please check."
+        ttft = latency  # 非流式模式下完整响应到达即为首个token
+    # 生成标准注释格式，返回注释+关键指标
+    result = build_comment_result(comment_content, function_code, latency, retries=retries, ttft=ttft, tokens=tokens)
+    if cache:
+        cache.put(cache_key, comment_content, result["metrics"])
+    instrumentation.record("annotate", time.perf_counter() - call_start, call_start)
+    return result
+
+
+def parse_function_name(function_code):
+    """从函数代码中解析函数名（支持 async def），无法解析时返回 unknown"""
+    match = FUNCTION_NAME_PATTERN.match(function_code.strip())
+    return match.group(1) if match else "unknown"
 
 
 def main():
@@ -196,30 +353,41 @@ def main():
     function_code = "\n".join(function_lines)
     env = init_environment()
     print("\nGenerated comment:")
-    result = generate_function_comment(function_code, env)
+    streamed_chunks = []
+
+    def print_token(text):
+        """流式输出：注释内容到达即打印"""
+        if not streamed_chunks:
+            print('"""')
+        streamed_chunks.append(text)
+        print(text, end="", flush=True)
+
+    result = generate_function_comment(function_code, env, on_token=print_token)
     # 主函数单独运行时，补充日志记录
     if not env:
         print(result)
     elif isinstance(result, dict):
-        print(result["comment"])
+        # 已流式打印的内容只需补上结尾，命中缓存时直接打印完整注释
+        print('\n"""' if streamed_chunks else result["comment"])
         # 非CI且非Docker环境才记录日志
-        if not os.getenv("CI") and not env.get("is_docker"):
-            with mlflow.start_run(run_name=f"{env['model_name']}_{function_code.split()[1].split('(')[0]}"):
+        if tracking_enabled(env):
+            func_name = parse_function_name(function_code)
+            with mlflow.start_run(run_name=f"{env['model_name']}_{func_name}"):
                 mlflow.log_param("model", env["model_name"])
                 mlflow.log_param("temperature", env["model_temperature"])
-                mlflow.log_param("function_name", function_code.split()[1].split('(')[0])
+                mlflow.log_param("function_name", func_name)
                 mlflow.log_metric("input_length", len(function_code.strip()))
                 mlflow.log_metric("output_length", result["metrics"]["output_length"])
                 mlflow.log_metric("latency", result["metrics"]["latency"])
+                mlflow.log_metric("ttft", result["metrics"]["ttft"])
                 mlflow.log_metric("completeness", result["metrics"]["completeness"])
                 mlflow.log_metric("comment_density", result["metrics"]["comment_density"])
                 mlflow.log_metric("success", 1)
     else:
         print(result)
         # 非CI且非Docker环境才记录错误日志
-        if not os.getenv("CI") and not env.get("is_docker"):
-            func_name = function_code.split()[1].split('(')[0] \
-                if function_code.strip().startswith("def ") else "unknown"
+        if tracking_enabled(env):
+            func_name = parse_function_name(function_code)
             with mlflow.start_run(run_name=f"{env['model_name']}_{func_name}_error"):
                 mlflow.log_param("model", env["model_name"])
                 mlflow.log_param("function_name", func_name)
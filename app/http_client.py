@@ -0,0 +1,136 @@
+"""模型API的HTTP客户端
+所有请求复用同一个带连接池的 keep-alive 会话，对 429/5xx 等临时错误按指数退避（带抖动）重试，
+并优先遵循服务端返回的 Retry-After；建立连接/TLS、首字节、响应体下载和退避等待的耗时计入分阶段统计
+"""
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from instrumentation import get_instrumentation
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_shared = {"session": None}
+_session_lock = threading.Lock()
+_connect_timing = threading.local()  # 当前线程本次请求中建立连接的耗时
+
+
+class _TimedConnectMixin:
+    """建立连接（含 TLS 握手）时计时；复用 keep-alive 连接时不会调用 connect"""
+
+    def connect(self):
+        """建立连接并记录 connect 阶段耗时"""
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            duration = time.perf_counter() - start
+            _connect_timing.seconds = getattr(_connect_timing, "seconds", 0.0) + duration
+            get_instrumentation().record("connect", duration, start, host=self.host)
+
+
+class TimedHTTPConnection(_TimedConnectMixin, HTTPConnection):
+    """记录建立连接耗时的 HTTP 连接"""
+
+
+class TimedHTTPSConnection(_TimedConnectMixin, HTTPSConnection):
+    """记录建立连接及 TLS 握手耗时的 HTTPS 连接"""
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    """使用 TimedHTTPConnection 的连接池"""
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    """使用 TimedHTTPSConnection 的连接池"""
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """连接池使用带计时的连接类"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+
+def get_http_session():
+    """获取进程内共享的连接池会话（首次调用时创建）"""
+    with _session_lock:
+        if _shared["session"] is None:
+            pool_size = int(os.getenv("API_POOL_SIZE", "16"))
+            adapter = TimedHTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _shared["session"] = session
+        return _shared["session"]
+
+
+def parse_retry_after(value):
+    """解析 Retry-After 头（秒数或 HTTP 日期），无法解析时返回 None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def compute_backoff(attempt, base_delay, max_delay):
+    """计算第 attempt 次重试前的等待时间（指数退避 + 全抖动）"""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def post_with_retry(request_params, timeout=30, stream=False):
+    """发送POST请求，对连接错误和 429/5xx 响应自动重试
+
+    重试次数和退避参数读取环境变量 API_MAX_RETRIES（默认 3）、API_BACKOFF_BASE（默认 0.5 秒）、
+    API_BACKOFF_MAX（默认 30 秒）。返回 (response, 重试次数)；最终仍失败时抛出 RequestException。
+    每次尝试的首字节耗时（不含建立连接）计入 ttfb，非流式响应的响应体读取计入 download。
+    """
+    max_retries = int(os.getenv("API_MAX_RETRIES", "3"))
+    base_delay = float(os.getenv("API_BACKOFF_BASE", "0.5"))
+    max_delay = float(os.getenv("API_BACKOFF_MAX", "30"))
+    session = get_http_session()
+    instrumentation = get_instrumentation()
+    attempt = 0
+    while True:
+        _connect_timing.seconds = 0.0
+        start = time.perf_counter()
+        try:
+            response = session.post(**request_params, timeout=timeout, stream=stream)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt >= max_retries:
+                raise
+            delay = compute_backoff(attempt, base_delay, max_delay)
+        else:
+            # response.elapsed 覆盖发送请求到解析完响应头，之后（非流式时）为读取响应体
+            connect = _connect_timing.seconds
+            elapsed = response.elapsed.total_seconds()
+            instrumentation.record("ttfb", max(0.0, elapsed - connect), start + connect, status=response.status_code)
+            if not stream:
+                instrumentation.record("download", max(0.0, time.perf_counter() - start - elapsed), start + elapsed)
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= max_retries:
+                if response.status_code >= 400:
+                    # 抛出前关闭响应：流式响应的响应体尚未读取，否则连接一直被占用
+                    response.close()
+                response.raise_for_status()
+                return response, attempt
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            delay = min(max_delay, retry_after) if retry_after is not None \
+                else compute_backoff(attempt, base_delay, max_delay)
+            response.close()
+        with instrumentation.span("backoff", attempt=attempt):
+            time.sleep(delay)
+        attempt += 1
@@ -0,0 +1,77 @@
+"""增量注释清单
+记录每个函数的 AST 指纹（结合模型、温度、提示词模板版本和 token 预算）及其上次的注释结果，
+下次运行时只为新增或变化的函数调用模型，其余函数沿用清单中的结果
+"""
+import hashlib
+import json
+import os
+import tempfile
+from token_budget import get_max_output_tokens, get_prompt_token_budget
+
+DEFAULT_MANIFEST_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), '.annotation_manifest.json')
+MANIFEST_VERSION = 1
+
+
+def compute_run_signature(environment, prompt_template):
+    """计算模型、温度、提示词模板和 token 预算的版本签名，任一变化都会使清单失效
+
+    输入预算决定函数代码是否被压缩、输出上限决定 max_tokens，与缓存键（annotation_cache.build_cache_key）一致。
+    """
+    payload = json.dumps(
+        [environment["model_name"], str(environment["model_temperature"]), prompt_template,
+         get_prompt_token_budget(environment), get_max_output_tokens()],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class AnnotationManifest:
+    """函数指纹清单，键为 文件::函数名::指纹"""
+
+    def __init__(self, path, signature):
+        self.path = path
+        self.signature = signature
+        self.entries = {}
+        self.carried_count = 0
+        self._seen = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            # 清单版本或运行签名不一致时全部重新注释
+            if data.get("version") == MANIFEST_VERSION and data.get("signature") == signature:
+                self.entries = data.get("functions", {})
+
+    @staticmethod
+    def entry_key(task):
+        """生成函数在清单中的键"""
+        return f"{task['file']}::{task.get('qualname', task['name'])}::{task['fingerprint']}"
+
+    def lookup(self, task):
+        """函数未变化时返回上次的函数记录（标记为沿用），否则返回 None"""
+        key = self.entry_key(task)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self._seen[key] = entry
+        self.carried_count += 1
+        return {**entry["record"], "file": task['file'], "carried_forward": True}
+
+    def update(self, task, record):
+        """记录新生成的函数记录（含注释文本，调用方只传入成功的结果）"""
+        self._seen[self.entry_key(task)] = {"record": record}
+
+    def save(self):
+        """原子写入清单；仅保留本次运行中出现的函数，已删除或失败的函数不再保留"""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".manifest-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({
+                    "version": MANIFEST_VERSION,
+                    "signature": self.signature,
+                    "functions": self._seen
+                }, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
@@ -0,0 +1,247 @@
+"""分阶段耗时统计
+注释流程的每个阶段（模板加载、请求构建、建立连接/TLS、首字节、响应体下载、JSON 解析、指标计算、
+跟踪记录等）分别计入对数分桶直方图；直方图可合并、可序列化，用于输出 p50/p95/p99。
+设置 TRACE_PATH（或批处理 --trace）时同时导出 Chrome Trace 格式的事件文件，可用 Perfetto 或 chrome://tracing 查看
+"""
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# 阶段名称及输出顺序
+PHASES = (
+    "template_load",  # 加载提示词模板
+    "request_build",  # 构建提示词和请求参数
+    "connect",  # 建立 TCP 连接及 TLS 握手（复用连接时不记录）
+    "ttfb",  # 请求发出到收到响应头（不含建立连接）
+    "download",  # 读取响应体
+    "backoff",  # 重试前的退避等待
+    "request",  # 整个 HTTP 请求（含重试），即 metrics["latency"]
+    "json_parse",  # 解析响应 JSON 并提取注释
+    "metrics",  # 计算完整性、注释密度等指标
+    "annotate",  # 单次 generate_function_comment 的总耗时
+    "tracking",  # 批处理主线程中的日志记录
+    "tracking_flush"  # 后台线程写入 MLflow
+)
+
+
+def percentile(values, q):
+    """样本的最近秩法分位数（q 为 0-100），无样本时返回 0"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(len(ordered) * q / 100) - 1))]
+
+
+def percentiles(values, ndigits=None):
+    """样本的 p50/p95/p99，可指定保留的小数位数"""
+    ordered = sorted(values)
+    result = {f"p{q}": percentile(ordered, q) for q in (50, 95, 99)}
+    return result if ndigits is None else {label: round(value, ndigits) for label, value in result.items()}
+
+
+class LatencyHistogram:
+    """对数分桶直方图（每个 2 倍区间 16 个桶，相对误差约 4%），可合并"""
+
+    BUCKETS_PER_OCTAVE = 16
+    MIN_VALUE = 1e-6  # 1 微秒
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def _index(self, value):
+        if value <= self.MIN_VALUE:
+            return 0
+        return int(math.log2(value / self.MIN_VALUE) * self.BUCKETS_PER_OCTAVE) + 1
+
+    def _upper_bound(self, index):
+        return self.MIN_VALUE * 2 ** (index / self.BUCKETS_PER_OCTAVE)
+
+    def record(self, value):
+        """记录一个耗时（秒）"""
+        index = self._index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """合并另一个直方图（例如其他线程、进程或运行的统计）"""
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def percentile(self, q):
+        """分位数（q 为 0-100），返回所在桶的上界（不超过最大值）"""
+        if not self.count:
+            return 0.0
+        target = max(1, math.ceil(self.count * q / 100))
+        cumulative = 0
+        for index in sorted(self.buckets):
+            cumulative += self.buckets[index]
+            if cumulative >= target:
+                return max(self.min, min(self.max, self._upper_bound(index)))
+        return self.max
+
+    def summary(self):
+        """数量、均值、p50/p95/p99 和最大值"""
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 6) if self.count else 0.0,
+            "p50": round(self.percentile(50), 6),
+            "p95": round(self.percentile(95), 6),
+            "p99": round(self.percentile(99), 6),
+            "max": round(self.max, 6)
+        }
+
+    def to_dict(self):
+        """序列化为可 JSON 化的字典"""
+        return {"buckets": {str(k): v for k, v in self.buckets.items()}, "count": self.count,
+                "total": self.total, "min": self.min if self.count else None, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        """从 to_dict 的结果还原"""
+        histogram = cls()
+        histogram.buckets = {int(k): v for k, v in data["buckets"].items()}
+        histogram.count = data["count"]
+        histogram.total = data["total"]
+        histogram.min = data["min"] if data["min"] is not None else math.inf
+        histogram.max = data["max"]
+        return histogram
+
+
+class TraceWriter:
+    """以 Chrome Trace（JSON 数组）格式逐条写出耗时事件；文件未正常结束时查看工具也能读取"""
+
+    def __init__(self, path):
+        self.path = path
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._file = open(path, 'w', encoding='utf-8')  # pylint: disable=consider-using-with
+        self._file.write("[\n")
+        self._first = True
+
+    def write(self, name, start, duration, args=None):
+        """写出一个完整事件（start 为 perf_counter 时间，单位秒）"""
+        event = {"name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                 "ts": round((start - self._origin) * 1e6, 1), "dur": round(duration * 1e6, 1)}
+        if args:
+            event["args"] = args
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(("" if self._first else ",\n") + json.dumps(event, ensure_ascii=False))
+            self._first = False
+
+    def close(self):
+        """写出数组结尾并关闭文件"""
+        with self._lock:
+            if not self._file.closed:
+                self._file.write("\n]\n")
+                self._file.close()
+
+
+class Instrumentation:
+    """按阶段汇总耗时直方图，可选写出追踪事件；可在多线程间共享"""
+
+    def __init__(self, trace_path=None):
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self.tracer = TraceWriter(trace_path) if trace_path else None
+
+    def record(self, phase, duration, start=None, **args):
+        """记录一个阶段的耗时（秒）；提供 start（perf_counter 时间）且开启追踪时同时写出事件"""
+        with self._lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = LatencyHistogram()
+            histogram.record(duration)
+        if self.tracer is not None and start is not None:
+            self.tracer.write(phase, start, duration, args)
+
+    @contextmanager
+    def span(self, phase, **args):
+        """计时上下文：退出时记录该阶段的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - start, start, **args)
+
+    def merge(self, other):
+        """合并另一个统计对象（或 to_dict 的结果）"""
+        histograms = other.histograms if isinstance(other, Instrumentation) else {
+            phase: LatencyHistogram.from_dict(data) for phase, data in other.items()
+        }
+        with self._lock:
+            for phase, histogram in histograms.items():
+                self.histograms.setdefault(phase, LatencyHistogram()).merge(histogram)
+        return self
+
+    def summary(self):
+        """各阶段的统计（按 PHASES 顺序，未知阶段排在最后）"""
+        with self._lock:
+            phases = sorted(self.histograms, key=lambda p: (PHASES.index(p) if p in PHASES else len(PHASES), p))
+            return {phase: self.histograms[phase].summary() for phase in phases}
+
+    def to_dict(self):
+        """序列化所有直方图"""
+        with self._lock:
+            return {phase: histogram.to_dict() for phase, histogram in self.histograms.items()}
+
+    def metrics(self, prefix="phase_"):
+        """展开为 MLflow 指标：{前缀阶段_p50/p95/p99: 秒}"""
+        return {
+            f"{prefix}{phase}_{key}": values[key]
+            for phase, values in self.summary().items() for key in ("p50", "p95", "p99")
+        }
+
+    def close(self):
+        """结束追踪文件"""
+        if self.tracer is not None:
+            self.tracer.close()
+
+
+_shared = {"instrumentation": None}
+_shared_lock = threading.Lock()
+
+
+def get_instrumentation():
+    """进程内共享的统计对象（首次调用时创建，TRACE_PATH 设置时开启追踪）"""
+    with _shared_lock:
+        if _shared["instrumentation"] is None:
+            _shared["instrumentation"] = Instrumentation(os.getenv("TRACE_PATH") or None)
+        return _shared["instrumentation"]
+
+
+def reset_instrumentation(trace_path=None):
+    """开始新的统计（例如每次批处理运行开始时），返回新的统计对象"""
+    with _shared_lock:
+        if _shared["instrumentation"] is not None:
+            _shared["instrumentation"].close()
+        _shared["instrumentation"] = Instrumentation(trace_path or os.getenv("TRACE_PATH") or None)
+        return _shared["instrumentation"]
+
+
+def format_summary(summary):
+    """将阶段统计格式化为文本行（毫秒）"""
+    lines = [f"   {'phase':<16}{'count':>8}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}  (ms)"]
+    for phase, values in summary.items():
+        lines.append(
+            f"   {phase:<16}{values['count']:>8}" + "".join(
+                f"{values[key] * 1000:>10.2f}" for key in ("mean", "p50", "p95", "p99", "max")
+            )
+        )
+    return lines
@@ -0,0 +1,219 @@
+"""离线批量评分引擎
+从结果数据集读取已存储的注释/函数代码对，使用与请求路径相同的评分规则批量重新计算指标，
+并输出各指标的分布；修改评分规则后无需重新调用模型即可在历史结果上评估
+
+评分按列批量计算：关键词匹配使用 pyarrow 的向量化正则，注释密度将整列字符串展开为一个码点数组后
+用 numpy 统计去空白、合并连续重复字符后的长度，结果与 calculate_completeness/calculate_comment_density 一致
+
+用法：
+    python app/metrics_engine.py [--path DIR] [--run-id ID] [--file GLOB] [--workers N] [--bins N] [--output FILE]
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from func_annotator import COMPLETENESS_PATTERNS
+from results_store import DEFAULT_RESULTS_DIR, load_results, print_table
+
+DEFAULT_CHUNK_SIZE = 50000
+# 与 Python 正则 \s 相同的空白字符查找表（Unicode 空白字符的最大码点为 U+3000）
+_WHITESPACE_TABLE = np.array([chr(c).isspace() for c in range(0x3001)] + [False], dtype=bool)
+_QUANTILES = (("p10", 0.10), ("p25", 0.25), ("p50", 0.50), ("p75", 0.75), ("p90", 0.90))
+
+
+def extract_comment_content(comments):
+    """去掉存储注释首尾的三引号行（与 build_comment_result 的包装格式对应），返回注释正文列"""
+    comments = pc.fill_null(comments, "")
+    comments = pc.replace_substring_regex(comments, '^"""\n', "", max_replacements=1)
+    return pc.replace_substring_regex(comments, '\n"""$', "", max_replacements=1)
+
+
+def _codepoints(strings):
+    """将字符串列展开为一个码点数组，返回 (码点数组, 每个字符串对应的行号数组)"""
+    strings = pc.fill_null(strings, "")
+    if isinstance(strings, pa.ChunkedArray):
+        strings = strings.combine_chunks()
+    strings = strings.cast(pa.string())
+    lengths = pc.utf8_length(strings).to_numpy(zero_copy_only=False)
+    row_ids = np.repeat(np.arange(len(strings)), lengths)
+    if len(row_ids) == 0:
+        return np.empty(0, dtype=np.uint32), row_ids
+    offsets = np.frombuffer(strings.buffers()[1], dtype=np.int32)[strings.offset:strings.offset + len(strings) + 1]
+    data = strings.buffers()[2].to_pybytes()[offsets[0]:offsets[-1]]
+    codepoints = np.frombuffer(data.decode('utf-8').encode('utf-32-le'), dtype=np.uint32)
+    return codepoints, row_ids
+
+
+def _non_whitespace(codepoints):
+    """非空白字符的布尔掩码"""
+    return ~_WHITESPACE_TABLE[np.minimum(codepoints, len(_WHITESPACE_TABLE) - 1)]
+
+
+def completeness(annotations, codes):  # pylint: disable=unused-argument
+    """注释完整性：输入、处理、输出三类关键词的覆盖度"""
+    annotations = pc.fill_null(annotations, "")
+    hits = [
+        pc.cast(pc.match_substring_regex(annotations, pattern.pattern, ignore_case=True), pa.int8())
+        .to_numpy(zero_copy_only=False)
+        for pattern in COMPLETENESS_PATTERNS.values()
+    ]
+    return np.sum(hits, axis=0) / 3 if hits else np.zeros(len(annotations))
+
+
+def comment_density(annotations, codes):
+    """注释密度：去空白并合并连续重复字符后的注释长度 / 去空白后的代码长度"""
+    count = len(annotations)
+    annotation_points, annotation_rows = _codepoints(annotations)
+    keep = _non_whitespace(annotation_points)
+    annotation_points, annotation_rows = annotation_points[keep], annotation_rows[keep]
+    # 每段连续重复字符只计一次（不跨越字符串边界）
+    run_start = np.ones(len(annotation_points), dtype=bool)
+    run_start[1:] = (annotation_points[1:] != annotation_points[:-1]) | (annotation_rows[1:] != annotation_rows[:-1])
+    annotation_lengths = np.bincount(annotation_rows[run_start], minlength=count)
+    code_points, code_rows = _codepoints(codes)
+    code_lengths = np.bincount(code_rows[_non_whitespace(code_points)], minlength=count)
+    ratios = np.where(code_lengths > 0, annotation_lengths / np.maximum(code_lengths, 1), 0.0)
+    # 逐个使用 Python round，保证与请求路径的舍入结果一致（np.round 在恰好为 .5 的情况下会不同）
+    return np.array([round(ratio, 4) for ratio in ratios.tolist()], dtype=np.float64)
+
+
+def _count_parts(annotations, split):
+    """去掉首尾空白后按 split 拆分并计数，空注释计为 0"""
+    trimmed = pc.utf8_trim_whitespace(pc.fill_null(annotations, ""))
+    empty = pc.equal(pc.utf8_length(trimmed), 0).to_numpy(zero_copy_only=False)
+    return np.where(empty, 0, pc.list_value_length(split(trimmed)).to_numpy(zero_copy_only=False))
+
+
+def word_count(annotations, codes):  # pylint: disable=unused-argument
+    """注释的词数"""
+    return _count_parts(annotations, pc.utf8_split_whitespace)
+
+
+def line_count(annotations, codes):  # pylint: disable=unused-argument
+    """注释的非空行数"""
+    return _count_parts(annotations, lambda trimmed: pc.split_pattern_regex(trimmed, r"\s*\n\s*"))
+
+
+# 指标注册表：名称 -> 函数(注释列, 代码列) -> numpy 数组；新增或修改评分规则只需在此登记
+METRICS = {
+    "completeness": completeness,
+    "comment_density": comment_density,
+    "word_count": word_count,
+    "line_count": line_count
+}
+
+
+def score_batch(annotations, codes, metrics=None):
+    """对一批注释/代码对计算指标，返回 {指标名: numpy 数组}"""
+    annotations = pa.array(annotations, type=pa.string()) if isinstance(annotations, list) else annotations
+    codes = pa.array(codes, type=pa.string()) if isinstance(codes, list) else codes
+    return {name: METRICS[name](annotations, codes) for name in (metrics or METRICS)}
+
+
+def _score_chunk(args):
+    """进程池任务：对一个分块评分"""
+    annotations, codes, metrics = args
+    return score_batch(annotations, codes, metrics)
+
+
+def rescore_table(table, metrics=None, workers=1, chunk_size=DEFAULT_CHUNK_SIZE):
+    """对结果表中的成功记录重新评分
+
+    返回包含 run_id/file/function_name、原存储指标（stored_ 前缀）和新指标的表；
+    workers > 1 时按 chunk_size 分块在进程池中并行计算。
+    """
+    metrics = list(metrics or METRICS)
+    table = table.filter(pc.fill_null(table["success"], False))
+    annotations = extract_comment_content(table["comment"])
+    codes = pc.fill_null(table["code"], "")
+    chunks = [
+        (annotations.slice(start, chunk_size), codes.slice(start, chunk_size), metrics)
+        for start in range(0, table.num_rows, chunk_size)
+    ]
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            scored = list(executor.map(_score_chunk, chunks))
+    else:
+        scored = [_score_chunk(chunk) for chunk in chunks]
+    columns = {name: table[name] for name in ("run_id", "file", "function_name") if name in table.column_names}
+    for name in ("completeness", "comment_density"):
+        if name in table.column_names:
+            columns[f"stored_{name}"] = table[name]
+    for name in metrics:
+        values = [result[name] for result in scored]
+        columns[name] = pa.array(np.concatenate(values) if values else np.empty(0), type=pa.float64())
+    return pa.table(columns)
+
+
+def metric_distributions(table, metrics=None):
+    """计算各指标的分布：数量、均值、标准差、最小值、分位数、最大值"""
+    rows = []
+    for name in metrics or [m for m in METRICS if m in table.column_names]:
+        values = table[name].to_numpy()
+        row = {"metric": name, "count": len(values)}
+        if len(values):
+            row.update({"mean": float(values.mean()), "std": float(values.std()), "min": float(values.min())})
+            row.update({label: float(np.quantile(values, q)) for label, q in _QUANTILES})
+            row["max"] = float(values.max())
+        rows.append(row)
+    return pa.Table.from_pylist(rows)
+
+
+def metric_histogram(table, name, bins=10):
+    """返回指标的直方图 (计数, 区间边界)"""
+    return np.histogram(table[name].to_numpy(), bins=bins)
+
+
+def count_changed(table, name):
+    """新规则下与存储值不同的记录数（比较到 4 位小数）"""
+    stored = f"stored_{name}"
+    if stored not in table.column_names:
+        return None
+    previous = pc.fill_null(table[stored], float("nan")).to_numpy()
+    return int(np.sum(~np.isclose(previous, table[name].to_numpy(), atol=1e-4)))
+
+
+def main():
+    """命令行入口：重新评分结果数据集并输出分布"""
+    parser = argparse.ArgumentParser(description="离线批量重新评分已存储的注释")
+    parser.add_argument("--path", default=DEFAULT_RESULTS_DIR, help="结果数据集目录")
+    parser.add_argument("--run-id", default=None, help="只评分指定运行的记录")
+    parser.add_argument("--file", default=None, help="文件 glob 过滤，例如 'feedings/*'")
+    parser.add_argument("--metrics", nargs="+", default=None, choices=list(METRICS), help="要计算的指标（默认全部）")
+    parser.add_argument("--workers", type=int, default=1, help="并行评分的进程数")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="每个分块的记录数")
+    parser.add_argument("--bins", type=int, default=0, help="输出每个指标的直方图（区间数）")
+    parser.add_argument("--output", default=None, help="将重新评分的结果写入 Parquet 文件")
+    args = parser.parse_args()
+    if not os.path.isdir(args.path):
+        print(f"[ERROR] 结果数据集不存在: {args.path}")
+        return
+    table = load_results(args.path, columns=["run_id", "file", "function_name", "code", "comment", "success",
+                                             "completeness", "comment_density"], file_pattern=args.file)
+    if args.run_id:
+        table = table.filter(pc.equal(table["run_id"], args.run_id))
+    scored = rescore_table(table, args.metrics, workers=args.workers, chunk_size=args.chunk_size)
+    print(f"[RESCORE] 重新评分 {scored.num_rows} 条记录")
+    print_table(metric_distributions(scored, args.metrics))
+    for name in ("completeness", "comment_density"):
+        changed = count_changed(scored, name) if name in scored.column_names else None
+        if changed is not None:
+            print(f"[DIFF] {name} 与存储值不同：{changed}")
+    if args.bins and scored.num_rows:
+        for name in args.metrics or METRICS:
+            counts, edges = metric_histogram(scored, name, args.bins)
+            print(f"\n[HISTOGRAM] {name}")
+            for index, (count, low, high) in enumerate(zip(counts, edges[:-1], edges[1:])):
+                bracket = "]" if index == len(counts) - 1 else ")"  # 最后一个区间包含右端点
+                histogram_bar = '#' * int(40 * count / max(counts.max(), 1))
+                print(f"   [{low:.4f}, {high:.4f}{bracket} {count:>8} {histogram_bar}")
+    if args.output:
+        pq.write_table(scored, args.output, compression="zstd")
+        print(f"[OUTPUT] 已写入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""本地模拟模型服务
+在本机启动一个多线程 HTTP 服务，按请求体自动返回 GLM/OpenAI（choices[0].message.content）或
+Qwen（output.text）格式的注释及 token 用量，支持 SSE 流式响应、按 max_tokens 截断、可配置的延迟分布
+（可另加按 token 数计的耗时）以及 5xx/429 错误率，用于在无网络、无API费用的情况下测试和压测注释流程
+
+用法：
+    python app/mock_llm_server.py [--port 8765] [--latency lognormal:-3,0.5] [--error-rate 0.01] [--rate-limit 0.05]
+                                  [--token-latency 0.0002]
+
+延迟分布格式：fixed:秒 | uniform:最小,最大 | normal:均值,标准差 | lognormal:mu,sigma | exponential:均值
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from func_annotator import FUNCTION_NAME_PATTERN
+from prompt_packing import SECTION_PATTERN
+
+LATENCY_DISTRIBUTIONS = {
+    "fixed": lambda rng, value: value,
+    "uniform": lambda rng, low, high: rng.uniform(low, high),
+    "normal": lambda rng, mean, std: max(0.0, rng.gauss(mean, std)),
+    "lognormal": lambda rng, mu, sigma: rng.lognormvariate(mu, sigma),
+    "exponential": lambda rng, mean: rng.expovariate(1 / mean) if mean > 0 else 0.0
+}
+
+
+def parse_latency_spec(spec):
+    """解析延迟分布描述（如 'lognormal:-3,0.5'），返回 函数(random.Random) -> 秒"""
+    name, _, args = (spec or "fixed:0").partition(":")
+    if name not in LATENCY_DISTRIBUTIONS:
+        raise ValueError(f"Unknown latency distribution: {name}")
+    values = [float(v) for v in args.split(",") if v.strip()] or [0.0]
+    sampler = LATENCY_DISTRIBUTIONS[name]
+    return lambda rng: sampler(rng, *values)
+
+
+def build_mock_annotation(function_code):
+    """根据函数代码生成确定性的三段式注释"""
+    match = FUNCTION_NAME_PATTERN.search(function_code)
+    name = match.group(1) if match else "function"
+    return (
+        f"Input: the parameters passed to {name}.\n"
+        f"Processing: performs the operation steps of {name}.\n"
+        f"Output: returns the result of {name}."
+    )
+
+
+def build_mock_content(prompt):
+    """为提示词生成回复内容；打包提示词按分隔格式逐个返回"""
+    sections = SECTION_PATTERN.findall(prompt)
+    if not sections:
+        return build_mock_annotation(prompt)
+    return "\n".join(
+        f"=== FUNCTION {number} ===\n{build_mock_annotation(code)}\n=== END {number} ==="
+        for number, code in sections
+    )
+
+
+class MockLLMServer:
+    """模拟模型服务；可作为上下文管理器在后台线程中运行"""
+
+    def __init__(self, host="127.0.0.1", port=0, *, latency="fixed:0", error_rate=0.0, rate_limit_rate=0.0,
+                 retry_after=0.0, stream_chunks=8, token_latency=0.0, seed=None):
+        self.sample_latency = parse_latency_spec(latency)
+        self.token_latency = token_latency  # 每个输入/输出 token 额外的耗时（秒）
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.stream_chunks = stream_chunks
+        self.stats = {"requests": 0, "errors": 0, "rate_limited": 0, "streamed": 0, "connections": 0}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        """服务地址（可直接作为 API_URL）"""
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def draw_response(self, streamed=False):
+        """抽取本次请求的延迟和状态码，并更新请求统计（加锁保证同一种子下可复现）"""
+        with self._lock:
+            self.stats["requests"] += 1
+            latency = self.sample_latency(self._rng)
+            roll = self._rng.random()
+            if roll < self.rate_limit_rate:
+                self.stats["rate_limited"] += 1
+                return latency, 429
+            if roll < self.rate_limit_rate + self.error_rate:
+                self.stats["errors"] += 1
+                return latency, 500
+            self.stats["streamed"] += int(streamed)
+            return latency, 200
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """请求处理：按请求体格式返回对应的响应"""
+            protocol_version = "HTTP/1.1"
+            # 响应头和响应体分两次写出，关闭 Nagle 算法以免与客户端的延迟确认叠加出约 40ms 的等待
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with server._lock:  # pylint: disable=protected-access
+                    server.stats["connections"] += 1  # 统计新建连接数，用于检查客户端是否复用连接
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                streamed = self.headers.get("X-DashScope-SSE") == "enable" or bool(body.get("stream"))
+                latency, status = server.draw_response(streamed)
+                if latency > 0:
+                    time.sleep(latency)
+                if status != 200:
+                    payload = json.dumps({"error": {"code": status, "message": "mock error"}}).encode()
+                    self.send_response(status)
+                    if status == 429:
+                        self.send_header("Retry-After", str(server.retry_after))
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                    return
+                is_qwen = "input" in body
+                prompt = body["input"]["prompt"] if is_qwen else body["messages"][-1]["content"]
+                content = build_mock_content(prompt)
+                # 按 max_tokens 截断回复（约 4 个字符一个 token），并返回 token 用量
+                max_tokens = (body.get("parameters") if is_qwen else body).get("max_tokens")
+                finish_reason = "stop"
+                if max_tokens and len(content) > max_tokens * 4:
+                    content, finish_reason = content[:max_tokens * 4], "length"
+                usage = (-(-len(prompt) // 4), -(-len(content) // 4))
+                if server.token_latency:
+                    time.sleep(server.token_latency * sum(usage))
+                if streamed:
+                    self._send_stream(content, is_qwen, body.get("model"), usage)
+                    return
+                if is_qwen:
+                    response = {"output": {"text": content, "finish_reason": finish_reason},
+                                "usage": {"input_tokens": usage[0], "output_tokens": usage[1]}}
+                else:
+                    response = {
+                        "model": body.get("model"),
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                                     "finish_reason": finish_reason}],
+                        "usage": {"prompt_tokens": usage[0], "completion_tokens": usage[1],
+                                  "total_tokens": sum(usage)}
+                    }
+                payload = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _send_stream(self, content, is_qwen, model, usage):
+                """以 SSE 分块发送内容（分块编码，连接可复用），token 用量随最后一个事件返回"""
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                size = max(1, -(-len(content) // server.stream_chunks))
+                for start in range(0, len(content), size):
+                    text = content[start:start + size]
+                    event = {"output": {"text": text}} if is_qwen else \
+                        {"model": model, "choices": [{"index": 0, "delta": {"content": text}}]}
+                    if start + size >= len(content):
+                        event["usage"] = {"input_tokens": usage[0], "output_tokens": usage[1]} if is_qwen else \
+                            {"prompt_tokens": usage[0], "completion_tokens": usage[1], "total_tokens": sum(usage)}
+                    self._write_chunk(f"data: {json.dumps(event)}\n\n")
+                if not is_qwen:
+                    self._write_chunk("data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _write_chunk(self, text):
+                data = text.encode()
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                pass
+
+        return Handler
+
+    def start(self):
+        """在后台线程中启动服务，返回服务地址"""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="mock-llm-server", daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        """停止服务"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    """命令行入口：在前台运行模拟服务"""
+    parser = argparse.ArgumentParser(description="本地模拟模型服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=8765, help="监听端口")
+    parser.add_argument("--latency", default="fixed:0", help="延迟分布，例如 lognormal:-3,0.5")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 500 的比例")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="返回 429 的比例")
+    parser.add_argument("--retry-after", type=float, default=0.0, help="429 响应的 Retry-After 秒数")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="每个输入/输出 token 额外的耗时（秒）")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子")
+    args = parser.parse_args()
+    server = MockLLMServer(args.host, args.port, latency=args.latency, error_rate=args.error_rate,
+                           rate_limit_rate=args.rate_limit, retry_after=args.retry_after,
+                           token_latency=args.token_latency, seed=args.seed)
+    print(f"[MOCK] 模拟模型服务已启动：{server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(f"[MOCK] 统计：{server.stats}")
+
+
+if __name__ == "__main__":
+    main()
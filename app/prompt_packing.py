@@ -0,0 +1,142 @@
+"""多函数打包请求
+将多个函数合并进一次API请求（共享同一份提示词模板前言），要求模型按可解析的分隔格式逐个返回注释，
+再拆分回每个函数单独评分；解析失败的函数回退为单函数请求
+"""
+import re
+import time
+import requests
+from annotation_cache import build_cache_key, get_annotation_cache
+from func_annotator import (
+    build_api_request,
+    build_comment_result,
+    generate_function_comment,
+    load_prompt_template,
+    parse_api_response,
+    parse_usage,
+    tag_endpoint
+)
+from http_client import post_with_retry
+from instrumentation import get_instrumentation
+from token_budget import choose_max_tokens, compact_functions, estimate_tokens
+
+PACKED_INSTRUCTIONS = (
+    "The following {count} Python functions are numbered. Annotate each function separately, "
+    "following the requirements above for every annotation.\n"
+    "Reply with exactly one section per function, in order, using this format and nothing else:\n"
+    "=== FUNCTION <number> ===\n<annotation>\n=== END <number> ===\n\n"
+)
+SECTION_PATTERN = re.compile(r'===\s*FUNCTION\s+(\d+)\s*===\s*(.*?)\s*===\s*END\s+\1\s*===', re.DOTALL)
+MAX_PACKED_OUTPUT_TOKENS = 4096
+
+
+def pack_functions(functions, max_functions, token_budget=None):
+    """按函数数量和token预算将函数分组，逐组产出 [(序号, 函数信息), ...]，可直接消费生成器"""
+    current, current_tokens = [], 0
+    for index, func_info in enumerate(functions):
+        tokens = estimate_tokens(func_info['code'])
+        over_budget = token_budget and current and current_tokens + tokens > token_budget
+        if current and (len(current) >= max_functions or over_budget):
+            yield current
+            current, current_tokens = [], 0
+        current.append((index, func_info))
+        current_tokens += tokens
+    if current:
+        yield current
+
+
+def build_packed_prompt(prompt_template, function_codes):
+    """构建包含多个编号函数的提示词"""
+    blocks = "".join(
+        f"=== FUNCTION {number} ===\n{code.strip()}\n=== END {number} ===\n\n"
+        for number, code in enumerate(function_codes, start=1)
+    )
+    packed_code = PACKED_INSTRUCTIONS.format(count=len(function_codes)) + blocks
+    return prompt_template.replace("{function_code}", packed_code)
+
+
+def parse_packed_response(content, count):
+    """按分隔格式拆分响应，返回 {函数编号: 注释内容}，缺失或为空的编号不包含在结果中"""
+    sections = {}
+    for match in SECTION_PATTERN.finditer(content):
+        number = int(match.group(1))
+        if 1 <= number <= count and match.group(2).strip() and number not in sections:
+            sections[number] = match.group(2).strip()
+    return sections
+
+
+def generate_packed_comments(function_codes, environment):
+    """为一组函数生成注释，返回与输入顺序一致的结果列表（dict 或错误信息字符串）
+
+    命中缓存的函数不进入打包请求；每个函数的 latency 为整次请求耗时按函数数量均摊，
+    metrics["packed"] 记录同一请求中的函数数量，token 相关指标为整个请求的值。配置多端点时整组请求由路由器选择端点。
+    """
+    router = environment.get("router") if environment else None
+    if router is not None:
+        # 多端点：整组请求路由到同一端点，端点不可用（全部失败）时转移到其他端点
+        return router.call(
+            lambda endpoint_env: [
+                tag_endpoint(result, endpoint_env) for result in generate_packed_comments(function_codes, endpoint_env)
+            ],
+            lambda results: any(isinstance(result, dict) for result in results),
+            environment
+        )
+    results = [None] * len(function_codes)
+    prompt_template = load_prompt_template()
+    cache = get_annotation_cache(environment)
+    pending = []
+    for position, code in enumerate(function_codes):
+        if not environment or not code.strip().startswith(("def ", "async def ")):
+            # 无效输入由单函数逻辑返回统一的错误信息
+            results[position] = generate_function_comment(code, environment)
+            continue
+        if cache:
+            lookup_start = time.perf_counter()
+            cached = cache.get(build_cache_key(code, environment, prompt_template))
+            if cached is not None:
+                results[position] = build_comment_result(
+                    cached["content"], code, time.perf_counter() - lookup_start, cache_hit=True
+                )
+                continue
+        pending.append(position)
+    if len(pending) == 1:
+        # 已查过缓存：单函数请求不再重复查找
+        results[pending[0]] = generate_function_comment(function_codes[pending[0]], environment,
+                                                        skip_cache_lookup=True)
+        pending = []
+    sections = {}
+    latency, retries = 0.0, 0
+    request_tokens, compactions = {}, []  # 整个请求的估算和实际 token 数（同一请求中的函数记录相同的值）
+    if pending:
+        # 每个函数按 token 预算压缩，max_tokens 按各函数规模累加
+        codes, compactions, code_tokens = compact_functions([function_codes[p] for p in pending], environment)
+        prompt = build_packed_prompt(prompt_template, codes)
+        max_tokens = min(MAX_PACKED_OUTPUT_TOKENS, choose_max_tokens(code_tokens, len(pending)))
+        request_params = build_api_request(environment, prompt, max_tokens=max_tokens)
+        request_tokens = {"input_tokens_est": estimate_tokens(prompt), "max_tokens": max_tokens,
+                          "input_tokens": None, "output_tokens": None}
+        try:
+            start_time = time.time()
+            with get_instrumentation().span("request", packed=len(pending)):
+                response, retries = post_with_retry(request_params, timeout=30 * len(pending))
+            latency = round(time.time() - start_time, 4)
+            with get_instrumentation().span("json_parse", packed=len(pending)):
+                response_data = response.json()
+                sections = parse_packed_response(parse_api_response(response_data, environment), len(pending))
+                request_tokens.update(parse_usage(response_data))
+        except (requests.exceptions.RequestException, KeyError, IndexError, ValueError):
+            sections = {}
+    for number, position in enumerate(pending, start=1):
+        code = function_codes[position]
+        if number not in sections:
+            # 该函数的分段解析失败：回退为单函数请求（已查过缓存）
+            results[position] = generate_function_comment(code, environment, skip_cache_lookup=True)
+            continue
+        result = build_comment_result(
+            sections[number], code, round(latency / len(pending), 4), retries=retries,
+            tokens={**request_tokens, "compaction": compactions[number - 1]}
+        )
+        result["metrics"]["packed"] = len(pending)
+        if cache:
+            cache.put(build_cache_key(code, environment, prompt_template), sections[number], result["metrics"])
+        results[position] = result
+    return results
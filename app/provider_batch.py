@@ -0,0 +1,127 @@
+"""服务商批处理（Batch API）请求导出与结果解析
+每个函数导出为一行 JSONL 请求（custom_id + method + url + body，body 与 build_api_request 生成的请求体一致），
+同时导出 custom_id 到函数信息的任务索引；服务商返回结果 JSONL 后按 custom_id 拆回每个函数的注释内容
+"""
+import hashlib
+import json
+import os
+from urllib.parse import urlparse
+from func_annotator import build_api_request, parse_api_response
+from incremental import AnnotationManifest
+
+DEFAULT_BATCH_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'outputs', 'batch_requests.jsonl')
+MAX_REQUESTS_PER_FILE = 50000  # 常见服务商单个批处理文件的请求数上限
+TASK_INDEX_FIELDS = ("file", "name", "qualname", "kind", "line", "end_line", "fingerprint", "code")
+
+
+def build_custom_id(task):
+    """根据 文件::函数名::指纹 生成稳定的 custom_id（函数未变化时多次导出结果相同）"""
+    digest = hashlib.sha256(AnnotationManifest.entry_key(task).encode('utf-8')).hexdigest()
+    return f"func-{digest[:32]}"
+
+
+def build_batch_line(custom_id, environment, prompt, max_tokens=1024):
+    """构建一行批处理请求，url 取 API_URL 的路径部分"""
+    request_params = build_api_request(environment, prompt, max_tokens=max_tokens)
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": urlparse(environment["api_url"]).path or "/",
+        "body": request_params["json"]
+    }
+
+
+def default_task_index_path(batch_path):
+    """请求文件对应的任务索引路径"""
+    return os.path.splitext(batch_path)[0] + ".tasks.jsonl"
+
+
+def part_path(batch_path, part):
+    """第 part 个分片的文件路径（第 1 片即 batch_path 本身）"""
+    if part == 1:
+        return batch_path
+    root, ext = os.path.splitext(batch_path)
+    return f"{root}.part{part}{ext}"
+
+
+class BatchRequestWriter:
+    """逐行写出批处理请求（超过单文件请求数上限时分片），并写出任务索引"""
+
+    def __init__(self, batch_path, max_requests=None):
+        os.makedirs(os.path.dirname(os.path.abspath(batch_path)), exist_ok=True)
+        self.batch_path = batch_path
+        self.index_path = default_task_index_path(batch_path)
+        self.max_requests = max_requests or MAX_REQUESTS_PER_FILE
+        self.paths = []
+        self.count = 0
+        self._seen = {}
+        self._file = None
+        self._index = open(self.index_path, 'w', encoding='utf-8')  # pylint: disable=consider-using-with
+
+    def write(self, task, environment, prompt, max_tokens=1024):
+        """写出一个函数的请求，返回其 custom_id（同一文件中重复的函数追加序号以保证唯一）"""
+        custom_id = build_custom_id(task)
+        duplicates = self._seen.get(custom_id, 0)
+        self._seen[custom_id] = duplicates + 1
+        if duplicates:
+            custom_id = f"{custom_id}-{duplicates}"
+        if self.count % self.max_requests == 0:
+            self._open_part(self.count // self.max_requests + 1)
+        line = build_batch_line(custom_id, environment, prompt, max_tokens)
+        self._file.write(json.dumps(line, ensure_ascii=False) + "\n")
+        self._index.write(json.dumps(
+            {"custom_id": custom_id, **{k: task.get(k) for k in TASK_INDEX_FIELDS}}, ensure_ascii=False
+        ) + "\n")
+        self.count += 1
+        return custom_id
+
+    def _open_part(self, part):
+        if self._file is not None:
+            self._file.close()
+        path = part_path(self.batch_path, part)
+        self._file = open(path, 'w', encoding='utf-8')  # pylint: disable=consider-using-with
+        self.paths.append(path)
+
+    def close(self):
+        """关闭所有文件"""
+        if self._file is not None:
+            self._file.close()
+        self._index.close()
+
+
+def load_task_index(index_path):
+    """读取任务索引，返回 {custom_id: 函数信息}（保持导出顺序）"""
+    tasks = {}
+    with open(index_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                tasks[entry.pop("custom_id")] = entry
+    return tasks
+
+
+def iter_batch_results(result_paths):
+    """逐行读取一个或多个服务商结果 JSONL 文件"""
+    for path in result_paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def parse_batch_result(result_line, environment):
+    """解析一行批处理结果，返回 (custom_id, 注释内容, 错误信息)，成功时错误信息为 None"""
+    custom_id = result_line.get("custom_id")
+    response = result_line.get("response") or {}
+    error = result_line.get("error")
+    status_code = response.get("status_code", 200 if response else None)
+    if error or status_code != 200:
+        message = error.get("message") if isinstance(error, dict) else error
+        return custom_id, None, f"Batch request failed: {message or f'HTTP {status_code}'}"
+    try:
+        content = parse_api_response(response["body"], environment)
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return custom_id, None, "Problems in API response, please check."
+    if not content:
+        return custom_id, None, "Problems in API response, please check."
+    return custom_id, content, None
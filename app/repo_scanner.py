@@ -0,0 +1,143 @@
+"""源码仓库扫描器
+遍历任意目录树（支持包含/排除 glob），在进程池中解析文件，每个文件只切分一次源码，
+按需逐个产出函数记录（限定名、类型、行范围、代码、AST 指纹）
+"""
+import ast
+import copy
+import fnmatch
+import hashlib
+import os
+import textwrap
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+DEFAULT_INCLUDE = ("*.py",)
+DEFAULT_EXCLUDE = (".git", "__pycache__", ".venv", "venv", "env", "node_modules", ".tox", ".nox", "build", "dist")
+
+
+def fingerprint_function_node(node):
+    """计算函数 AST 的指纹（忽略行号等位置信息和文档字符串）"""
+    node = copy.copy(node)
+    body = node.body
+    if body and isinstance(body[0], ast.Expr) and isinstance(body[0].value, ast.Constant) \
+            and isinstance(body[0].value.value, str):
+        node.body = body[1:]
+    return hashlib.sha256(ast.dump(node, include_attributes=False).encode('utf-8')).hexdigest()
+
+
+class _FunctionCollector(ast.NodeVisitor):
+    """按源码顺序收集函数定义，记录所在类/函数的上下文"""
+
+    def __init__(self, lines, fingerprints=True):
+        self.lines = lines
+        self.fingerprints = fingerprints
+        self.scope = []  # (名称, 是否为类)
+        self.functions = []
+
+    def visit_ClassDef(self, node):  # pylint: disable=invalid-name
+        self.scope.append((node.name, True))
+        self.generic_visit(node)
+        self.scope.pop()
+
+    def visit_FunctionDef(self, node):  # pylint: disable=invalid-name
+        self._collect(node, is_async=False)
+
+    def visit_AsyncFunctionDef(self, node):  # pylint: disable=invalid-name
+        self._collect(node, is_async=True)
+
+    def _collect(self, node, is_async):
+        if self.scope and self.scope[-1][1]:
+            kind = "method"
+        elif self.scope:
+            kind = "nested_function"
+        else:
+            kind = "function"
+        qualname = ".".join([name for name, _ in self.scope] + [node.name])
+        self.functions.append({
+            'name': node.name,
+            'qualname': qualname,
+            'kind': f"async_{kind}" if is_async else kind,
+            'code': textwrap.dedent('\n'.join(self.lines[node.lineno - 1:node.end_lineno])),
+            'line': node.lineno,
+            'end_line': node.end_lineno,
+            'col_offset': node.col_offset,
+            'fingerprint': fingerprint_function_node(node) if self.fingerprints else None
+        })
+        self.scope.append((node.name, False))
+        self.generic_visit(node)
+        self.scope.pop()
+
+
+def extract_functions_from_source(content, tree=None, fingerprints=True):
+    """从源码字符串中提取所有函数（含异步函数和方法），源码只切分一次
+
+    已解析过时可传入 tree 避免重复解析；fingerprints=False 时不计算 AST 指纹（fingerprint 为 None）。
+    """
+    tree = tree or ast.parse(content)
+    collector = _FunctionCollector(content.split('\n'), fingerprints)
+    collector.visit(tree)
+    return collector.functions
+
+
+def scan_file(file_path, file_label=None):
+    """解析单个文件并返回函数记录列表，file 字段为 file_label（默认文件名）；解析失败时返回空列表"""
+    label = file_label or os.path.basename(file_path)
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        functions = extract_functions_from_source(content)
+    except (OSError, SyntaxError, UnicodeDecodeError, ValueError) as e:
+        print(f"[ERROR] 读取文件 {file_path} 时出错: {e}")
+        return []
+    return [{**func_info, 'file': label} for func_info in functions]
+
+
+def _matches(rel_path, patterns):
+    """相对路径或其任一路径分量匹配任一 glob 模式"""
+    parts = rel_path.split('/')
+    return any(
+        fnmatch.fnmatch(rel_path, pattern) or any(fnmatch.fnmatch(part, pattern) for part in parts)
+        for pattern in patterns
+    )
+
+
+def iter_source_files(root, include=None, exclude=None, *, default_excludes=True):
+    """遍历目录树，按包含/排除 glob 逐个产出 (文件路径, 相对路径)，结果按路径排序以保证稳定
+
+    exclude 在 DEFAULT_EXCLUDE 的基础上追加；default_excludes 为 False 时只使用 exclude。
+    """
+    include = tuple(include or DEFAULT_INCLUDE)
+    exclude = (DEFAULT_EXCLUDE if default_excludes else ()) + tuple(exclude or ())
+    for dir_path, dir_names, file_names in os.walk(root):
+        rel_dir = os.path.relpath(dir_path, root).replace(os.sep, '/')
+        rel_dir = "" if rel_dir == "." else rel_dir + "/"
+        # 原地裁剪被排除的目录，避免进入遍历
+        dir_names[:] = sorted(d for d in dir_names if not _matches(rel_dir + d, exclude))
+        for file_name in sorted(file_names):
+            rel_path = rel_dir + file_name
+            if _matches(rel_path, exclude):
+                continue
+            if any(fnmatch.fnmatch(rel_path, p) or fnmatch.fnmatch(file_name, p) for p in include):
+                yield os.path.join(dir_path, file_name), rel_path
+
+
+def scan_repository(root, include=None, exclude=None, workers=None, *, default_excludes=True):
+    """扫描目录树中的函数，按文件顺序逐个产出函数记录
+
+    workers > 1 时在进程池中并行解析文件（在途文件数有上限，不会一次性提交整棵树），
+    workers 默认取 CPU 核数；workers <= 1 时在当前进程中解析。
+    """
+    files = iter_source_files(root, include, exclude, default_excludes=default_excludes)
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1:
+        for file_path, rel_path in files:
+            yield from scan_file(file_path, rel_path)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for file_path, rel_path in files:
+            in_flight.append(executor.submit(scan_file, file_path, rel_path))
+            if len(in_flight) >= workers * 4:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
@@ -0,0 +1,175 @@
+"""批量注释结果的列式存储（Parquet）
+批处理过程中按行组批量写入每个函数的记录，每次运行写入数据集目录下的一个文件，
+多次运行的结果可作为一个数据集统一扫描、查询和汇总
+
+用法：
+    python app/results_store.py summary [--path DIR] [--by file]
+    python app/results_store.py query [--path DIR] [--file GLOB] [--errors] [--limit N]
+"""
+import argparse
+import os
+import threading
+import time
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+DEFAULT_RESULTS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'outputs', 'annotations')
+DEFAULT_ROW_GROUP_SIZE = 5000
+
+RESULTS_SCHEMA = pa.schema([
+    ("run_id", pa.string()),
+    ("model", pa.string()),
+    ("timestamp", pa.timestamp("ms")),
+    ("file", pa.string()),
+    ("function_name", pa.string()),
+    ("line", pa.int32()),
+    ("code", pa.string()),
+    ("comment", pa.string()),
+    ("success", pa.bool_()),
+    ("error_message", pa.string()),
+    ("latency", pa.float64()),
+    ("completeness", pa.float64()),
+    ("comment_density", pa.float64()),
+    ("input_length", pa.int64()),
+    ("output_length", pa.int64()),
+    ("carried_forward", pa.bool_()),
+])
+
+
+class ResultsWriter:
+    """按行组缓冲并写入 Parquet 文件（每次运行一个文件，多次运行追加为同一数据集）"""
+
+    def __init__(self, dataset_dir, run_id, model, row_group_size=DEFAULT_ROW_GROUP_SIZE):
+        os.makedirs(dataset_dir, exist_ok=True)
+        self.path = os.path.join(dataset_dir, f"run-{time.strftime('%Y%m%d_%H%M%S')}-{run_id}.parquet")
+        self.run_id = run_id
+        self.model = model
+        self.row_group_size = row_group_size
+        self.row_count = 0
+        self._rows = []
+        self._lock = threading.Lock()
+        self._writer = pq.ParquetWriter(self.path, RESULTS_SCHEMA, compression="zstd")
+
+    def write(self, record, code=None):
+        """追加一条函数记录，缓冲满一个行组时写入文件"""
+        row = {
+            "run_id": self.run_id,
+            "model": self.model,
+            "timestamp": int(time.time() * 1000),
+            "code": code,
+            "carried_forward": bool(record.get("carried_forward", False)),
+            **{name: record.get(name) for name in RESULTS_SCHEMA.names
+               if name not in ("run_id", "model", "timestamp", "code", "carried_forward")}
+        }
+        with self._lock:
+            self._rows.append(row)
+            if len(self._rows) >= self.row_group_size:
+                self._flush()
+
+    def _flush(self):
+        if self._rows:
+            self._writer.write_table(pa.Table.from_pylist(self._rows, schema=RESULTS_SCHEMA))
+            self.row_count += len(self._rows)
+            self._rows = []
+
+    def close(self):
+        """写出剩余记录并关闭文件"""
+        with self._lock:
+            self._flush()
+            self._writer.close()
+
+
+def load_results(dataset_dir=DEFAULT_RESULTS_DIR, columns=None, file_pattern=None, errors_only=False):
+    """读取数据集（可只读取部分列），按文件 glob 和错误状态过滤，返回 pyarrow.Table"""
+    import pyarrow.dataset as ds  # pylint: disable=import-outside-toplevel  # 导入开销大，仅查询时加载
+    dataset = ds.dataset(dataset_dir, format="parquet", schema=RESULTS_SCHEMA)
+    expression = None
+    if errors_only:
+        expression = ~ds.field("success")
+    scan_columns = None
+    if columns:
+        scan_columns = list(dict.fromkeys(list(columns) + (["file"] if file_pattern else [])))
+    table = dataset.to_table(columns=scan_columns, filter=expression)
+    if file_pattern:
+        table = table.filter(pc.match_like(table["file"], _glob_to_like(file_pattern)))
+    return table
+
+
+def _glob_to_like(pattern):
+    """将简单 glob 模式转换为 SQL LIKE 模式"""
+    escaped = pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped.replace("*", "%").replace("?", "_")
+
+
+def summarize_results(dataset_dir=DEFAULT_RESULTS_DIR, group_by="file"):
+    """按指定列汇总：函数数、成功数、平均延迟/完整性/注释密度"""
+    table = load_results(dataset_dir, columns=[group_by, "success", "latency", "completeness", "comment_density"])
+    table = table.append_column("succeeded", pc.cast(table["success"], pa.int64()))
+    successes = table.filter(table["success"])
+    totals = table.group_by(group_by).aggregate([("success", "count"), ("succeeded", "sum")])
+    totals = pa.table({
+        group_by: totals[group_by],
+        "functions": totals["success_count"],
+        "successes": totals["succeeded_sum"]
+    })
+    averages = successes.group_by(group_by).aggregate([
+        ("latency", "mean"),
+        ("latency", "max"),
+        ("completeness", "mean"),
+        ("comment_density", "mean")
+    ])
+    return totals.join(averages, group_by).sort_by(group_by)
+
+
+def print_table(table):
+    """以对齐的文本形式输出表格"""
+    rows = table.to_pylist()
+    names = table.column_names
+    widths = {
+        name: max([len(name)] + [len(_format_cell(row[name])) for row in rows])
+        for name in names
+    }
+    print("  ".join(name.ljust(widths[name]) for name in names))
+    for row in rows:
+        print("  ".join(_format_cell(row[name]).ljust(widths[name]) for name in names))
+
+
+def _format_cell(value):
+    if isinstance(value, float):
+        return f"{value:.4f}"
+    text = "" if value is None else str(value)
+    return text if len(text) <= 60 else text[:57] + "..."
+
+
+def main():
+    """命令行入口：汇总或查询结果数据集"""
+    parser = argparse.ArgumentParser(description="批量注释结果数据集的汇总与查询")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summary", help="按列分组汇总")
+    summary_parser.add_argument("--path", default=DEFAULT_RESULTS_DIR, help="结果数据集目录")
+    summary_parser.add_argument("--by", default="file", choices=["file", "model", "run_id"], help="分组列")
+    query_parser = subparsers.add_parser("query", help="查询函数记录")
+    query_parser.add_argument("--path", default=DEFAULT_RESULTS_DIR, help="结果数据集目录")
+    query_parser.add_argument("--file", default=None, help="文件 glob 过滤，例如 'feedings/*'")
+    query_parser.add_argument("--function", default=None, help="函数名 glob 过滤")
+    query_parser.add_argument("--errors", action="store_true", help="只显示失败的函数")
+    query_parser.add_argument("--limit", type=int, default=20, help="最多显示的行数")
+    args = parser.parse_args()
+    if not os.path.isdir(args.path):
+        print(f"[ERROR] 结果数据集不存在: {args.path}")
+        return
+    if args.command == "summary":
+        print_table(summarize_results(args.path, args.by))
+        return
+    columns = ["run_id", "file", "function_name", "success", "latency", "completeness",
+               "comment_density", "error_message"]
+    table = load_results(args.path, columns=columns, file_pattern=args.file, errors_only=args.errors)
+    if args.function:
+        table = table.filter(pc.match_like(table["function_name"], _glob_to_like(args.function)))
+    print(f"[QUERY] 匹配 {table.num_rows} 条记录")
+    print_table(table.select(columns).slice(0, args.limit))
+
+
+if __name__ == "__main__":
+    main()
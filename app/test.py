@@ -1,5 +1,31 @@
 import json
+import os
+import socket
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
 
+import pytest
+import requests
+
+import annotation_service
+import batch_annotator
+import dedup
+import docstring_writer
+import endpoint_router
+import func_annotator
+import http_client
+import incremental
+import instrumentation
+import mock_llm_server
+import prompt_packing
+import repo_scanner
+import token_budget
+import tracking
+import work_queue
+from annotation_cache import build_cache_key, get_annotation_cache
 from func_annotator import (
     init_environment,
     generate_function_comment,
@@ -10,6 +36,41 @@ from func_annotator import (
 TEST_FUNCTION = """def add(a: int, b: int) -> int:
     return a + b
 """
+API_TEST_ENV = {"API_KEY": "test", "API_URL": "https://open.bigmodel.cn/api/paas/v4/chat/completions",
+                "MODEL_NAME": "glm-4-flash", "MODEL_TEMPERATURE": "0.3", "CI": "1"}
+
+
+class FakeAnnotator:
+    """批处理测试中代替模型调用：记录收到的代码，代码包含 fail_marker 时返回连接错误，否则返回带函数名的注释"""
+
+    def __init__(self):
+        self.calls = []
+        self.fail_marker = None
+        self.delay = 0.0
+        self.latency = 0.01
+        self.template = 'Input: {name} args.\n\nOutput: a "quoted" value.'
+
+    def __call__(self, function_code, _environment):
+        self.calls.append(function_code)
+        if self.delay:
+            time.sleep(self.delay)
+        if self.fail_marker and self.fail_marker in function_code:
+            return "Problems in API connection, please check."
+        content = self.template.format(name=function_code.split("(")[0].split()[-1])
+        return {"comment": f'"""\n{content}\n"""',
+                "metrics": {"latency": self.latency, "output_length": len(content), "completeness": 2 / 3,
+                            "comment_density": 0.5}}
+
+
+@pytest.fixture(name="fake_annotator")
+def fake_annotator_fixture(monkeypatch):
+    """设置测试用 API 环境变量，用 FakeAnnotator 代替批处理的模型调用，并跳过函数级 MLflow 记录"""
+    for key, value in API_TEST_ENV.items():
+        monkeypatch.setenv(key, value)
+    annotator = FakeAnnotator()
+    monkeypatch.setattr(batch_annotator, "generate_function_comment", annotator)
+    monkeypatch.setattr(batch_annotator, "log_function_record", lambda *args: None)
+    return annotator
 
 def test_environment_init():
     """测试环境变量初始化"""
@@ -62,3 +123,704 @@ def test_api_response_debug():
             print(f"\nAPI调用失败，错误信息: {result}")
     except Exception as e:
         print(f"API调试过程出错: {str(e)}")
+
+
+def test_concurrent_batch_stats_match_sequential(tmp_path, fake_annotator):
+    """测试并发批处理与顺序批处理的统计结果一致（无需API）"""
+    sample_file = tmp_path / "function_sample_test.py"
+    sample_file.write_text(
+        "\n".join(f"def f{i}(x):\n    return x + {i}\n" for i in range(8)), encoding="utf-8"
+    )
+    fake_annotator.fail_marker, fake_annotator.delay = "f3", 0.01
+    env = {"model_name": "glm-test", "model_temperature": "0.3"}
+    # 不同目录下的同名文件分别统计
+    (tmp_path / "other").mkdir()
+    same_name = tmp_path / "other" / "function_sample_test.py"
+    same_name.write_text("def g(x):\n    return x\n", encoding="utf-8")
+    sequential = batch_annotator.process_sample_files([sample_file, same_name], env, workers=1)
+    concurrent = batch_annotator.process_sample_files([sample_file, same_name], env, workers=4)
+    assert sequential == concurrent
+    assert sequential[0]["success_count"] == 7 and sequential[0]["error_count"] == 1
+    assert sequential[1]["success_count"] == 1 and sequential[1]["error_count"] == 0
+
+
+class FakeResponse:
+    """模拟的HTTP响应"""
+
+    def __init__(self, status_code, payload=None, headers=None, lines=None):
+        self.status_code = status_code
+        self.payload = payload
+        self.headers = headers or {}
+        self.lines = lines or []
+        self.elapsed = timedelta(0)
+        self.closed = False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error")
+
+    def json(self):
+        return self.payload
+
+    def iter_lines(self):
+        return iter(self.lines)
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def test_annotation_cache_hit_skips_api(tmp_path, monkeypatch):
+    """测试缓存命中时不再调用API（无需API）"""
+    calls = []
+
+    def fake_post(request_params, timeout, stream=False):
+        calls.append((request_params, timeout, stream))
+        return FakeResponse(200, {"choices": [{"message": {"content": "Input: a, b. Output: sum."}}]}), 0
+
+    monkeypatch.setattr(func_annotator, "post_with_retry", fake_post)
+    env = {"api_key": "k", "api_url": "http://localhost", "model_name": "glm-test",
+           "model_temperature": "0.3", "cache_path": str(tmp_path / "cache.sqlite3")}
+    first = generate_function_comment(TEST_FUNCTION, env)
+    # 仅格式变化（规范化后相同）应命中缓存
+    second = generate_function_comment(TEST_FUNCTION.replace("a + b", "a+b"), env)
+    assert len(calls) == 1
+    assert first["metrics"]["cache_hit"] is False and second["metrics"]["cache_hit"] is True
+    assert first["comment"] == second["comment"]
+    with sqlite3.connect(env["cache_path"]) as conn:
+        # 命中只计入内存，不在读取路径上写库；命中结果的延迟是查找耗时而非原 API 延迟
+        assert conn.execute("SELECT value FROM counters WHERE name = 'hits'").fetchone() is None
+        conn.execute("UPDATE annotations SET metrics = ?", (json.dumps({"latency": 5.0}),))
+    assert generate_function_comment(TEST_FUNCTION, env)["metrics"]["latency"] < 1.0
+    stats = get_annotation_cache(env).stats()
+    assert stats["hits"] == 2 and stats["total_hits"] == 2 and stats["total_misses"] == 1
+
+
+def test_post_with_retry_honors_retry_after(monkeypatch):
+    """测试429响应按Retry-After重试并返回重试次数（无需API）"""
+    responses = [FakeResponse(429, headers={"Retry-After": "0"}), FakeResponse(503), FakeResponse(200, {})]
+
+    class FakeSession:
+        def post(self, **_kwargs):
+            return responses.pop(0)
+
+    sleeps = []
+    monkeypatch.setattr(http_client, "get_http_session", FakeSession)
+    monkeypatch.setattr(http_client.time, "sleep", sleeps.append)
+    monkeypatch.setenv("API_MAX_RETRIES", "3")
+    response, retries = http_client.post_with_retry({"url": "http://localhost"})
+    assert response.status_code == 200 and retries == 2
+    assert sleeps[0] == 0.0
+    # 最后一次仍失败时，抛出前也要关闭响应
+    failed = FakeResponse(503)
+    responses.append(failed)
+    monkeypatch.setenv("API_MAX_RETRIES", "0")
+    with pytest.raises(requests.exceptions.HTTPError):
+        http_client.post_with_retry({"url": "http://localhost"}, stream=True)
+    assert failed.closed
+
+
+def test_stream_response_reports_ttft(monkeypatch):
+    """测试流式响应逐段回调并返回ttft指标（无需API）"""
+    lines = [
+        b'data: {"choices": [{"delta": {"role": "assistant"}}]}',
+        b'',
+        'data: {"choices": [{"delta": {"content": "Input: a, b. "}}]}'.encode('utf-8'),
+        b'data: {"choices": [{"delta": {"content": "Output: \xe5\x92\x8c."}}]}',
+        b'data: [DONE]',
+    ]
+    requests_sent = []
+
+    def fake_post(request_params, timeout, stream=False):
+        requests_sent.append((request_params, timeout, stream))
+        return FakeResponse(200, lines=lines), 0
+
+    monkeypatch.setattr(func_annotator, "post_with_retry", fake_post)
+    env = {"api_key": "k", "api_url": "http://localhost", "model_name": "glm-test", "model_temperature": "0.3"}
+    tokens = []
+    result = generate_function_comment(TEST_FUNCTION, env, on_token=tokens.append)
+    assert requests_sent[0][0]["json"]["stream"] is True and requests_sent[0][2] is True
+    assert tokens == ["Input: a, b. ", "Output: 和."]
+    assert result["comment"] == '"""\nInput: a, b. Output: 和.\n"""'
+    assert 0 <= result["metrics"]["ttft"] <= result["metrics"]["latency"]
+    # 读到 [DONE] 后仍读完响应体，流式请求复用同一个 keep-alive 连接
+    monkeypatch.undo()
+    with mock_llm_server.MockLLMServer() as server:
+        for model in ("glm-4-flash", "qwen-plus"):
+            stream_env = {"api_key": "mock", "api_url": server.url, "model_name": model, "model_temperature": "0.3"}
+            assert all(isinstance(generate_function_comment(TEST_FUNCTION, stream_env, on_token=len), dict)
+                       for _ in range(5))
+    assert server.stats["streamed"] == 10 and server.stats["connections"] == 1
+
+
+def test_packed_request_splits_and_falls_back(tmp_path, monkeypatch):
+    """测试打包请求按分段拆分注释，解析失败的函数回退为单函数请求（无需API）"""
+    codes = [f"def f{i}(x):\n    return x + {i}\n" for i in range(3)]
+    packed_reply = (
+        "=== FUNCTION 1 ===\nInput: x. Output: x + 0.\n=== END 1 ===\n"
+        "=== FUNCTION 3 ===\nInput: x. Output: x + 2.\n=== END 3 ==="
+    )
+    prompts = []
+
+    def fake_post(request_params, timeout):
+        assert timeout >= 30
+        prompts.append(request_params["json"]["messages"][0]["content"])
+        return FakeResponse(200, {"choices": [{"message": {"content": packed_reply}}]}), 0
+
+    monkeypatch.setattr(prompt_packing, "post_with_retry", fake_post)
+    monkeypatch.setattr(prompt_packing, "generate_function_comment", lambda code, env, **kwargs: "single")
+    env = {"api_key": "k", "api_url": "http://localhost", "model_name": "glm-test", "model_temperature": "0.3"}
+    results = prompt_packing.generate_packed_comments(codes, env)
+    assert len(prompts) == 1 and "=== FUNCTION 3 ===" in prompts[0]
+    assert results[0]["comment"] == '"""\nInput: x. Output: x + 0.\n"""'
+    assert results[0]["metrics"]["packed"] == 3
+    assert results[1] == "single"
+    assert results[2]["comment"].endswith('x + 2.\n"""')
+    packs = prompt_packing.pack_functions([{"code": c} for c in codes], 2)
+    assert [[index for index, _ in pack] for pack in packs] == [[0, 1], [2]]
+    # 只剩一个未命中的函数时发送单函数请求，不重复查找缓存
+    monkeypatch.undo()
+    with mock_llm_server.MockLLMServer() as server:
+        cache_env = {"api_key": "mock", "api_url": server.url, "model_name": "glm-4-flash", "model_temperature": "0.3",
+                     "cache_path": str(tmp_path / "packed_cache.sqlite3")}
+        generate_function_comment(codes[0], cache_env)
+        results = prompt_packing.generate_packed_comments(codes[:2], cache_env)
+    assert results[0]["metrics"]["cache_hit"] and not results[1]["metrics"]["cache_hit"]
+    assert {k: v for k, v in get_annotation_cache(cache_env).stats().items() if k in ("hits", "misses")} == \
+        {"hits": 1, "misses": 2}
+
+
+def test_background_tracker_batches_and_falls_back(tmp_path):
+    """测试后台记录器按批写入父运行，服务器异常时写入本地JSONL并可重放（无需MLflow服务器）"""
+
+    class FakeClient:
+        def __init__(self):
+            self.down = False
+            self.calls = 0
+            self.metrics = []
+            self.artifact_files = []
+
+        def log_batch(self, run_id, metrics, params):
+            self.calls += 1
+            if self.down:
+                raise ConnectionError("tracking server down")
+            assert run_id == "parent" and not params
+            self.metrics.extend((m.key, m.value, m.step) for m in metrics)
+
+        def log_artifacts(self, run_id, artifact_dir, artifact_path):
+            self.calls += 1
+            assert run_id == "parent" and artifact_path == "functions"
+            self.artifact_files.extend(
+                os.path.relpath(os.path.join(root, name), artifact_dir)
+                for root, _, names in os.walk(artifact_dir) for name in names
+            )
+
+    client = FakeClient()
+    fallback_path = tmp_path / "fallback.jsonl"
+    tracker = tracking.BackgroundTracker("parent", "0", client=client, fallback_path=str(fallback_path),
+                                         flush_interval=0.5)
+    tracker.log_run("ok", {"file": "a.py"}, {"success": 1}, {"f_input.txt": "def f(): pass"})
+    tracker.log_run("ok2", {"file": "a.py"}, {"success": 1})
+    tracker.close()
+    # 两条记录在同一批中写入：一次 log_batch 加一次产物上传
+    assert client.calls == 2 and tracker.logged_count == 2
+    assert client.metrics == [("function/success", 1.0, 0), ("function/success", 1.0, 1)]
+    assert sorted(client.artifact_files) == [os.path.join("000000", "f_input.txt"),
+                                             os.path.join("000000", "record.json"),
+                                             os.path.join("000001", "record.json")]
+    client.down = True
+    broken = tracking.BackgroundTracker("parent", "0", client=client, fallback_path=str(fallback_path),
+                                        flush_interval=0.01)
+    broken.log_run("broken", {"file": "b.py"}, {"success": 0})
+    broken.close()
+    fallback = [json.loads(line) for line in fallback_path.read_text(encoding="utf-8").splitlines()]
+    assert [r["run_name"] for r in fallback] == ["broken"] and broken.fallback_count == 1
+    assert tracking.replay_fallback(str(fallback_path), client=client) == (0, 1)
+    client.down = False
+    assert tracking.replay_fallback(str(fallback_path), client=client) == (1, 0)
+    assert client.metrics[-1] == ("function/success", 0.0, 0) and fallback_path.read_text(encoding="utf-8") == ""
+
+
+def test_incremental_manifest_only_annotates_changed(tmp_path, monkeypatch, fake_annotator):
+    """测试增量模式只为变化的函数调用模型，统计仍包含全部函数（无需API）"""
+    sample_file = tmp_path / "function_sample_inc.py"
+    sample_file.write_text("def f1(x):\n    return x + 1\n\ndef f2(x):\n    return x + 2\n", encoding="utf-8")
+    calls = fake_annotator.calls
+    env = {"model_name": "glm-test", "model_temperature": "0.3"}
+    manifest_path = str(tmp_path / "manifest.json")
+    manifest = incremental.AnnotationManifest(manifest_path, "sig")
+    first = batch_annotator.process_sample_files([sample_file], env, manifest=manifest)
+    manifest.save()
+    # 仅修改 f2 并增加注释行（注释不影响指纹）
+    sample_file.write_text("def f1(x):\n    # comment\n    return x + 1\n\ndef f2(x):\n    return x * 2\n",
+                           encoding="utf-8")
+    calls.clear()
+    manifest = incremental.AnnotationManifest(manifest_path, "sig")
+    second = batch_annotator.process_sample_files([sample_file], env, manifest=manifest)
+    assert len(calls) == 1 and "x * 2" in calls[0]
+    assert manifest.carried_count == 1
+    assert first == second
+    # 签名变化（模型或模板变化）时全部重新注释
+    assert not incremental.AnnotationManifest(manifest_path, "other").entries
+    # token 预算变化同样使清单失效
+    signature = incremental.compute_run_signature(env, "template")
+    assert incremental.compute_run_signature({**env, "prompt_token_budget": 0}, "template") != signature
+    monkeypatch.setenv("MAX_OUTPUT_TOKENS", "512")
+    assert incremental.compute_run_signature(env, "template") != signature
+
+
+def test_repository_scanner_walks_tree(tmp_path):
+    """测试扫描器识别异步函数、类方法上下文并按 glob 过滤（无需API）"""
+    package_dir = tmp_path / "pkg"
+    package_dir.mkdir()
+    (package_dir / "service.py").write_text(
+        "class Client:\n"
+        "    async def fetch(self, url):\n"
+        "        return url\n\n"
+        "def outer():\n"
+        "    def inner():\n"
+        "        return 1\n"
+        "    return inner\n",
+        encoding="utf-8"
+    )
+    (package_dir / "test_service.py").write_text("def test_x():\n    pass\n", encoding="utf-8")
+    (tmp_path / ".venv").mkdir()
+    (tmp_path / ".venv" / "lib.py").write_text("def hidden():\n    pass\n", encoding="utf-8")
+    records = list(repo_scanner.scan_repository(str(tmp_path), exclude=[".venv", "test_*.py"], workers=2))
+    assert [(r['file'], r['qualname'], r['kind']) for r in records] == [
+        ("pkg/service.py", "Client.fetch", "async_method"),
+        ("pkg/service.py", "outer", "function"),
+        ("pkg/service.py", "outer.inner", "nested_function"),
+    ]
+    assert records[0]['code'].startswith("async def fetch") and records[0]['end_line'] == 3
+    assert records[0]['col_offset'] == 4
+    # 用户排除规则追加在默认排除之上，关闭默认排除后才会扫描 .venv
+    assert len(list(repo_scanner.scan_repository(str(tmp_path), exclude=["test_*.py"], workers=1))) == 3
+    unfiltered = repo_scanner.scan_repository(str(tmp_path), exclude=["pkg"], workers=1, default_excludes=False)
+    assert [r['file'] for r in unfiltered] == [".venv/lib.py"]
+
+
+def test_results_store_append_and_summary(tmp_path):
+    """测试结果数据集按行组写入、跨运行追加及汇总（无需API）"""
+    import results_store  # pylint: disable=import-outside-toplevel
+    dataset_dir = str(tmp_path / "annotations")
+    for run_id in ("run1", "run2"):
+        writer = results_store.ResultsWriter(dataset_dir, run_id, "glm-test", row_group_size=2)
+        for i in range(3):
+            writer.write({"file": "a.py" if i < 2 else "b.py", "function_name": f"f{i}", "line": i + 1,
+                          "comment": '"""\nx\n"""', "success": i != 1, "latency": 1.0 + i,
+                          "completeness": 1.0, "comment_density": 0.5, "input_length": 10,
+                          "output_length": 5, "error_message": None if i != 1 else "failed"},
+                         code=f"def f{i}(): pass")
+        writer.close()
+        assert writer.row_count == 3
+    summary = {row["file"]: row for row in results_store.summarize_results(dataset_dir).to_pylist()}
+    assert summary["a.py"]["functions"] == 4 and summary["a.py"]["successes"] == 2
+    assert summary["b.py"]["latency_mean"] == 3.0
+    errors = results_store.load_results(dataset_dir, columns=["function_name"], file_pattern="a.*",
+                                        errors_only=True)
+    assert errors.column("function_name").to_pylist() == ["f1", "f1"]
+
+
+def test_core_path_skips_tracking_imports():
+    """测试跟踪关闭时注释主流程不导入 mlflow/dagshub（无需API）"""
+    import subprocess  # pylint: disable=import-outside-toplevel
+    import sys  # pylint: disable=import-outside-toplevel
+    code = (
+        "import sys, func_annotator, batch_annotator\n"
+        "print(any(m in sys.modules for m in ('mlflow', 'dagshub')))"
+    )
+    output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    assert output.strip() == "False"
+    env = {"model_name": "glm-test", "model_temperature": "0.3", "tracking": False}
+    record = {"file": "a.py", "function_name": "f", "input_length": 10, "success": True}
+    result = {"metrics": {"latency": 0.1}, "comment": "x"}
+    batch_annotator.log_function_record(record, {"code": TEST_FUNCTION}, result, env)
+
+
+def test_batch_startup_skips_pyarrow_import():
+    """测试导入批处理模块不加载 pyarrow（只在写入或读取结果数据集时加载），命令行默认目录与结果存储一致（无需API）"""
+    import subprocess  # pylint: disable=import-outside-toplevel
+    import sys  # pylint: disable=import-outside-toplevel
+    import results_store  # pylint: disable=import-outside-toplevel
+    code = "import sys, batch_annotator\nprint('pyarrow' in sys.modules)"
+    output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    assert output.strip() == "False"
+    assert batch_annotator.DEFAULT_RESULTS_DIR == results_store.DEFAULT_RESULTS_DIR
+
+
+def test_metrics_engine_matches_request_path(tmp_path):
+    """测试离线批量评分与请求路径的评分结果一致，并能重新评分结果数据集（无需API）"""
+    import metrics_engine  # pylint: disable=import-outside-toplevel
+    import results_store  # pylint: disable=import-outside-toplevel
+    annotations = ["Input: a, b\nProcessing: add them\nOutput: the sum", "Returns  the   resultttt 中文", "", "x"]
+    codes = [TEST_FUNCTION, "def f(s):\n    return s * 2\n", "def g():\n    pass\n", "   "]
+    scores = metrics_engine.score_batch(annotations, codes)
+    assert list(scores["completeness"]) == [func_annotator.calculate_completeness(a) for a in annotations]
+    assert list(scores["comment_density"]) == [
+        func_annotator.calculate_comment_density(a, c) for a, c in zip(annotations, codes)
+    ]
+    assert list(scores["word_count"]) == [9, 4, 0, 1] and list(scores["line_count"]) == [3, 1, 0, 1]
+    dataset_dir = str(tmp_path / "annotations")
+    writer = results_store.ResultsWriter(dataset_dir, "run1", "glm-test")
+    for i, (annotation, code) in enumerate(zip(annotations[:2] * 3, codes[:2] * 3)):
+        result = func_annotator.build_comment_result(annotation, code, 0.1)
+        writer.write({"file": "a.py", "function_name": f"f{i}", "comment": result["comment"], "success": True,
+                      "completeness": result["metrics"]["completeness"],
+                      "comment_density": result["metrics"]["comment_density"]}, code=code)
+    writer.write({"file": "a.py", "function_name": "failed", "success": False, "error_message": "x"})
+    writer.close()
+    scored = metrics_engine.rescore_table(results_store.load_results(dataset_dir), workers=2, chunk_size=2)
+    assert scored.num_rows == 6
+    assert metrics_engine.count_changed(scored, "completeness") == 0
+    assert metrics_engine.count_changed(scored, "comment_density") == 0
+    distributions = {row["metric"]: row for row in metrics_engine.metric_distributions(scored).to_pylist()}
+    assert distributions["word_count"]["p50"] == 6.5 and distributions["line_count"]["max"] == 3
+
+
+def test_mock_server_speaks_both_response_shapes(monkeypatch):
+    """测试模拟模型服务的两种响应格式、流式响应和 429 重试（无需API）"""
+    monkeypatch.setenv("API_BACKOFF_BASE", "0")
+    with mock_llm_server.MockLLMServer(rate_limit_rate=0.5, seed=3) as server:
+        for model_name in ("glm-4-flash", "qwen-plus"):
+            for stream in (False, True):
+                env = {"api_key": "mock", "api_url": server.url, "model_name": model_name,
+                       "model_temperature": "0.3", "stream": stream}
+                result = generate_function_comment(TEST_FUNCTION, env)
+                assert isinstance(result, dict), result
+                assert "Output: returns the result of add." in result["comment"]
+                assert result["metrics"]["completeness"] == 1.0
+        packed = prompt_packing.generate_packed_comments([TEST_FUNCTION, "def sub(a, b):\n    return a - b\n"],
+                                                         {**env, "stream": False})
+        packed = [r for r in packed if isinstance(r, dict)]
+        assert [r["metrics"]["packed"] for r in packed] == [2, 2] and "sub" in packed[1]["comment"]
+    assert server.stats["rate_limited"] > 0 and server.stats["streamed"] == 2
+    assert server.stats["requests"] == 5 + server.stats["rate_limited"]
+    assert instrumentation.percentiles([0.1 * i for i in range(1, 101)])["p95"] == 0.1 * 95
+
+
+def test_provider_batch_export_and_ingest(tmp_path, monkeypatch):
+    """测试批处理请求导出（稳定 custom_id、分片）与结果导入为函数记录（无需API）"""
+    import results_store  # pylint: disable=import-outside-toplevel
+    monkeypatch.setenv("API_KEY", "test")
+    monkeypatch.setenv("API_URL", "https://open.bigmodel.cn/api/paas/v4/chat/completions")
+    monkeypatch.setenv("MODEL_NAME", "glm-4-flash")
+    monkeypatch.setenv("MODEL_TEMPERATURE", "0.3")
+    monkeypatch.setenv("CI", "1")
+    source_dir = tmp_path / "src"
+    source_dir.mkdir()
+    (source_dir / "ops.py").write_text(TEST_FUNCTION + "\n\ndef sub(a, b):\n    return a - b\n\n"
+                                       "class Box:\n    def size(self):\n        return 1\n", encoding="utf-8")
+    batch_path = str(tmp_path / "batch" / "requests.jsonl")
+    paths = batch_annotator.export_batch_requests(batch_path, source_root=str(source_dir), max_requests=2)
+    assert paths == [batch_path, str(tmp_path / "batch" / "requests.part2.jsonl")]
+    lines = [json.loads(line) for path in paths for line in Path(path).read_text(encoding="utf-8").splitlines()]
+    assert [line["url"] for line in lines] == ["/api/paas/v4/chat/completions"] * 3
+    assert lines[0]["body"]["model"] == "glm-4-flash" and "def add" in lines[0]["body"]["messages"][0]["content"]
+    batch_annotator.export_batch_requests(batch_path, source_root=str(source_dir))
+    assert [json.loads(line)["custom_id"] for line in Path(batch_path).read_text(encoding="utf-8").splitlines()] \
+        == [line["custom_id"] for line in lines]
+    results_path = tmp_path / "results.jsonl"
+    results_path.write_text("\n".join(json.dumps(row) for row in [
+        {"custom_id": lines[0]["custom_id"], "response": {"status_code": 200, "body": {
+            "choices": [{"message": {"content": "Input: a, b. Processing: add. Output: the sum."}}]}}},
+        {"custom_id": lines[1]["custom_id"], "response": {"status_code": 400, "body": {}},
+         "error": {"code": "1214", "message": "bad request"}},
+        {"custom_id": "func-unknown", "response": {"status_code": 200, "body": {}}}
+    ]), encoding="utf-8")
+    dataset_dir = str(tmp_path / "annotations")
+    overall = batch_annotator.ingest_batch_results(
+        [str(results_path)], task_index_path=str(tmp_path / "batch" / "requests.tasks.jsonl"),
+        results_dir=dataset_dir
+    )
+    assert overall["total_functions"] == 3 and overall["total_success"] == 1
+    assert overall["avg_completeness"] == 1.0
+    rows = results_store.load_results(dataset_dir, columns=["function_name", "error_message"]).to_pylist()
+    assert [(r["function_name"], r["error_message"]) for r in rows] == [
+        ("add", None), ("sub", "Batch request failed: bad request"), ("Box.size", "Missing from batch results")
+    ]
+
+
+def test_annotation_service_coalesces_in_flight_requests():
+    """测试常驻服务合并相同的在途请求并统计排队和延迟（无需API）"""
+    with mock_llm_server.MockLLMServer(latency="fixed:0.3") as server:
+        env = {"api_key": "mock", "api_url": server.url, "model_name": "glm-4-flash", "model_temperature": "0.3"}
+        service = annotation_service.AnnotationService(env, workers=2)
+        url = service.start_background()
+        try:
+            # 格式不同但规范化后相同的函数也会合并
+            codes = [TEST_FUNCTION] * 4 + ["def add(a: int, b: int) -> int:\n    return a + b  # sum\n",
+                                           "def sub(a, b):\n    return a - b\n"]
+            with ThreadPoolExecutor(max_workers=len(codes)) as executor:
+                responses = list(executor.map(
+                    lambda code: requests.post(f"{url}/annotate", json={"code": code}, timeout=10), codes
+                ))
+            assert [r.status_code for r in responses] == [200] * len(codes)
+            assert sum(r.json()["coalesced"] for r in responses) == 4
+            assert "sub" in responses[-1].json()["comment"]
+            assert requests.post(f"{url}/annotate", json={"code": "x = 1"}, timeout=10).status_code == 400
+            host, port = url.rsplit("/", 1)[-1].split(":")
+            for length in ("abc", "-5"):
+                with socket.create_connection((host, int(port)), timeout=10) as conn:
+                    conn.sendall(f"POST /annotate HTTP/1.1\r\nContent-Length: {length}\r\n\r\n{{}}".encode())
+                    reply = conn.makefile("rb").read()
+                assert reply.startswith(b"HTTP/1.1 400") and b"Invalid Content-Length" in reply
+            stats = requests.get(f"{url}/stats", timeout=10).json()
+        finally:
+            service.stop()
+    assert stats["requests"] == 7 and stats["upstream_calls"] == 3 and stats["coalesced"] == 4
+    assert stats["queue_depth"] == 0 and stats["max_queue_depth"] >= 1 and stats["latency"]["p99"] >= 0.3
+    assert server.stats["requests"] == 2
+
+
+def test_endpoint_router_prefers_fast_healthy_endpoint_and_hedges(monkeypatch):
+    """测试多端点路由：失败转移、摘除故障端点、选择最快端点及对冲请求（无需API）"""
+    monkeypatch.setenv("API_MAX_RETRIES", "0")
+    with mock_llm_server.MockLLMServer(latency="fixed:0.02") as fast, \
+            mock_llm_server.MockLLMServer(latency="fixed:0.1") as slow, \
+            mock_llm_server.MockLLMServer(error_rate=1.0) as broken:
+        endpoints = [
+            {"name": "broken", "api_url": broken.url, "api_key": "k", "model_name": "glm-4", "model_temperature": "0"},
+            {"name": "fast", "api_url": fast.url, "api_key": "k", "model_name": "glm-4", "model_temperature": "0"},
+            {"name": "slow", "api_url": slow.url, "api_key": "k", "model_name": "qwen-plus", "model_temperature": "0"},
+        ]
+        router = endpoint_router.EndpointRouter(endpoints, hedge=True, hedge_min_samples=5, failure_threshold=1)
+        env = {**endpoints[0], "router": router}
+        results = [generate_function_comment(TEST_FUNCTION, env) for _ in range(8)]
+        assert all(isinstance(r, dict) for r in results)
+        assert [r["metrics"]["endpoint"] for r in results][:2] == ["fast", "slow"]
+        assert {r["metrics"]["endpoint"] for r in results[2:]} == {"fast"}
+        assert broken.stats["requests"] == 1  # 失败一次后进入冷却期
+        # 最快端点变慢：超过其延迟分位数后对冲到次优端点
+        fast.sample_latency = mock_llm_server.parse_latency_spec("fixed:1.0")
+        hedged_before = router.stats()["hedged_calls"]  # 快速端点的调度抖动也可能触发对冲
+        start = time.time()
+        result = generate_function_comment(TEST_FUNCTION, env)
+        assert result["metrics"]["endpoint"] == "slow" and time.time() - start < 0.8
+        stats = router.stats()
+        assert stats["hedged_calls"] == hedged_before + 1
+        assert {e["name"]: e["hedges_won"] for e in stats["endpoints"]}["slow"] >= 1
+        # 失败计入惩罚延迟：未达到摘除阈值的失败端点排到健康端点之后
+        state = endpoint_router.EndpointState(endpoints[0])
+        state.record(0.001, False, failure_threshold=3, cooldown=30)
+        assert state.ewma_latency >= endpoint_router.FAILURE_LATENCY_FLOOR and not state.latencies
+        flaky = endpoint_router.EndpointRouter(endpoints[:2], failure_threshold=3)
+        flaky.states[1].record(0.02, True, failure_threshold=3, cooldown=30)
+        flaky.states[0].record(0.001, False, failure_threshold=3, cooldown=30)
+        assert flaky.select().name == "fast"
+        # 请求只在端点调用中构建一次，主环境无需完整配置
+        fast.sample_latency = mock_llm_server.parse_latency_spec("fixed:0.02")
+        phases = instrumentation.reset_instrumentation()
+        single = endpoint_router.EndpointRouter(endpoints[1:2])
+        assert isinstance(generate_function_comment(TEST_FUNCTION, {"router": single}), dict)
+        assert phases.summary()["template_load"]["count"] == 1
+
+
+def test_endpoint_router_stops_failover_after_streamed_tokens(monkeypatch):
+    """测试流式输出的失败转移：未输出文本时转移到下一端点，已有文本送达 on_token 后不再转移（无需API）"""
+    def event(text):
+        return "data: " + json.dumps({"choices": [{"delta": {"content": text}}]})
+
+    streams = []
+    monkeypatch.setattr(func_annotator, "post_with_retry", lambda *args, **kwargs: (streams.pop(0), 0))
+    endpoints = [{"name": name, "api_url": "http://localhost", "api_key": "k", "model_name": "glm-4",
+                  "model_temperature": "0"} for name in ("first", "second")]
+    env = {**endpoints[0], "router": endpoint_router.EndpointRouter(endpoints)}
+    # 第一个端点没有输出任何文本就失败：转移到第二个端点
+    streams.extend([FakeResponse(200, lines=["data: [DONE]"]),
+                    FakeResponse(200, lines=[event("Input: a, b."), event(" Output: sum."), "data: [DONE]"])])
+    tokens = []
+    result = generate_function_comment(TEST_FUNCTION, env, on_token=tokens.append)
+    assert result["metrics"]["endpoint"] == "second" and tokens == ["Input: a, b.", " Output: sum."]
+    # 输出一段文本后中断：不再转移，避免已输出的文本被下一个端点重复输出
+    env["router"] = endpoint_router.EndpointRouter(endpoints)
+    streams.extend([FakeResponse(200, lines=[event("Input: a"), "data: {"]),
+                    FakeResponse(200, lines=[event("Input: a, b."), "data: [DONE]"])])
+    tokens.clear()
+    assert generate_function_comment(TEST_FUNCTION, env, on_token=tokens.append) == \
+        "Problems in API response, please check."
+    assert tokens == ["Input: a"] and len(streams) == 1
+
+
+def test_instrumentation_histograms_merge_and_trace_phases(tmp_path):
+    """测试分阶段耗时：直方图分位数与合并、请求各阶段的记录及追踪文件导出（无需API）"""
+    first, second = instrumentation.LatencyHistogram(), instrumentation.LatencyHistogram()
+    for i in range(1, 101):
+        (first if i % 2 else second).record(i / 1000)
+    merged = instrumentation.LatencyHistogram.from_dict(json.loads(json.dumps(first.to_dict()))).merge(second)
+    assert merged.count == 100 and merged.max == 0.1
+    for q in (50, 95, 99):
+        assert abs(merged.percentile(q) - q / 1000) <= q / 1000 * 0.05
+    trace_path = tmp_path / "trace.json"
+    collector = instrumentation.reset_instrumentation(str(trace_path))
+    with mock_llm_server.MockLLMServer(latency="fixed:0.05") as server:
+        env = {"api_key": "mock", "api_url": server.url, "model_name": "glm-4-flash", "model_temperature": "0.3"}
+        for _ in range(3):
+            assert isinstance(generate_function_comment(TEST_FUNCTION, env), dict)
+    summary = collector.summary()
+    assert set(summary) >= {"template_load", "request_build", "connect", "ttfb", "download", "request",
+                            "json_parse", "metrics", "annotate"}
+    assert summary["connect"]["count"] == 1 and summary["annotate"]["count"] == 3  # keep-alive 连接只建立一次
+    assert 0.05 <= summary["ttfb"]["p50"] < summary["request"]["p50"] <= summary["annotate"]["p50"]
+    assert collector.metrics()["phase_ttfb_p99"] == summary["ttfb"]["p99"]
+    instrumentation.reset_instrumentation()
+    events = json.loads(trace_path.read_text(encoding="utf-8"))
+    assert {event["name"] for event in events} == set(summary) and all(event["ph"] == "X" for event in events)
+
+
+def test_dedup_annotates_one_representative_per_equivalent_group(fake_annotator):
+    """测试结构去重：仅标识符不同的函数只调用一次模型，注释中的名称按成员改写并重新评分（无需API）"""
+    fake_annotator.fail_marker, fake_annotator.latency = "fail", 0.5
+    fake_annotator.template = "Input: {name} takes first and second. Output: returns the result."
+    codes = [
+        'def add_values(first, second):\n    """Add."""\n    return first + second\n',
+        "def plus(x, y):\n    # sum\n    return x + y\n",
+        "def multiply(first, second):\n    return first * second\n",  # 结构不同
+        "def sub_fail(minuend, subtrahend):\n    return minuend - subtrahend\n",  # 代表失败，成员单独调用
+        "def sub(left, right):\n    return left - right\n",
+        "def twice(a):\n    return a + a\n",  # 单字母名称在注释中无法安全替换
+        "def double(b):\n    return b + b\n",
+        "def twice_again(a):\n    return a + a\n"  # 名称相同，可以复用
+    ]
+    tasks = [{"file": "m.py", "name": f"f{i}", "code": code} for i, code in enumerate(codes)]
+    deduplicator = dedup.FunctionDeduplicator()
+    records = batch_annotator.annotate_tasks(tasks, {"model_name": "glm-test", "model_temperature": "0"}, 4,
+                                             dedup=deduplicator)
+    assert len(fake_annotator.calls) == 6 and deduplicator.reused == 2
+    assert [r["success"] for r in records] == [True, True, True, False, True, True, True, True]
+    # 传入 on_record 时记录逐条交出、不再返回列表，内容与返回的列表一致
+    streamed = {}
+    assert batch_annotator.annotate_tasks(tasks, {"model_name": "glm-test", "model_temperature": "0"}, 4,
+                                          dedup=dedup.FunctionDeduplicator(), on_record=streamed.__setitem__) is None
+    assert [(streamed[i]["function_name"], streamed[i]["comment"]) for i in sorted(streamed)] == \
+        [(r["function_name"], r["comment"]) for r in records]
+    assert "Input: plus takes x and y." in records[1]["comment"]
+    assert records[1]["comment_density"] != records[0]["comment_density"] and records[1]["latency"] == 0.5
+    assert "Input: sub takes" in records[4]["comment"]  # 代表失败后单独注释
+    assert "Input: twice_again takes first" in records[7]["comment"]
+    assert dedup.canonicalize_function(codes[0])[0] == dedup.canonicalize_function(codes[1])[0]
+    assert dedup.rename_in_text("swap a_x and b_y", ("a_x", "b_y"), ("b_y", "a_x")) == "swap b_y and a_x"
+
+
+def test_token_budget_compacts_large_functions_and_reports_usage(monkeypatch):
+    """测试 token 预算：超预算函数保留签名和控制流压缩，max_tokens 随规模调整，指标包含估算与实际 token 数（无需API）"""
+    branches = "".join(
+        f"    if mode == {i}:\n        for item in items:\n            # step {i}\n"
+        f"            total += item * {i}\n            log('processing branch {i} with a long message text')\n"
+        for i in range(60)
+    )
+    large = (f'def dispatch(items, mode):\n    """Dispatch.\n\n    Details.\n    """\n    total = 0\n'
+             f'{branches}    return total\n')
+    compacted, level = token_budget.compact_function(large, 800)
+    assert level == "depth:0" and token_budget.estimate_tokens(compacted) <= 800
+    assert compacted.startswith("def dispatch(items, mode):") and "if mode == 59:" in compacted
+    assert "# step" not in compacted and "return total" in compacted
+    assert token_budget.compact_function(TEST_FUNCTION, 800) == (TEST_FUNCTION, None)
+    with mock_llm_server.MockLLMServer() as server:
+        for stream in (False, True):
+            env = {"api_key": "mock", "api_url": server.url, "model_name": "glm-4-flash", "model_temperature": "0.3",
+                   "stream": stream, "prompt_token_budget": 800}
+            small, big = generate_function_comment(TEST_FUNCTION, env), generate_function_comment(large, env)
+            assert small["metrics"]["compaction"] is None and big["metrics"]["compaction"] == "depth:0"
+            assert small["metrics"]["max_tokens"] < big["metrics"]["max_tokens"] <= 1024
+            for metrics in (small["metrics"], big["metrics"]):
+                assert metrics["output_tokens"] > 0
+                assert 0.5 < metrics["input_tokens"] / metrics["input_tokens_est"] < 2
+    # 预算变化会改变请求内容，缓存键随之变化
+    key_env = {"model_name": "glm-4-flash", "model_temperature": "0.3", "prompt_token_budget": 800}
+    key = build_cache_key(TEST_FUNCTION, key_env, "template")
+    assert build_cache_key(TEST_FUNCTION, {**key_env, "prompt_token_budget": 0}, "template") != key
+    monkeypatch.setenv("MAX_OUTPUT_TOKENS", "512")
+    assert build_cache_key(TEST_FUNCTION, key_env, "template") != key
+
+
+def test_work_queue_sharded_workers_resume_and_merge(tmp_path, fake_annotator):
+    """测试分片工作队列：崩溃进程的租约过期后被重新处理，多个工作进程并行，合并统计与单进程一致（无需API）"""
+    fake_annotator.fail_marker, fake_annotator.delay = "f3(", 0.002
+    source_dir = tmp_path / "src"
+    for package in ("a", "b"):
+        (source_dir / package).mkdir(parents=True)
+        (source_dir / package / "m.py").write_text(
+            "\n".join(f"def f{i}(x):\n    return x + {i}\n" for i in range(12)), encoding="utf-8"
+        )
+    queue_path = str(tmp_path / "queue.sqlite3")
+    assert batch_annotator.enqueue_work(queue_path, source_root=str(source_dir)) == 24
+    assert batch_annotator.enqueue_work(queue_path, source_root=str(source_dir)) == 0  # 重复入队跳过
+    # 模拟被杀的工作进程：租用后既未完成也未归还，租约过期后由其他工作进程重新处理
+    crashed = work_queue.WorkQueue(queue_path, lease_seconds=0.05)
+    assert len(crashed.lease("crashed", 5)) == 5
+    time.sleep(0.1)
+    with ThreadPoolExecutor(2) as pool:
+        completed = list(pool.map(
+            lambda worker: batch_annotator.run_queue_worker(queue_path, 2, worker_id=worker, lease_size=3),
+            ["w1", "w2"]
+        ))
+    assert sum(completed) == 24 and all(completed)
+    assert crashed.complete("crashed", [(1, {"stale": True})]) == 0  # 过期的完成结果不会覆盖
+    assert crashed.counts() == {"pending": 0, "leased": 0, "done": 24, "total": 24}
+    crashed.close()
+    merged = batch_annotator.merge_queue_results(queue_path)
+    expected = batch_annotator.compute_overall_stats(
+        batch_annotator.process_source_tree(str(source_dir), {"model_name": "glm-test", "model_temperature": "0"}),
+        merged["total_time"]
+    )
+    assert merged == expected
+    assert merged["total_functions"] == 24 and merged["total_errors"] == 2 and merged["total_files"] == 2
+    # 租约过期并被其他工作进程重新租用后，原工作进程的完成结果不会写入
+    requeue = work_queue.WorkQueue(str(tmp_path / "requeue.sqlite3"), lease_seconds=0.05)
+    requeue.enqueue([{"file": "m.py", "name": "f", "code": "def f():\n    pass\n"}])
+    [(task_id, _)] = requeue.lease("slow", 1)
+    time.sleep(0.1)
+    assert requeue.lease("fast", 1)[0][0] == task_id
+    assert requeue.complete("slow", [(task_id, {"stale": True})]) == 0
+    assert requeue.complete("fast", [(task_id, {"fresh": True})]) == 1
+    assert [record for _, record in requeue.iter_done()] == [{"fresh": True}]
+    requeue.close()
+
+
+def test_docstring_write_back_inserts_replaces_and_diffs(tmp_path, fake_annotator):
+    """测试文档字符串回写：插入或替换并保持缩进和换行符，跳过修改过的和单行函数，dry-run 只输出 diff（无需API）"""
+    source = (
+        "import functools\n\n\n"
+        "def plain(x):\n    return x\n\n\n"
+        "def documented(x):\n    '''Old\n    docstring.'''\n    return x\n\n\n"
+        "class Box:\n"
+        "    def method(\n            self,\n            value,\n    ):\n        # keep me\n        return value\n\n"
+        "    def outer(self):\n        @functools.lru_cache\n        def inner():\n            return 1\n"
+        "        return inner()\n\n\n"
+        "def one_liner(x): return x\n"
+    )
+    source_dir = tmp_path / "src"
+    (source_dir / "pkg").mkdir(parents=True)
+    (source_dir / "pkg" / "mod.py").write_text(source, encoding="utf-8")
+    (source_dir / "crlf.py").write_bytes(b"def crlf(x):\r\n    return x\r\n")
+    overall = batch_annotator.batch_annotate(2, source_root=str(source_dir), write_back="diff")
+    assert overall["total_success"] == 7
+    assert (source_dir / "pkg" / "mod.py").read_text(encoding="utf-8") == source  # dry-run 不修改文件
+    records = [{"file": task["file"], "function_name": task["qualname"], "line": task["line"], "code": task["code"],
+                "comment": fake_annotator(task["code"], None)["comment"], "success": True}
+               for task in repo_scanner.scan_repository(str(source_dir), workers=1)]
+    records[1]["code"] = "def plain(x):\n    return x + 1\n"  # 注释后源码已被修改
+    summary = docstring_writer.write_back_docstrings(str(source_dir), records, workers=2)
+    assert (summary["written"], summary["unmatched"], summary["skipped"], summary["changed_files"]) == (5, 1, 1, 2)
+    updated = (source_dir / "pkg" / "mod.py").read_text(encoding="utf-8")
+    assert "def plain(x):\n    return x\n" in updated and "Old" not in updated
+    assert '    ):\n        """\n        Input: method args.\n\n        Output: a "quoted" value.\n        """\n' \
+           '        # keep me\n' in updated
+    assert '    def outer(self):\n        """\n        Input: outer args.' in updated
+    assert '        @functools.lru_cache\n        def inner():\n            """\n            Input: inner' in updated
+    assert 'def documented(x):\n    """\n    Input: documented args.\n\n    Output: a "quoted" value.\n    """\n' \
+           '    return x\n' in updated
+    assert (source_dir / "crlf.py").read_bytes() == \
+        b'def crlf(x):\r\n    """\r\n    Input: crlf args.\r\n\r\n    Output: a "quoted" value.\r\n    """\r\n' \
+        b'    return x\r\n'
+    assert docstring_writer.format_docstring('x """ y \\ z', "") == ['"""\n', 'x \\"\\"\\" y \\\\ z\n', '"""\n']
+    again = docstring_writer.write_back_docstrings(str(source_dir), records, workers=1)
+    assert (again["written"], again["unchanged"], again["changed_files"]) == (0, 5, 0)
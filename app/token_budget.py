@@ -0,0 +1,209 @@
+"""token 预算
+在本地估算提示词的 token 数：函数代码超过输入预算时逐级压缩（去掉注释和文档字符串正文、截短长字面量、
+从最深层开始把嵌套代码块替换为 ...，保留函数签名和控制流结构），并按函数大小调整 max_tokens
+
+配置：PROMPT_TOKEN_BUDGET（函数代码的 token 上限，默认 3000，0 表示不压缩）、
+MAX_OUTPUT_TOKENS（max_tokens 上限，默认 1024）
+"""
+import ast
+import copy
+import os
+import re
+import textwrap
+
+DEFAULT_PROMPT_TOKEN_BUDGET = 3000
+DEFAULT_MAX_OUTPUT_TOKENS = 1024
+MIN_OUTPUT_TOKENS = 256  # 三段式注释的基本长度
+OUTPUT_TOKENS_PER_INPUT_TOKEN = 0.5  # 注释长度随函数规模增长，但远慢于代码本身
+MAX_LITERAL_CHARS = 40
+MAX_COLLECTION_ITEMS = 6
+ELLIPSIS_MARKER = "    ..."
+# 单词按约 4 个字符一个 token 计，数字约 3 位一个 token，标点和中日韩字符各计一个，换行及缩进计一个
+TOKEN_PATTERN = re.compile(r"[A-Za-z]+|\d+|\n[ \t]*|[ \t]+|[\u3000-\u9fff\uff00-\uffef]|[^\sA-Za-z\d]")
+
+
+def estimate_tokens(text):
+    """在本地估算文本的 token 数（接近常见 BPE 分词器对代码和英文的结果）"""
+    count = 0
+    for piece in TOKEN_PATTERN.findall(text):
+        first = piece[0]
+        if first.isalpha() and first.isascii():
+            count += -(-len(piece) // 4)
+        elif first.isdigit():
+            count += -(-len(piece) // 3)
+        elif first == "\n":
+            count += 1
+        elif not first.isspace():
+            count += 1
+    return count + 1
+
+
+def get_prompt_token_budget(environment=None):
+    """函数代码的 token 预算（环境配置 prompt_token_budget 优先，其次读取 PROMPT_TOKEN_BUDGET），0 表示不限制"""
+    budget = (environment or {}).get("prompt_token_budget")
+    if budget is None:
+        budget = int(os.getenv("PROMPT_TOKEN_BUDGET", str(DEFAULT_PROMPT_TOKEN_BUDGET)))
+    return budget
+
+
+def get_max_output_tokens():
+    """单个函数的 max_tokens 上限（读取 MAX_OUTPUT_TOKENS）"""
+    return int(os.getenv("MAX_OUTPUT_TOKENS", str(DEFAULT_MAX_OUTPUT_TOKENS)))
+
+
+def choose_max_tokens(code_tokens, functions=1):
+    """按函数代码的估算 token 数确定 max_tokens（打包请求按函数数量累加，总上限为单函数上限乘以函数数量）"""
+    cap = get_max_output_tokens()
+    per_function = MIN_OUTPUT_TOKENS + OUTPUT_TOKENS_PER_INPUT_TOKEN * code_tokens / functions
+    return int(min(cap, per_function) * functions)
+
+
+def _ellipsis():
+    return ast.Expr(ast.Constant(...))
+
+
+class _LiteralShortener(ast.NodeTransformer):
+    """截短长字符串（文档字符串只保留首行）和长的列表/元组/集合/字典字面量"""
+
+    def visit_Constant(self, node):  # pylint: disable=invalid-name
+        if isinstance(node.value, (str, bytes)) and len(node.value) > MAX_LITERAL_CHARS:
+            value = node.value
+            if isinstance(value, str) and "\n" in value.strip():
+                value = value.strip().splitlines()[0]
+            if len(value) > MAX_LITERAL_CHARS:
+                value = value[:MAX_LITERAL_CHARS - 3] + ("..." if isinstance(value, str) else b"...")
+            node.value = value
+        return node
+
+    def _shorten(self, node, field):
+        self.generic_visit(node)
+        items = getattr(node, field)
+        if len(items) > MAX_COLLECTION_ITEMS:
+            setattr(node, field, items[:MAX_COLLECTION_ITEMS - 1] + [ast.Constant(...)])
+        return node
+
+    def visit_List(self, node):  # pylint: disable=invalid-name
+        return self._shorten(node, "elts")
+
+    def visit_Tuple(self, node):  # pylint: disable=invalid-name
+        return self._shorten(node, "elts")
+
+    def visit_Set(self, node):  # pylint: disable=invalid-name
+        return self._shorten(node, "elts")
+
+    def visit_Dict(self, node):  # pylint: disable=invalid-name
+        self.generic_visit(node)
+        if len(node.keys) > MAX_COLLECTION_ITEMS:
+            node.keys = node.keys[:MAX_COLLECTION_ITEMS - 1]
+            node.values = node.values[:MAX_COLLECTION_ITEMS - 1]
+        return node
+
+
+def _child_blocks(statement):
+    """语句包含的代码块 [(所属节点, 字段名, 是否为 elif)]（含 try 的 except 块和 match 的 case 块）"""
+    blocks = []
+    for field in ("body", "orelse", "finalbody"):
+        block = getattr(statement, field, None)
+        if isinstance(block, list) and block and isinstance(block[0], ast.stmt):
+            is_elif = field == "orelse" and isinstance(statement, ast.If) and len(block) == 1 \
+                and isinstance(block[0], ast.If)
+            blocks.append((statement, field, is_elif))
+    for handler in getattr(statement, "handlers", []):
+        blocks.append((handler, "body", False))
+    for case in getattr(statement, "cases", []):
+        blocks.append((case, "body", False))
+    return blocks
+
+
+def _block_depth(statements):
+    """代码块的最大嵌套层数（elif 不增加层数）"""
+    depth = 0
+    for statement in statements:
+        for owner, field, is_elif in _child_blocks(statement):
+            inner = _block_depth(getattr(owner, field))
+            depth = max(depth, inner if is_elif else inner + 1)
+    return depth
+
+
+def _trim_blocks(statements, depth, limit):
+    """把嵌套层数不小于 limit 的代码块替换为 ...，保留外层的控制流语句"""
+    for statement in statements:
+        for owner, field, is_elif in _child_blocks(statement):
+            if is_elif:
+                _trim_blocks(getattr(owner, field), depth, limit)
+            elif depth >= limit:
+                setattr(owner, field, [_ellipsis()])
+            else:
+                _trim_blocks(getattr(owner, field), depth + 1, limit)
+
+
+def _function_body(tree):
+    """模块中函数定义的函数体（代码不是单个函数时返回模块顶层语句）"""
+    if len(tree.body) == 1 and isinstance(tree.body[0], (ast.FunctionDef, ast.AsyncFunctionDef)):
+        return tree.body[0].body
+    return tree.body
+
+
+def _truncate_lines(code, budget):
+    """保留开头在预算内的行，其余以 ... 代替（无法解析的代码或压缩后仍超预算时使用）"""
+    kept = []
+    used = estimate_tokens(ELLIPSIS_MARKER)
+    for line in code.splitlines():
+        used += estimate_tokens(line + "\n")
+        if used > budget and kept:
+            break
+        kept.append(line)
+    return "\n".join(kept + [ELLIPSIS_MARKER]) + "\n"
+
+
+def compact_function(function_code, budget):
+    """将函数代码压缩到 token 预算内，返回 (代码, 压缩级别)
+
+    依次尝试：去掉注释并截短文档字符串和长字面量（literals）、从最深层开始把嵌套代码块替换为 ...（depth:N）、
+    按行截断（truncate）。未超出预算时原样返回，级别为 None。
+    """
+    if not budget or estimate_tokens(function_code) <= budget:
+        return function_code, None
+    try:
+        tree = ast.parse(textwrap.dedent(function_code))
+    except SyntaxError:
+        return _truncate_lines(function_code, budget), "truncate"
+    tree = _LiteralShortener().visit(tree)
+    compacted = ast.unparse(tree) + "\n"
+    if estimate_tokens(compacted) <= budget:
+        return compacted, "literals"
+    for limit in range(_block_depth(_function_body(tree)) - 1, -1, -1):
+        trimmed = copy.deepcopy(tree)
+        _trim_blocks(_function_body(trimmed), 0, limit)
+        compacted = ast.unparse(trimmed) + "\n"
+        if estimate_tokens(compacted) <= budget:
+            return compacted, f"depth:{limit}"
+    return _truncate_lines(compacted, budget), "truncate"
+
+
+def compact_functions(function_codes, environment):
+    """打包请求：逐个函数按预算压缩，返回 (压缩后的代码列表, 各函数的压缩级别, 压缩后代码的估算 token 总数)"""
+    budget = get_prompt_token_budget(environment)
+    compacted = [compact_function(code, budget) for code in function_codes]
+    codes = [code for code, _ in compacted]
+    return codes, [level for _, level in compacted], sum(estimate_tokens(code) for code in codes)
+
+
+def plan_function_prompt(function_code, prompt_template, environment):
+    """按预算构建单个函数的提示词，返回 (提示词, 预算信息)
+
+    预算信息：code_tokens（原始代码的估算 token 数）、input_tokens_est（整个提示词的估算 token 数）、
+    max_tokens（按压缩后代码规模确定）、compaction（压缩级别，未压缩时为 None），
+    以及由响应填入的实际用量 input_tokens/output_tokens（服务端未返回时为 None）。
+    """
+    code_tokens = estimate_tokens(function_code)
+    code, compaction = compact_function(function_code, get_prompt_token_budget(environment))
+    prompt = prompt_template.replace("{function_code}", code)
+    return prompt, {
+        "code_tokens": code_tokens,
+        "input_tokens_est": estimate_tokens(prompt),
+        "max_tokens": choose_max_tokens(code_tokens if compaction is None else estimate_tokens(code)),
+        "compaction": compaction,
+        "input_tokens": None,
+        "output_tokens": None
+    }
@@ -0,0 +1,245 @@
+"""实验跟踪层
+mlflow 和 dagshub 均为延迟导入：跟踪关闭（CI 或 Docker 环境）时不会加载，注释主流程只导入所需模块。
+批处理的函数级记录先进入有界队列，由后台线程按批写入父运行（每批一次 log_batch + 一次整目录上传），
+跟踪服务器变慢或不可用时改写到本地 JSONL 文件，不阻塞批处理；回退文件可用 replay_fallback 重新写入
+"""
+import atexit
+import importlib
+import itertools
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from instrumentation import get_instrumentation
+
+DEFAULT_FALLBACK_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'tracking_fallback.jsonl')
+_STOP = object()
+MAX_BATCH_RECORDS = 200  # 每次刷新最多写入的记录数
+MAX_BATCH_METRICS = 1000  # MLflow log_batch 单次请求的指标上限
+
+
+class LazyModule:
+    """模块代理：首次访问属性时才导入真实模块"""
+
+    def __init__(self, module_name):
+        self._module_name = module_name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._module_name)
+        return getattr(self._module, attr)
+
+
+mlflow = LazyModule("mlflow")
+dagshub = LazyModule("dagshub")
+
+
+def tracking_enabled(environment):
+    """是否记录实验跟踪（由 init_environment 根据 CI/Docker 环境决定）"""
+    return bool(environment) and bool(environment.get("tracking"))
+
+
+def init_tracking():
+    """配置 MLflow 跟踪服务器并初始化 dagshub（首次调用时才导入相关模块）"""
+    mlflow_tracking_uri = os.getenv("MLFLOW_TRACKING_URI")
+    mlflow_experiment = os.getenv("MLFLOW_EXPERIMENT")
+    if mlflow_tracking_uri and mlflow_experiment:
+        mlflow.set_tracking_uri(mlflow_tracking_uri)
+        mlflow.set_experiment(mlflow_experiment)
+    dagshub.init(
+        repo_name=os.getenv("DAGSHUB_REPO"),
+        repo_owner=os.getenv("DAGSHUB_USER"),
+        mlflow=True,
+        host="https://dagshub.com"
+    )
+
+
+@contextmanager
+def start_run(environment, run_name):
+    """跟踪开启时启动 MLflow 运行并返回运行ID，关闭时不做任何操作并返回 None"""
+    if not tracking_enabled(environment):
+        yield None
+        return
+    with mlflow.start_run(run_name=run_name) as run:
+        yield run.info.run_id
+
+
+def log_params(environment, params):
+    """跟踪开启时向当前运行记录参数"""
+    if tracking_enabled(environment):
+        mlflow.log_params(params)
+
+
+def log_metrics(environment, metrics):
+    """跟踪开启时向当前运行记录指标"""
+    if tracking_enabled(environment):
+        mlflow.log_metrics(metrics)
+
+
+def write_records(client, parent_run_id, records):
+    """把一批函数级记录写入父运行：指标按记录序号作为 step 用 log_batch 写入，
+    参数和文本产物按序号分目录后整体上传一次，每批只有 log_batch 和 log_artifacts 两类请求
+    """
+    metrics = [
+        mlflow.entities.Metric(f"function/{key}", float(value), record["timestamp"], record.get("step", 0))
+        for record in records for key, value in record["metrics"].items()
+    ]
+    for offset in range(0, len(metrics), MAX_BATCH_METRICS):
+        client.log_batch(parent_run_id, metrics=metrics[offset:offset + MAX_BATCH_METRICS], params=[])
+    with tempfile.TemporaryDirectory() as artifact_dir:
+        for record in records:
+            record_dir = os.path.join(artifact_dir, f"{record.get('step', 0):06d}")
+            os.makedirs(record_dir, exist_ok=True)
+            with open(os.path.join(record_dir, "record.json"), 'w', encoding='utf-8') as f:
+                json.dump({"run_name": record["run_name"], "step": record.get("step", 0), "params": record["params"]},
+                          f, ensure_ascii=False)
+            for file_name, text in record["texts"].items():
+                with open(os.path.join(record_dir, file_name), 'w', encoding='utf-8') as f:
+                    f.write(text)
+        client.log_artifacts(parent_run_id, artifact_dir, artifact_path="functions")
+
+
+def replay_fallback(fallback_path=None, *, client=None):
+    """把本地回退文件中的记录重新写入各自的父运行，返回 (写入数, 仍失败数)；仍失败的记录留在文件中"""
+    fallback_path = fallback_path or os.getenv("TRACKING_FALLBACK_PATH", DEFAULT_FALLBACK_PATH)
+    if not os.path.exists(fallback_path):
+        return 0, 0
+    client = client or mlflow.tracking.MlflowClient()
+    by_parent = {}
+    with open(fallback_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                by_parent.setdefault(record.pop("parent_run_id"), []).append(record)
+    replayed, remaining = 0, []
+    for parent_run_id, records in by_parent.items():
+        for offset in range(0, len(records), MAX_BATCH_RECORDS):
+            chunk = records[offset:offset + MAX_BATCH_RECORDS]
+            try:
+                write_records(client, parent_run_id, chunk)
+                replayed += len(chunk)
+            except Exception as e:
+                remaining.extend({**record, "parent_run_id": parent_run_id, "fallback_reason": str(e)}
+                                 for record in chunk)
+    with open(fallback_path, 'w', encoding='utf-8') as f:
+        for record in remaining:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    return replayed, len(remaining)
+
+
+class BackgroundTracker:
+    """在后台线程中把函数级记录批量写入 MLflow 父运行"""
+
+    def __init__(self, parent_run_id, experiment_id, *, client=None, fallback_path=None,
+                 max_queue=None, flush_interval=1.0):
+        self.parent_run_id = parent_run_id
+        self.experiment_id = experiment_id
+        self.client = client or mlflow.tracking.MlflowClient()
+        self.fallback_path = fallback_path or os.getenv("TRACKING_FALLBACK_PATH", DEFAULT_FALLBACK_PATH)
+        self.flush_interval = flush_interval
+        self.logged_count = 0
+        self.fallback_count = 0
+        self._steps = itertools.count()
+        self._queue = queue.Queue(maxsize=max_queue or int(os.getenv("TRACKING_QUEUE_SIZE", "1000")))
+        self._fallback_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="mlflow-tracker", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def for_active_run(cls, **kwargs):
+        """以当前活动的 MLflow 运行作为父运行创建记录器"""
+        run = mlflow.active_run()
+        return cls(run.info.run_id, run.info.experiment_id, **kwargs)
+
+    def log_run(self, run_name, params, metrics, texts=None):
+        """提交一条函数级记录；队列已满时直接写入本地回退文件，不等待"""
+        record = {
+            "run_name": run_name,
+            "step": next(self._steps),
+            "params": params,
+            "metrics": metrics,
+            "texts": texts or {},
+            "timestamp": int(time.time() * 1000)
+        }
+        if self._closed:
+            self._write_fallback([record], "tracker closed")
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._write_fallback([record], "queue full")
+
+    def _run(self):
+        """后台线程：收到第一条记录后继续收集一个刷新间隔（或攒满一批），再整批写入"""
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < MAX_BATCH_RECORDS:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    # 关闭时不再等待刷新间隔，取出剩余记录立即写入
+                    stopping = True
+                    deadline = time.monotonic()
+                    continue
+                batch.append(item)
+            self._flush_batch(batch)
+
+    def _flush_batch(self, records):
+        """将一批记录写入父运行，失败时整批写入本地回退文件"""
+        start = time.perf_counter()
+        try:
+            write_records(self.client, self.parent_run_id, records)
+            self.logged_count += len(records)
+        except Exception as e:
+            self._write_fallback(records, str(e))
+        finally:
+            get_instrumentation().record("tracking_flush", time.perf_counter() - start, start)
+
+    def _write_fallback(self, records, reason):
+        """追加写入本地 JSONL 回退文件"""
+        with self._fallback_lock, open(self.fallback_path, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps({
+                    **record,
+                    "parent_run_id": self.parent_run_id,
+                    "fallback_reason": reason
+                }, ensure_ascii=False) + "\n")
+            self.fallback_count += len(records)
+
+    def close(self, timeout=None):
+        """停止接收新记录，等待队列中的记录全部写出"""
+        if self._closed:
+            return
+        self._closed = True
+        timeout = timeout if timeout is not None else float(os.getenv("TRACKING_FLUSH_TIMEOUT", "60"))
+        deadline = time.time() + timeout
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(max(0.0, deadline - time.time()))
+        if self._thread.is_alive():
+            # 超时仍未写完：剩余记录转存到本地回退文件
+            remaining = []
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not _STOP:
+                    remaining.append(item)
+            if remaining:
+                self._write_fallback(remaining, "flush timeout")
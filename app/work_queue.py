@@ -0,0 +1,176 @@
+"""分片批处理的本地工作队列
+函数任务存放在 SQLite 文件中（WAL 模式，可放在多个进程或 Docker 容器共享的本地卷上），
+工作进程按批租用任务，完成后写回函数记录；租约过期未完成的任务（进程被杀或崩溃）会被其他工作进程重新租用，
+因此一个工作进程退出最多丢失其在途任务。所有任务完成后由合并步骤汇总统计
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing, contextmanager
+from itertools import islice
+
+DEFAULT_QUEUE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'outputs', 'work_queue.sqlite3')
+DEFAULT_LEASE_SECONDS = 600
+MAX_ATTEMPTS = 3  # 租约过期次数达到上限的任务记为失败，避免反复拖垮工作进程
+QUEUE_TASK_FIELDS = ("file", "name", "qualname", "kind", "line", "end_line", "fingerprint", "code")
+
+
+def build_task_key(task):
+    """任务的唯一键（文件、限定名、起始行和 AST 指纹），重复入队时据此去重"""
+    return f"{task['file']}::{task.get('qualname', task['name'])}::{task.get('line')}::{task.get('fingerprint')}"
+
+
+def default_worker_id():
+    """默认的工作进程标识：主机名-进程号-随机后缀（容器内主机名即容器 ID）"""
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+class WorkQueue:
+    """基于 SQLite 的任务队列，支持租约、过期重租和断点续跑；同一对象可在多线程间共享"""
+
+    def __init__(self, path=DEFAULT_QUEUE_PATH, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # isolation_level=None：手动管理事务，租用时用 BEGIN IMMEDIATE 避免多个进程租到同一任务
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, task_key TEXT UNIQUE NOT NULL, task TEXT NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', worker TEXT, lease_expires REAL, attempts INTEGER NOT NULL "
+            "DEFAULT 0, record TEXT, leased_at REAL, completed_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_expires)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, started_at REAL, finished_at REAL, "
+            "completed INTEGER NOT NULL DEFAULT 0, phases TEXT)"
+        )
+
+    @contextmanager
+    def _write(self):
+        """写事务：BEGIN IMMEDIATE 立即取得写锁，多个进程不会租到同一任务"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def enqueue(self, tasks, chunk_size=1000):
+        """加入任务（已存在的任务跳过，重复入队可续跑），返回新加入的数量"""
+        added = 0
+        tasks = iter(tasks)
+        while chunk := list(islice(tasks, chunk_size)):
+            rows = [(build_task_key(task), json.dumps({k: task.get(k) for k in QUEUE_TASK_FIELDS}, ensure_ascii=False))
+                    for task in chunk]
+            with self._write() as conn:
+                before = conn.total_changes
+                conn.executemany("INSERT OR IGNORE INTO tasks (task_key, task) VALUES (?, ?)", rows)
+                added += conn.total_changes - before
+        return added
+
+    def lease(self, worker, limit):
+        """租用最多 limit 个待处理或租约已过期的任务，返回 [(任务 ID, 任务)]
+
+        租约过期次数已达上限的任务直接记为完成且没有记录（合并时计为失败），不再分配。
+        """
+        now = time.time()
+        with self._write() as conn:
+            conn.execute(
+                "UPDATE tasks SET status = 'done', completed_at = ?, record = NULL "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, now, self.max_attempts)
+            )
+            rows = conn.execute(
+                "SELECT id, task FROM tasks WHERE status = 'pending' "
+                "OR (status = 'leased' AND lease_expires < ?) ORDER BY id LIMIT ?",
+                (now, limit)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE tasks SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, "
+                "leased_at = COALESCE(leased_at, ?) WHERE id = ?",
+                [(worker, now + self.lease_seconds, now, task_id) for task_id, _ in rows]
+            )
+        return [(task_id, json.loads(task)) for task_id, task in rows]
+
+    def complete(self, worker, results):
+        """写回完成的任务 [(任务 ID, 函数记录)]，返回写入数量
+
+        只写回仍由该工作进程租用的任务：租约过期后已被其他工作进程重新租用或完成的任务保持不变。
+        """
+        now = time.time()
+        with self._write() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "UPDATE tasks SET status = 'done', record = ?, completed_at = ? "
+                "WHERE id = ? AND status != 'done' AND worker = ?",
+                [(json.dumps(record, ensure_ascii=False), now, task_id, worker) for task_id, record in results]
+            )
+            return conn.total_changes - before
+
+    def release(self, worker, task_ids):
+        """归还未完成的任务（工作进程被中断时调用），使其立即可被重新租用"""
+        if not task_ids:
+            return
+        with self._write() as conn:
+            conn.execute(
+                "UPDATE tasks SET status = 'pending', worker = NULL, lease_expires = NULL, "
+                "attempts = MAX(attempts - 1, 0) WHERE status = 'leased' AND worker = ? "
+                f"AND id IN ({','.join('?' * len(task_ids))})",
+                (worker, *task_ids)
+            )
+
+    def register_worker(self, worker):
+        """记录工作进程开始"""
+        with self._write() as conn:
+            conn.execute("INSERT OR REPLACE INTO workers (worker, started_at) VALUES (?, ?)", (worker, time.time()))
+
+    def finish_worker(self, worker, completed, phases):
+        """记录工作进程结束、完成的任务数及其分阶段耗时直方图（供合并步骤汇总）"""
+        with self._write() as conn:
+            conn.execute("UPDATE workers SET finished_at = ?, completed = ?, phases = ? WHERE worker = ?",
+                         (time.time(), completed, json.dumps(phases), worker))
+
+    def counts(self):
+        """各状态的任务数 {"pending", "leased", "done", "total"}"""
+        with self._lock:
+            rows = dict(self._conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+        counts = {status: rows.get(status, 0) for status in ("pending", "leased", "done")}
+        counts["total"] = sum(counts.values())
+        return counts
+
+    def time_span(self):
+        """首个任务被租用到最后一个任务完成的时间跨度（秒）"""
+        with self._lock:
+            first, last = self._conn.execute("SELECT MIN(leased_at), MAX(completed_at) FROM tasks").fetchone()
+        return (last - first) if first is not None and last is not None else 0.0
+
+    def iter_done(self):
+        """按入队顺序逐个产出已完成的 (任务, 函数记录)；租约多次过期而放弃的任务记录为 None
+
+        使用单独的连接逐行读取游标，不一次载入全部记录，也不占用共享连接的锁。
+        """
+        with closing(sqlite3.connect(self.path, timeout=60)) as conn:
+            for task, record in conn.execute("SELECT task, record FROM tasks WHERE status = 'done' ORDER BY id"):
+                yield json.loads(task), json.loads(record) if record else None
+
+    def worker_phases(self):
+        """所有已结束工作进程的分阶段耗时直方图列表"""
+        with self._lock:
+            rows = self._conn.execute("SELECT phases FROM workers WHERE phases IS NOT NULL").fetchall()
+        return [json.loads(phases) for (phases,) in rows]
+
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            self._conn.close()